@@ -1,120 +1,401 @@
+import logging
 import os
 import requests
 import json
-from flask import Blueprint, request, jsonify
+import http_client
+import d1
+from circuit_breaker import CircuitOpenError
+from fair_scheduler import SlotTimeout, slot
+from admission import service_unavailable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Blueprint, request, jsonify, Response, stream_with_context
+from rate_limit import get_bucket
+from credential_cache import credential_cache, NOT_CONFIGURED
+import credential_replica
+import customer_index
+import points_accumulator
+import push_dispatcher
+from single_flight import get_group
+import metrics
+from idempotency import idempotent
+from structured_log import log_payload
 
 # Crea el Blueprint para este módulo
 customer_actions_bp = Blueprint('customer_actions', __name__)
+logger = logging.getLogger(__name__)
 
 # URL base de la API de SmartPasses
-SMARTPASSES_API_BASE_URL = "https://pass.smartpasses.io/api/v1/loyalty"
+SMARTPASSES_API_BASE_URL = os.environ.get('SMARTPASSES_API_BASE_URL', "https://pass.smartpasses.io/api/v1/loyalty")
 
-# -----------------------------------------------------------------------------
-# FUNCIÓN AUXILIAR PARA COMUNICARSE CON CLOUDFLARE D1
-# -----------------------------------------------------------------------------
-def query_d1(sql, params=[]):
-    """
-    Ejecuta una consulta SQL en la base de datos D1 a través de la API de Cloudflare.
-    Lee las credenciales necesarias desde los Secrets de Replit.
-    """
-    account_id = os.environ.get('CF_ACCOUNT_ID')
-    db_id = os.environ.get('CF_D1_DATABASE_ID')
-    api_token = os.environ.get('CF_API_TOKEN')
-
-    if not all([account_id, db_id, api_token]):
-        print("🚨 ERROR: Faltan secretos de Cloudflare en Replit (CF_ACCOUNT_ID, CF_D1_DATABASE_ID, CF_API_TOKEN).")
-        return None, ("Faltan secretos de configuración del servidor.", 500)
-
-    url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/d1/database/{db_id}/query"
-    headers = {"Authorization": f"Bearer {api_token}", "Content-Type": "application/json"}
-    data = {"sql": sql, "params": params}
-
-    try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        return response.json(), None
-    except requests.exceptions.HTTPError as err:
-        print(f"Error en la API de D1: {err.response.text}")
-        return None, (err.response.text, err.response.status_code)
+# Límites para la creación masiva de clientes
+BULK_MAX_CONTACTS = int(os.environ.get('BULK_MAX_CONTACTS', 5000))
+BULK_MAX_WORKERS = int(os.environ.get('BULK_MAX_WORKERS', 8))
+SMARTPASSES_RATE_PER_KEY = float(os.environ.get('SMARTPASSES_RATE_PER_KEY', 10))
 
 # -----------------------------------------------------------------------------
 # FUNCIÓN AUXILIAR PARA OBTENER CREDENCIALES
 # -----------------------------------------------------------------------------
+
+NOT_CONFIGURED_ERROR = {"error": "La aplicación no ha sido configurada. Por favor, guarde sus credenciales."}
+
 def get_agency_credentials(ghl_data):
     """
     Obtiene las credenciales de la agencia desde la base de datos D1
     basándose en el 'locationId' proporcionado por GHL.
     """
+    with metrics.stage('credential_lookup'):
+        return _lookup_agency_credentials(ghl_data)
+
+def _lookup_agency_credentials(ghl_data):
     location_id = ghl_data.get('locationId') or ghl_data.get('location_id')
 
     if not location_id:
         return None, {"error": "No se recibió el Location ID de la sub-cuenta."}, 400
 
-    # Sentencia SQL para seleccionar las credenciales de la sub-cuenta actual
-    sql = "SELECT api_key, program_id FROM sub_account_credentials WHERE location_id = ?;"
-    params = [location_id]
+    local = local_agency_credentials(location_id)
+    if local is not None:
+        return local
 
-    # Ejecuta la consulta para obtener los datos
-    result, error = query_d1(sql, params)
+    # Ejecuta la consulta para obtener los datos. Si ya hay una consulta en curso
+    # para la misma location, se espera su resultado en vez de repetirla.
+    result, error = get_group('d1_credentials').do(location_id, lambda: d1.query(d1.CREDENTIALS_SQL, [location_id]))
+    return credentials_from_d1(location_id, result, error)
 
+def local_agency_credentials(location_id):
+    """
+    Busca las credenciales sin salir del proceso (caché y réplica local).
+    Devuelve la misma tupla que get_agency_credentials, o None si hay que ir a D1.
+    """
+    # Primero se consulta la caché en memoria para evitar el viaje a D1
+    cached = credential_cache.get(location_id)
+    if cached is NOT_CONFIGURED:
+        return None, NOT_CONFIGURED_ERROR, 400
+    if cached is not None:
+        return cached, None, None
+
+    # Después la réplica local de SQLite (si está en modo 'local' y ya cargó)
+    if credential_replica.CREDENTIAL_REPLICA_MODE == 'local' and credential_replica.is_ready():
+        credentials = credential_replica.get(location_id)
+        if credentials is not None:
+            credential_cache.set(location_id, credentials)
+            return credentials, None, None
+
+    return None
+
+def credentials_from_d1(location_id, result, error):
+    """Convierte la respuesta de D1 en la tupla (credenciales, error, status) y la guarda en caché."""
     if error:
-        print(f"🚨 ERROR al leer de D1: {error[0]}")
+        logger.error("🚨 ERROR al leer de D1: %s", error[0])
+        # Si D1 no responde, se sirve la copia local o la caché vencida aunque puedan estar desfasadas
+        credentials = credential_replica.get(location_id) if credential_replica.is_enabled() else None
+        if credentials is None:
+            credentials = credential_cache.get_stale(location_id)
+        if credentials is not None and credentials is not NOT_CONFIGURED:
+            return credentials, None, None
         return None, {"error": "No se pudieron obtener las credenciales desde la base de datos."}, error[1]
 
     # La API de D1 devuelve los resultados en una lista dentro de la clave 'results'
-    if result and result.get('results'):
-        db_row = result['results'][0]
-        credentials = {
-            "smartpasses_api_key": db_row['api_key'],
-            "default_program_id": db_row['program_id']
-        }
+    rows = d1.rows(result)
+    if rows:
+        db_row = rows[0]
+        credentials = d1.credentials_from_row(db_row)
+        credential_cache.set(location_id, credentials)
+        credential_replica.upsert(location_id, db_row['api_key'], db_row['program_id'])
         return credentials, None, None
     else:
         # Esto ocurre si el usuario aún no ha guardado su configuración
-        print(f"🔎 No se encontraron credenciales en D1 para Location ID: {location_id}.")
-        return None, {"error": "La aplicación no ha sido configurada. Por favor, guarde sus credenciales."}, 400
+        logger.info("🔎 No se encontraron credenciales en D1 para Location ID: %s.", location_id)
+        credential_cache.set(location_id, NOT_CONFIGURED)
+        return None, NOT_CONFIGURED_ERROR, 400
 
 # -----------------------------------------------------------------------------
-# RUTAS DE LAS ACCIONES DE GHL
+# FUNCIÓN AUXILIAR PARA CREAR CLIENTES EN SMARTPASSES
 # -----------------------------------------------------------------------------
+def create_smartpasses_customer(smartpasses_api_key, program_id, payload, location_id=None):
+    """
+    Crea un cliente en el programa indicado y devuelve la respuesta de SmartPasses.
+    La llamada ocupa un hueco del reparto justo a nombre de la sub-cuenta.
+    Lanza requests.exceptions.HTTPError si la API responde con error.
+    """
+    create_url = f"{SMARTPASSES_API_BASE_URL}/programs/{program_id}/customers"
+    headers = {"Authorization": smartpasses_api_key, "Content-Type": "application/json"}
 
-@customer_actions_bp.route('/actions/create_customer', methods=['POST'])
-def handle_create_customer():
-    ghl_data = request.json
-    print(f"📥 Datos recibidos de GHL (create_customer): {json.dumps(ghl_data, indent=2)}")
+    with slot(location_id):
+        response = http_client.post(create_url, json=payload, headers=headers)
+    response.raise_for_status()
+    return response.json()
 
-    agency_credentials, error_response, status_code = get_agency_credentials(ghl_data)
-    if error_response:
-        return jsonify(error_response), status_code
+def update_smartpasses_customer(smartpasses_api_key, program_id, customer_id, payload, location_id=None):
+    """
+    Actualiza los datos de un cliente y devuelve la respuesta de SmartPasses.
+    Lanza requests.exceptions.HTTPError si la API responde con error.
+    """
+    update_url = f"{SMARTPASSES_API_BASE_URL}/programs/{program_id}/customers/{customer_id}"
+    headers = {"Authorization": smartpasses_api_key, "Content-Type": "application/json"}
+
+    with slot(location_id):
+        response = http_client.put(update_url, json=payload, headers=headers)
+    response.raise_for_status()
+    return response.json()
 
+def ghl_contact_id(data):
+    """contactId de GHL en los inputs de la acción o en el cuerpo, si viene."""
+    inputs = data.get('inputs') or {}
+    return inputs.get('contact_id') or data.get('contactId') or data.get('contact_id') or \
+        (data.get('contact') or {}).get('id')
+
+def index_customer(location_id, program_id, customer, contact_id=None, email=None):
+    """Registra el cliente creado en el índice local. Un fallo aquí no afecta a la respuesta."""
+    if not isinstance(customer, dict):
+        return
+    try:
+        customer_index.record(location_id, program_id, customer.get('id'), contact_id, email or customer.get('email'))
+    except Exception as e:
+        logger.warning("No se pudo indexar el cliente %s de %s: %s", customer.get('id'), location_id, e)
+
+def prepare_customer_payload(ghl_data, agency_credentials):
+    """Extrae de los inputs de GHL la API key, el programa y el cuerpo para crear el cliente."""
     inputs = ghl_data.get('inputs', {})
     smartpasses_api_key = agency_credentials.get('smartpasses_api_key')
     program_id = inputs.get('program_id') or agency_credentials.get('default_program_id')
-    email = inputs.get('contact_email')
-
-    if not program_id or not email:
-        return jsonify({"error": "El Program ID y el Email son obligatorios."}), 400
-
-    create_url = f"{SMARTPASSES_API_BASE_URL}/programs/{program_id}/customers"
     payload = {
         "firstName": inputs.get('contact_first_name', ''),
         "lastName": inputs.get('contact_last_name', ''),
-        "email": email,
+        "email": inputs.get('contact_email'),
         "phone": inputs.get('contact_phone', '')
     }
-    headers = {"Authorization": smartpasses_api_key, "Content-Type": "application/json"}
+    return smartpasses_api_key, program_id, payload
+
+# -----------------------------------------------------------------------------
+# RUTAS DE LAS ACCIONES DE GHL
+# -----------------------------------------------------------------------------
+
+@customer_actions_bp.route('/actions/create_customer', methods=['POST'])
+@idempotent('create_customer')
+def handle_create_customer():
+    ghl_data = request.json
+    log_payload(logger, 'create_customer', "📥 Datos recibidos de GHL (create_customer)", ghl_data,
+                location_id=(ghl_data or {}).get('locationId'))
+
+    agency_credentials, error_response, status_code = get_agency_credentials(ghl_data)
+    if error_response:
+        return jsonify(error_response), status_code
+
+    smartpasses_api_key, program_id, payload = prepare_customer_payload(ghl_data, agency_credentials)
+    if not program_id or not payload['email']:
+        return jsonify({"error": "El Program ID y el Email son obligatorios."}), 400
 
     try:
-        response = requests.post(create_url, json=payload, headers=headers)
-        response.raise_for_status()
-        return jsonify(response.json()), 200
+        customer = create_smartpasses_customer(smartpasses_api_key, program_id, payload, ghl_data.get('locationId'))
+        index_customer(ghl_data.get('locationId'), program_id, customer, ghl_contact_id(ghl_data), payload['email'])
+        return jsonify(customer), 200
     except requests.exceptions.HTTPError as err:
         return jsonify({"error": "Fallo en la API de Smart Passes", "details": err.response.text}), err.response.status_code
+    except (CircuitOpenError, SlotTimeout) as err:
+        return service_unavailable(err.retry_after, "Smart Passes no está disponible temporalmente.")
     except Exception as e:
         return jsonify({"error": "Error interno del servidor.", "details": str(e)}), 500
 
-# Aquí puedes agregar el resto de tus acciones (add_points, get_customer, etc.)
+@customer_actions_bp.route('/actions/create_customers_bulk', methods=['POST'])
+def handle_create_customers_bulk():
+    """
+    Crea muchos clientes de una misma sub-cuenta en una sola llamada.
+    Las credenciales se resuelven una vez y las creaciones se reparten en un
+    pool acotado, respetando el límite de peticiones por API key.
+    Con `?stream=1` o `Accept: application/x-ndjson` los resultados se envían
+    línea por línea a medida que terminan.
+    """
+    ghl_data = request.json or {}
+    contacts = ghl_data.get('contacts')
+    logger.info("📥 Datos recibidos de GHL (create_customers_bulk): %s contactos", len(contacts or []))
+
+    if not isinstance(contacts, list) or not contacts:
+        return jsonify({"error": "Se requiere una lista 'contacts' no vacía."}), 400
+    if len(contacts) > BULK_MAX_CONTACTS:
+        return jsonify({"error": f"Máximo {BULK_MAX_CONTACTS} contactos por petición."}), 400
+
+    agency_credentials, error_response, status_code = get_agency_credentials(ghl_data)
+    if error_response:
+        return jsonify(error_response), status_code
+
+    smartpasses_api_key = agency_credentials.get('smartpasses_api_key')
+    program_id = ghl_data.get('program_id') or agency_credentials.get('default_program_id')
+    if not program_id:
+        return jsonify({"error": "El Program ID es obligatorio."}), 400
+
+    stream = request.args.get('stream') in ('1', 'true') or \
+        'application/x-ndjson' in request.headers.get('Accept', '')
+
+    results = _bulk_create_results(smartpasses_api_key, program_id, contacts, ghl_data.get('locationId'))
+
+    if stream:
+        lines = (json.dumps(item) + "\n" for item in results)
+        return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+    items = sorted(results, key=lambda item: item['index'])
+    summary = {status: sum(1 for item in items if item['status'] == status)
+               for status in ('created', 'duplicate', 'failed')}
+    return jsonify({"program_id": program_id, "summary": summary, "results": items}), 200
+
+def plan_bulk_contacts(contacts):
+    """
+    Valida y normaliza los contactos de un lote. Devuelve (resultados inmediatos,
+    pendientes) donde los pendientes son tuplas (índice, payload para SmartPasses).
+    """
+    immediate = []
+    seen_emails = set()
+    pending = []
+
+    for index, contact in enumerate(contacts):
+        contact = contact if isinstance(contact, dict) else {}
+        email = (contact.get('email') or contact.get('contact_email') or '').strip()
+        if not email:
+            immediate.append({"index": index, "email": None, "status": "failed", "error": "El Email es obligatorio."})
+            continue
+        if email.lower() in seen_emails:
+            immediate.append({"index": index, "email": email, "status": "duplicate", "error": "Email repetido en el lote."})
+            continue
+        seen_emails.add(email.lower())
+        payload = {
+            "firstName": contact.get('first_name') or contact.get('contact_first_name', ''),
+            "lastName": contact.get('last_name') or contact.get('contact_last_name', ''),
+            "email": email,
+            "phone": contact.get('phone') or contact.get('contact_phone', '')
+        }
+        pending.append((index, payload))
+
+    return immediate, pending
+
+def _bulk_create_results(smartpasses_api_key, program_id, contacts, location_id=None):
+    """
+    Generador con el resultado de cada contacto (created / duplicate / failed)
+    en el orden en que terminan.
+    """
+    bucket = get_bucket(f"smartpasses:{smartpasses_api_key}", SMARTPASSES_RATE_PER_KEY)
+    immediate, pending = plan_bulk_contacts(contacts)
+    yield from immediate
+
+    def create_one(index, payload):
+        contact = contacts[index]
+        contact_id = contact.get('id') or ghl_contact_id(contact)
+        bucket.acquire()
+        result = {"index": index, "email": payload['email']}
+        try:
+            result["customer"] = create_smartpasses_customer(smartpasses_api_key, program_id, payload, location_id)
+            result["status"] = "created"
+            index_customer(location_id, program_id, result["customer"], contact_id, payload['email'])
+        except requests.exceptions.HTTPError as err:
+            # SmartPasses responde 409 cuando el cliente ya existe en el programa
+            result["status"] = "duplicate" if err.response.status_code == 409 else "failed"
+            result["error"] = err.response.text
+        except Exception as e:
+            result["status"] = "failed"
+            result["error"] = str(e)
+        return result
+
+    executor = ThreadPoolExecutor(max_workers=min(BULK_MAX_WORKERS, max(len(pending), 1)))
+    try:
+        futures = [executor.submit(create_one, index, payload) for index, payload in pending]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # Si el cliente corta el stream, no se envían las creaciones que faltan
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# -----------------------------------------------------------------------------
+# PUNTOS Y SELLOS
+# -----------------------------------------------------------------------------
+
+def resolve_customer(ghl_data, location_id):
+    """customerId del contacto: explícito en los inputs o desde el índice local."""
+    inputs = ghl_data.get('inputs') or {}
+    if inputs.get('customer_id'):
+        return {"program_id": inputs.get('program_id'), "customer_id": inputs['customer_id']}
+    return customer_index.lookup(location_id, ghl_contact_id(ghl_data), inputs.get('contact_email'))
+
+def _handle_increment(kind, input_name):
+    """
+    Registra el incremento en el diario y espera a que se aplique junto con los
+    demás del mismo cliente. Responde 200 con el resultado de la llamada combinada,
+    o 202 con el trigger_id si sigue pendiente al vencer POINTS_ACK_TIMEOUT.
+    """
+    ghl_data = request.json or {}
+    location_id = ghl_data.get('locationId')
+    log_payload(logger, f'add_{kind}', f"📥 Datos recibidos de GHL (add_{kind})", ghl_data, location_id=location_id)
+
+    agency_credentials, error_response, status_code = get_agency_credentials(ghl_data)
+    if error_response:
+        return jsonify(error_response), status_code
+
+    inputs = ghl_data.get('inputs') or {}
+    try:
+        amount = int(inputs.get(input_name) or 1)
+    except (TypeError, ValueError):
+        return jsonify({"error": f"El valor de '{input_name}' debe ser un número entero."}), 400
+    if amount <= 0:
+        return jsonify({"error": f"El valor de '{input_name}' debe ser mayor que cero."}), 400
+
+    customer = resolve_customer(ghl_data, location_id)
+    if customer is None:
+        return jsonify({"error": "El contacto no tiene un cliente de Smart Passes asociado. Créelo primero."}), 404
+    program_id = customer['program_id'] or inputs.get('program_id') or agency_credentials.get('default_program_id')
+
+    trigger_id = points_accumulator.submit(location_id, program_id, customer['customer_id'], kind, amount)
+    trigger = points_accumulator.wait(trigger_id)
+    body = {"trigger_id": trigger_id, "status": trigger['status'], "amount": amount,
+            "status_url": f"{request.path}/{trigger_id}"}
+    if trigger['status'] == 'applied':
+        body.update(trigger['result'])
+        return jsonify(body), 200
+    if trigger['status'] == 'failed':
+        body["error"] = trigger['last_error']
+        return jsonify(body), 502
+    return jsonify(body), 202
+
+@customer_actions_bp.route('/actions/add_points', methods=['POST'])
+@idempotent('add_points', body_fallback=False)
+def handle_add_points():
+    return _handle_increment('points', 'points')
+
+@customer_actions_bp.route('/actions/add_stamp', methods=['POST'])
+@idempotent('add_stamp', body_fallback=False)
+def handle_add_stamp():
+    return _handle_increment('stamps', 'stamps')
+
+@customer_actions_bp.route('/actions/add_points/<trigger_id>', methods=['GET'])
+@customer_actions_bp.route('/actions/add_stamp/<trigger_id>', methods=['GET'])
+def get_increment_status(trigger_id):
+    """Estado de un trigger de puntos o sellos y el resultado de su llamada combinada."""
+    trigger = points_accumulator.get_trigger(trigger_id)
+    if trigger is None:
+        return jsonify({"error": "Trigger no encontrado."}), 404
+    return jsonify(trigger), 200
+
+def send_increment(smartpasses_api_key, program_id, customer_id, kind, amount, batch_id, location_id=None):
+    """
+    Suma `amount` puntos o sellos al cliente en una sola llamada. Los errores
+    transitorios se convierten en push_dispatcher.RetryLater para reintentar el lote.
+    """
+    url = f"{SMARTPASSES_API_BASE_URL}/programs/{program_id}/customers/{customer_id}/{kind}"
+    headers = {
+        "Authorization": smartpasses_api_key,
+        "Content-Type": "application/json",
+        "Idempotency-Key": batch_id,
+    }
+    try:
+        with slot(location_id):
+            response = http_client.post(url, json={kind: amount}, headers=headers)
+        response.raise_for_status()
+    except requests.exceptions.ReadTimeout as err:
+        # La suma pudo aplicarse: se reintenta con la misma Idempotency-Key, nunca se da por fallida
+        raise push_dispatcher.RetryLater(str(err)) from err
+    except requests.exceptions.RequestException as err:
+        push_dispatcher.raise_for_upstream(err)
+    return response.json()
+
+# Aquí puedes agregar el resto de tus acciones (get_customer, update_customer, etc.)
 # Todas seguirán el mismo patrón:
 # 1. Obtener ghl_data
 # 2. Llamar a get_agency_credentials(ghl_data)
-# 3. Usar las credenciales para hacer la llamada a la API de SmartPasses
\ No newline at end of file
+# 3. Obtener el customerId con customer_index.lookup(locationId, contactId, email)
+# 4. Usar las credenciales para hacer la llamada a la API de SmartPasses
\ No newline at end of file
@@ -1,42 +1,232 @@
-
 # actions/offer.py
 # Maneja las acciones relacionadas con ofertas en Smart Passes.
+#
+# El listado se sirve desde una caché por programa: durante OFFER_CACHE_FRESH
+# segundos se responde sin llamar a SmartPasses y después se revalida con un GET
+# condicional (If-None-Match), de modo que un catálogo sin cambios cuesta un 304.
+# Los dropdowns de GHL reciben páginas con cursor y su propio ETag.
+
+import base64
+import hashlib
+import logging
+import os
+import time
 
+import requests
 from flask import Blueprint, request, jsonify
 
+import http_client
+from actions.customer import get_agency_credentials
+from credential_cache import TTLCache
+from fair_scheduler import slot
+
 offer_actions_bp = Blueprint('offer_actions', __name__, url_prefix='/offer')
+logger = logging.getLogger(__name__)
+
+SMARTPASSES_API_BASE_URL = os.environ.get('SMARTPASSES_API_BASE_URL', "https://pass.smartpasses.io/api/v1/loyalty")
+
+# Segundos en que el listado se sirve sin revalidar, y vida máxima de la entrada (ETag incluido)
+OFFER_CACHE_FRESH = float(os.environ.get('OFFER_CACHE_FRESH', 30))
+OFFER_CACHE_MAX_AGE = float(os.environ.get('OFFER_CACHE_MAX_AGE', 3600))
+OFFER_CACHE_MAX_SIZE = int(os.environ.get('OFFER_CACHE_MAX_SIZE', 512))
+OFFER_PAGE_SIZE = int(os.environ.get('OFFER_PAGE_SIZE', 50))
+OFFER_MAX_PAGE_SIZE = 200
+
+# Campos de los inputs de GHL que no forman parte de la oferta
+CONTROL_FIELDS = ('program_id', 'offer_id')
+
+# Clave: (program_id, api_key); valor: {"etag", "offers", "version", "checked_at"}
+offer_cache = TTLCache(max_size=OFFER_CACHE_MAX_SIZE, ttl=OFFER_CACHE_MAX_AGE)
+
+
+def _offers_url(program_id, offer_id=None):
+    url = f"{SMARTPASSES_API_BASE_URL}/programs/{program_id}/offers"
+    return f"{url}/{offer_id}" if offer_id else url
+
+
+def _resolve_program(data):
+    """Devuelve (api_key, program_id, error_response, status_code) para la sub-cuenta."""
+    agency_credentials, error_response, status_code = get_agency_credentials(data)
+    if error_response:
+        return None, None, error_response, status_code
+    inputs = data.get('inputs') or {}
+    program_id = data.get('program_id') or inputs.get('program_id') or agency_credentials.get('default_program_id')
+    if not program_id:
+        return None, None, {"status": "error", "message": "El Program ID es obligatorio."}, 400
+    return agency_credentials.get('smartpasses_api_key'), program_id, None, None
+
+
+def invalidate_offers(program_id, smartpasses_api_key):
+    """Descarta el listado en caché del programa (tras crear o actualizar una oferta)."""
+    offer_cache.invalidate((program_id, smartpasses_api_key))
+
+
+def get_offers(smartpasses_api_key, program_id):
+    """
+    Catálogo de ofertas del programa, desde la caché o revalidado contra SmartPasses.
+    Devuelve (offers, version). Lanza requests.exceptions.HTTPError si la API falla.
+    """
+    key = (program_id, smartpasses_api_key)
+    entry = offer_cache.get(key)
+    if entry is not None and time.monotonic() - entry['checked_at'] < OFFER_CACHE_FRESH:
+        return entry['offers'], entry['version']
+
+    headers = {"Authorization": smartpasses_api_key}
+    if entry is not None and entry['etag']:
+        headers["If-None-Match"] = entry['etag']
+
+    # Los renders simultáneos del mismo dropdown comparten una sola llamada
+    response = http_client.coalesced_get(_offers_url(program_id), headers=headers)
+    if response.status_code == 304 and entry is not None:
+        entry = dict(entry, checked_at=time.monotonic())
+        offer_cache.set(key, entry)
+        return entry['offers'], entry['version']
+    response.raise_for_status()
+
+    body = response.json()
+    offers = body.get('data', []) if isinstance(body, dict) else body
+    offers = sorted(offers, key=lambda offer: str(offer.get('id', '')))
+    version = hashlib.sha1(response.content).hexdigest()
+    offer_cache.set(key, {
+        "etag": response.headers.get('ETag'),
+        "offers": offers,
+        "version": version,
+        "checked_at": time.monotonic(),
+    })
+    return offers, version
+
+
+def _encode_cursor(offer_id):
+    return base64.urlsafe_b64encode(str(offer_id).encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+
+
+def paginate(offers, cursor, limit):
+    """
+    Página de ofertas posteriores al cursor (el id de la última oferta entregada).
+    Al ser por id y no por posición, una oferta nueva no duplica ni salta elementos.
+    """
+    if cursor:
+        after = _decode_cursor(cursor)
+        offers = [offer for offer in offers if str(offer.get('id', '')) > after]
+    page = offers[:limit]
+    next_cursor = _encode_cursor(page[-1].get('id', '')) if len(offers) > limit else None
+    return page, next_cursor
+
+
+def _upstream_error(err):
+    response = err.response
+    if response is None:
+        return jsonify({"status": "error", "message": "No se pudo contactar a Smart Passes.", "details": str(err)}), 502
+    return jsonify({"status": "error", "message": "Fallo en la API de Smart Passes", "details": response.text}), response.status_code
+
+
+def _write_offer(action, send, url, payload, headers, location_id):
+    """
+    Crea o actualiza una oferta en SmartPasses. Devuelve (oferta, None) o
+    (None, respuesta de error para GHL). Un 2xx sin cuerpo devuelve (None, None).
+    """
+    try:
+        with slot(location_id):
+            response = send(url, json=payload, headers=headers)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as err:
+        logger.warning("Error %s oferta: %s", action, err)
+        return None, _upstream_error(err)
+
+    if not response.content:
+        return None, None
+    try:
+        return response.json(), None
+    except ValueError:
+        logger.warning("Respuesta no JSON de Smart Passes %s oferta: %s", action, response.text[:200])
+        return None, (jsonify({"status": "error", "message": "Smart Passes devolvió una respuesta no válida.",
+                               "details": response.text[:500]}), 502)
+
 
 @offer_actions_bp.route('/create', methods=['POST'])
 def create_offer():
     """Crear una nueva oferta en Smart Passes."""
+    data = request.json or {}
+    logger.info("Crear oferta para Location ID: %s", data.get('locationId'))
+
+    smartpasses_api_key, program_id, error_response, status_code = _resolve_program(data)
+    if error_response:
+        return jsonify(error_response), status_code
+
+    inputs = data.get('inputs') or {}
+    payload = {k: v for k, v in inputs.items() if k not in CONTROL_FIELDS}
+    headers = {"Authorization": smartpasses_api_key, "Content-Type": "application/json"}
     try:
-        data = request.json
-        # Aquí iría la lógica para crear la oferta
-        print(f"Crear oferta: {data}")
-        return jsonify({"status": "success", "message": "Oferta creada correctamente"}), 200
-    except Exception as e:
-        print(f"Error creando oferta: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+        offer, error = _write_offer('creando', http_client.post, _offers_url(program_id), payload, headers,
+                                    data.get('locationId'))
+    finally:
+        invalidate_offers(program_id, smartpasses_api_key)
+    if error:
+        return error
+
+    return jsonify({"status": "success", "message": "Oferta creada correctamente", "offer": offer}), 200
+
 
 @offer_actions_bp.route('/update', methods=['POST'])
 def update_offer():
     """Actualizar una oferta existente."""
+    data = request.json or {}
+    inputs = data.get('inputs') or {}
+    offer_id = data.get('offer_id') or inputs.get('offer_id')
+    logger.info("Actualizar oferta %s para Location ID: %s", offer_id, data.get('locationId'))
+
+    if not offer_id:
+        return jsonify({"status": "error", "message": "El Offer ID es obligatorio."}), 400
+
+    smartpasses_api_key, program_id, error_response, status_code = _resolve_program(data)
+    if error_response:
+        return jsonify(error_response), status_code
+
+    payload = {k: v for k, v in inputs.items() if k not in CONTROL_FIELDS}
+    headers = {"Authorization": smartpasses_api_key, "Content-Type": "application/json"}
     try:
-        data = request.json
-        # Aquí iría la lógica para actualizar la oferta
-        print(f"Actualizar oferta: {data}")
-        return jsonify({"status": "success", "message": "Oferta actualizada correctamente"}), 200
-    except Exception as e:
-        print(f"Error actualizando oferta: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+        offer, error = _write_offer('actualizando', http_client.put, _offers_url(program_id, offer_id), payload,
+                                    headers, data.get('locationId'))
+    finally:
+        invalidate_offers(program_id, smartpasses_api_key)
+    if error:
+        return error
+
+    return jsonify({"status": "success", "message": "Oferta actualizada correctamente", "offer": offer}), 200
+
 
 @offer_actions_bp.route('/list', methods=['GET'])
 def list_offers():
-    """Listar ofertas disponibles."""
+    """
+    Listar ofertas disponibles, paginadas con ?cursor=...&limit=...
+    Responde 304 si el cliente ya tiene la página (If-None-Match).
+    """
+    data = {"locationId": request.args.get('locationId') or request.args.get('location_id'),
+            "program_id": request.args.get('program_id')}
+    smartpasses_api_key, program_id, error_response, status_code = _resolve_program(data)
+    if error_response:
+        return jsonify(error_response), status_code
+
     try:
-        # Aquí iría la lógica para obtener las ofertas
-        offers = []  # Placeholder
-        return jsonify({"status": "success", "offers": offers}), 200
-    except Exception as e:
-        print(f"Error listando ofertas: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+        limit = min(max(int(request.args.get('limit', OFFER_PAGE_SIZE)), 1), OFFER_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"status": "error", "message": "El parámetro limit debe ser numérico."}), 400
+    cursor = request.args.get('cursor')
+
+    try:
+        offers, version = get_offers(smartpasses_api_key, program_id)
+        page, next_cursor = paginate(offers, cursor, limit)
+    except requests.exceptions.RequestException as err:
+        logger.warning("Error listando ofertas: %s", err)
+        return _upstream_error(err)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Cursor inválido."}), 400
+
+    response = jsonify({"status": "success", "offers": page, "next_cursor": next_cursor})
+    response.set_etag(hashlib.sha1(f"{version}:{cursor}:{limit}".encode('utf-8')).hexdigest())
+    response.headers['Cache-Control'] = f"private, max-age={int(OFFER_CACHE_FRESH)}"
+    return response.make_conditional(request)
@@ -1,35 +1,99 @@
 # actions/program.py
 # Contiene la lógica para acciones de GHL relacionadas con programas completos.
 
+import logging
 from flask import Blueprint, request, jsonify
 import requests
 import os
-import json
+import http_client
+import push_dispatcher
+from fair_scheduler import slot
+from idempotency import idempotent
+from actions.customer import get_agency_credentials
+from structured_log import log_payload
 
 program_actions_bp = Blueprint('program_actions', __name__)
+logger = logging.getLogger(__name__)
 
-SMARTPASSES_API_BASE_URL = "https://pass.smartpasses.io/api/v1/loyalty"
+SMARTPASSES_API_BASE_URL = os.environ.get('SMARTPASSES_API_BASE_URL', "https://pass.smartpasses.io/api/v1/loyalty")
 
 @program_actions_bp.route('/actions/send_push', methods=['POST'])
+@idempotent('send_push')
 def handle_send_push():
     """
     Esta función se activa cuando un workflow de GHL ejecuta la acción "Send Push Notification".
+    La notificación se encola y se envía en segundo plano; se devuelve el id del trabajo
+    para consultar su progreso en /actions/send_push/<job_id>.
     """
     ghl_data = request.json
-    print(f"📥 Datos recibidos de GHL (send_push): {json.dumps(ghl_data, indent=2)}")
+    log_payload(logger, 'send_push', "📥 Datos recibidos de GHL (send_push)", ghl_data,
+                location_id=(ghl_data or {}).get('locationId'))
 
-    smartpasses_api_key = os.environ.get('SMARTPASSES_API_KEY')
-    if not smartpasses_api_key:
-        print("❌ ERROR: La SMARTPASSES_API_KEY no está configurada.")
-        return jsonify({"error": "Configuración del servidor incompleta."}), 500
+    inputs = ghl_data.get('inputs', {})
+    location_id = ghl_data.get('locationId') or ghl_data.get('location_id')
 
-    program_id = ghl_data.get('program_id')
-    message = ghl_data.get('message')
+    # Cada sub-cuenta usa sus propias credenciales; sin locationId se usa la clave global
+    if location_id:
+        agency_credentials, error_response, status_code = get_agency_credentials(ghl_data)
+        if error_response:
+            return jsonify(error_response), status_code
+        default_program_id = agency_credentials.get('default_program_id')
+    else:
+        if not os.environ.get('SMARTPASSES_API_KEY'):
+            logger.error("❌ ERROR: La SMARTPASSES_API_KEY no está configurada.")
+            return jsonify({"error": "Configuración del servidor incompleta."}), 500
+        default_program_id = None
+
+    program_id = ghl_data.get('program_id') or inputs.get('program_id') or default_program_id
+    message = ghl_data.get('message') or inputs.get('message')
 
     if not all([program_id, message]):
         return jsonify({"error": "Program ID y Message son obligatorios."}), 400
 
-    # Preparar la petición POST para la API de Smart Passes
+    job_id, deduplicated = push_dispatcher.submit(location_id, program_id, message)
+    if deduplicated:
+        logger.info("♻️ Push duplicado dentro de la ventana, se reutiliza el trabajo %s.", job_id)
+    else:
+        logger.info("🚀 Notificación push encolada (%s).", job_id)
+
+    return jsonify({
+        "status": "queued",
+        "job_id": job_id,
+        "deduplicated": deduplicated,
+        "status_url": f"/actions/send_push/{job_id}"
+    }), 202
+
+@program_actions_bp.route('/actions/send_push/<job_id>', methods=['GET'])
+def get_send_push_status(job_id):
+    """Devuelve el progreso de entrega de una notificación encolada."""
+    job = push_dispatcher.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Trabajo no encontrado."}), 404
+    return jsonify(job), 200
+
+def resolve_push_api_key(location_id):
+    """
+    Resuelve la API key de SmartPasses para un trabajo de push (o de puntos).
+    Devuelve (api_key, error) si falta la configuración; si D1 no respondió
+    (5xx, 429, cortacircuitos abierto) lanza push_dispatcher.RetryLater.
+    """
+    if not location_id:
+        api_key = os.environ.get('SMARTPASSES_API_KEY')
+        return (api_key, None) if api_key else (None, "La SMARTPASSES_API_KEY no está configurada.")
+
+    agency_credentials, error_response, status_code = get_agency_credentials({'locationId': location_id})
+    if error_response:
+        if not status_code or status_code >= 500 or status_code == 429:
+            raise push_dispatcher.RetryLater(error_response['error'])
+        return None, error_response['error']
+    return agency_credentials.get('smartpasses_api_key'), None
+
+def send_broadcast(smartpasses_api_key, program_id, message, location_id=None):
+    """
+    Envía el broadcast a SmartPasses. Los errores transitorios (incluido no
+    conseguir hueco en el reparto justo) se convierten en
+    push_dispatcher.RetryLater para que el trabajo se reintente.
+    """
     broadcast_url = f"{SMARTPASSES_API_BASE_URL}/programs/{program_id}/broadcast"
 
     payload = {
@@ -42,21 +106,8 @@ def handle_send_push():
     }
 
     try:
-        print(f"🚀 Enviando notificación push a SmartPasses...")
-        response = requests.post(broadcast_url, json=payload, headers=headers)
+        with slot(location_id):
+            response = http_client.post(broadcast_url, json=payload, headers=headers)
         response.raise_for_status()
-
-        # Una petición de broadcast exitosa puede no devolver contenido, así que enviamos nuestro propio mensaje de éxito.
-        print(f"✅ Notificación enviada exitosamente.")
-        return jsonify({"status": "success", "message": "Push notification sent successfully"}), 200
-
-    except requests.exceptions.HTTPError as err:
-        error_details = err.response.text
-        print(f"❌ Error HTTP de SmartPasses: {error_details}")
-        return jsonify({
-            "error": "Fallo en la comunicación con la API de Smart Passes", 
-            "details": error_details
-        }), err.response.status_code
-    except Exception as e:
-        print(f"💥 Error inesperado en send_push: {str(e)}")
-        return jsonify({"error": "Ocurrió un error interno en el servidor."}), 500
+    except requests.exceptions.RequestException as err:
+        push_dispatcher.raise_for_upstream(err)
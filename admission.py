@@ -0,0 +1,124 @@
+# admission.py
+# Control de admisión: rechaza trabajo con 503 + Retry-After antes de que los
+# workers se saturen, en lugar de dejar que las peticiones se acumulen.
+#
+# Se rechaza una petición cuando:
+#   - el proceso ya tiene ADMISSION_MAX_IN_FLIGHT peticiones en curso, o
+#   - lleva más de ADMISSION_MAX_QUEUE_MS esperando (cabecera X-Request-Start que
+#     añade Nginx, ver README; en modo ASGI la pone asgi.py al recibirla, así
+#     cuenta también la espera por un hilo libre).
+#
+# Las peticiones en curso nunca superan los hilos que las atienden (--threads de
+# gunicorn o ASGI_WSGI_THREADS), y sin proxy que añada X-Request-Start la espera
+# delante de los hilos no se puede medir. Por eso el límite por defecto es un hilo
+# menos que los disponibles: con los demás ocupados, el último solo responde 503
+# de inmediato y la cola se vacía rápido en lugar de crecer.
+# Las rutas nativas de asgi.py no ocupan hilos: se cuentan aparte, con
+# ADMISSION_MAX_ASYNC_IN_FLIGHT (por defecto, ASYNC_HTTP_MAX_CONNECTIONS).
+# /health, /metrics y los endpoints de perfilado nunca se rechazan para poder diagnosticar la sobrecarga.
+
+import os
+import threading
+import time
+
+from flask import g, jsonify, request
+
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', 'true').lower() == 'true'
+_WORKER_THREADS = int(
+    os.environ.get('ASGI_WSGI_THREADS', 16) if os.environ.get('SERVER_MODE') == 'asgi'
+    else os.environ.get('GUNICORN_THREADS', 4)
+)
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT') or max(1, _WORKER_THREADS - 1))
+ADMISSION_MAX_ASYNC_IN_FLIGHT = int(
+    os.environ.get('ADMISSION_MAX_ASYNC_IN_FLIGHT') or os.environ.get('ASYNC_HTTP_MAX_CONNECTIONS', 500))
+ADMISSION_MAX_QUEUE_MS = float(os.environ.get('ADMISSION_MAX_QUEUE_MS', 5000))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 5))
+
+EXEMPT_PATHS = frozenset(('/', '/health', '/metrics', '/admin/profile', '/admin/slow_requests'))
+
+_lock = threading.Lock()
+_in_flight = {"threads": 0, "async": 0}
+_limits = {"threads": ADMISSION_MAX_IN_FLIGHT, "async": ADMISSION_MAX_ASYNC_IN_FLIGHT}
+_shed = {"in_flight": 0, "queue_time": 0}
+
+
+def service_unavailable(retry_after, message):
+    """Respuesta 503 con Retry-After (en segundos enteros, mínimo 1)."""
+    response = jsonify({"error": message})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(max(1, int(round(retry_after))))
+    return response
+
+
+def queue_ms(header):
+    """Milisegundos desde que el proxy recibió la petición según X-Request-Start, o None."""
+    if not header:
+        return None
+    try:
+        started = float(header.strip().removeprefix('t='))
+    except ValueError:
+        return None
+    # Nginx envía segundos con milisegundos ($msec); otros proxies, milisegundos o microsegundos
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    return max(0.0, (time.time() - started) * 1000)
+
+
+def enter(waited_ms, pool='threads'):
+    """
+    Admite una petición en `pool` ('threads' o 'async'). Devuelve False si hay que
+    rechazarla; si devuelve True, quien llama debe llamar a leave() al terminar.
+    """
+    if ADMISSION_MAX_QUEUE_MS and waited_ms is not None and waited_ms > ADMISSION_MAX_QUEUE_MS:
+        with _lock:
+            _shed["queue_time"] += 1
+        return False
+
+    with _lock:
+        limit = _limits[pool]
+        if limit and _in_flight[pool] >= limit:
+            _shed["in_flight"] += 1
+            return False
+        _in_flight[pool] += 1
+    return True
+
+
+def leave(pool='threads'):
+    with _lock:
+        _in_flight[pool] -= 1
+
+
+def _admit():
+    if request.path in EXEMPT_PATHS:
+        return None
+    if not enter(queue_ms(request.headers.get('X-Request-Start'))):
+        return service_unavailable(ADMISSION_RETRY_AFTER, "Servidor saturado, intente más tarde.")
+    g.admitted = True
+    return None
+
+
+def _release(exc=None):
+    if g.pop('admitted', False):
+        leave()
+
+
+def init_app(app):
+    """Registra los hooks de admisión en la app."""
+    if not ADMISSION_ENABLED:
+        return
+    app.before_request(_admit)
+    app.teardown_request(_release)
+
+
+def stats():
+    with _lock:
+        return {
+            "in_flight": _in_flight["threads"],
+            "max_in_flight": ADMISSION_MAX_IN_FLIGHT,
+            "async_in_flight": _in_flight["async"],
+            "max_async_in_flight": ADMISSION_MAX_ASYNC_IN_FLIGHT,
+            "shed_in_flight": _shed["in_flight"],
+            "shed_queue_time": _shed["queue_time"],
+        }
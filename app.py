@@ -1,13 +1,35 @@
 import os
-from flask import Flask
+from flask import Flask, Response, request
 from config import config
 
 # Importar los blueprints
 from auth_handler import auth_bp
 from actions.customer import customer_actions_bp
 from actions.program import program_actions_bp
+from actions.offer import offer_actions_bp, offer_cache
 from webhook_handler import webhook_bp
 from settings_handler import settings_bp # <-- LÍNEA AÑADIDA
+from webhook_handler import dispatch_webhook_event
+from actions.program import resolve_push_api_key, send_broadcast
+from actions.customer import send_increment
+from credential_cache import credential_cache, invalidate_locations
+import credential_replica
+import d1
+import token_store
+import single_flight
+import push_dispatcher
+import points_accumulator
+import reconcile
+import webhook_queue
+import metrics
+import admission
+import location_limits
+import fair_scheduler
+import circuit_breaker
+import structured_log
+import warmup
+import profiler
+import traffic_capture
 
 def create_app(config_name=None):
     """Factory function para crear la aplicación Flask"""
@@ -16,22 +38,107 @@ def create_app(config_name=None):
         config_name = os.environ.get('FLASK_ENV', 'production')
 
     app = Flask(__name__)
+    app.json = metrics.TimedJSONProvider(app)
     app.config.from_object(config[config_name])
 
     # Inicializar configuración específica del entorno
     config[config_name].init_app(app)
 
+    # Logs JSON asíncronos (ProductionConfig ya los configuró con archivo)
+    structured_log.configure()
+
     # Registrar blueprints
     app.register_blueprint(auth_bp)
     app.register_blueprint(customer_actions_bp)
     app.register_blueprint(program_actions_bp)
+    app.register_blueprint(offer_actions_bp)
     app.register_blueprint(webhook_bp)
     app.register_blueprint(settings_bp) # <-- LÍNEA AÑADIDA
 
+    # Consumidores en segundo plano de la cola de webhooks
+    webhook_queue.start_workers(dispatch_webhook_event)
+
+    # Carga y sincronización de la réplica local de credenciales
+    credential_replica.start_sync(on_change=invalidate_locations)
+
+    # Renovación proactiva de los tokens OAuth de GHL
+    token_store.start_refresher()
+
+    # Despacho en segundo plano de las notificaciones push
+    push_dispatcher.start_workers(resolve_push_api_key, send_broadcast)
+
+    # Envío combinado de puntos y sellos desde el diario
+    points_accumulator.start_workers(resolve_push_api_key, send_increment)
+
+    # Reconciliación periódica GHL <-> SmartPasses (solo si RECONCILE_INTERVAL > 0)
+    reconcile.start_scheduler()
+
+    # Conexiones, credenciales y plantillas listas antes de la primera petición
+    if app.config.get('WARMUP_ENABLED'):
+        warmup.warm_up(app)
+
+    # Medición por petición: duración total y tiempo por etapa
+    @app.before_request
+    def start_request_metrics():
+        metrics.start_request()
+
+    @app.after_request
+    def finish_request_metrics(response):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.finish_request(route, request.method, response.status_code)
+        return response
+
+    # Perfilado bajo demanda (/admin/profile) y registro de peticiones lentas (/admin/slow_requests)
+    profiler.init_app(app)
+
+    # Captura opcional de acciones y webhooks para reproducirlos con bench/replay.py
+    traffic_capture.init_app(app)
+
+    # Límite de entrada por sub-cuenta (429) y rechazo temprano (503 + Retry-After)
+    # antes de saturar los workers
+    location_limits.init_app(app)
+    admission.init_app(app)
+
+    # Un upstream con el circuito abierto responde 503 en vez de 500
+    @app.errorhandler(circuit_breaker.CircuitOpenError)
+    def upstream_unavailable(err):
+        return admission.service_unavailable(err.retry_after, "Servicio externo no disponible temporalmente.")
+
+    @app.errorhandler(fair_scheduler.SlotTimeout)
+    def smartpasses_saturated(err):
+        return admission.service_unavailable(err.retry_after, "Smart Passes está saturado, intente más tarde.")
+
+    # Endpoint de métricas en formato Prometheus
+    @app.route('/metrics')
+    def metrics_endpoint():
+        token = os.environ.get('METRICS_TOKEN')
+        if token and request.headers.get('Authorization') != f"Bearer {token}":
+            return {"error": "No autorizado."}, 401
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
     # Endpoint de salud para el servidor
     @app.route('/health')
     def health_check():
-        return {"status": "healthy", "service": "SmartPasses GHL Bridge"}, 200
+        health = {"status": "healthy", "service": "SmartPasses GHL Bridge"}
+        # Con un circuito abierto el servidor sigue atendiendo, pero degradado
+        health["circuit_breakers"] = circuit_breaker.stats()
+        if circuit_breaker.any_open():
+            health["status"] = "degraded"
+        health["admission"] = admission.stats()
+        health["smartpasses_scheduler"] = fair_scheduler.stats()
+        if webhook_queue.WEBHOOK_QUEUE_ENABLED:
+            health["webhook_queue"] = webhook_queue.stats()
+        if credential_replica.is_enabled():
+            health["credential_replica"] = credential_replica.stats()
+        health["single_flight"] = single_flight.stats()
+        health["push_jobs"] = push_dispatcher.stats()
+        health["points_journal"] = points_accumulator.stats()
+        health["profiler"] = profiler.stats()
+        if traffic_capture.TRAFFIC_CAPTURE_FILE:
+            health["traffic_capture"] = traffic_capture.stats()
+        if warmup.last_report:
+            health["warmup"] = warmup.last_report
+        return health, 200
 
     # Endpoint de bienvenida
     @app.route('/')
@@ -40,6 +147,39 @@ def create_app(config_name=None):
 
     return app
 
+@metrics.register_collector
+def _collect_gauges():
+    """Estado instantáneo de cachés y colas para /metrics."""
+    samples = []
+    for name, value in credential_cache.stats().items():
+        samples.append((f"bridge_credential_cache_{name}", {}, value))
+    for name, value in offer_cache.stats().items():
+        samples.append((f"bridge_offer_cache_{name}", {}, value))
+    for group, values in single_flight.stats().items():
+        for name, value in values.items():
+            samples.append((f"bridge_single_flight_{name}", {"group": group}, value))
+    if webhook_queue.WEBHOOK_QUEUE_ENABLED:
+        for name, value in webhook_queue.stats().items():
+            samples.append((f"bridge_webhook_queue_{name}", {}, value))
+    for upstream, values in circuit_breaker.stats().items():
+        samples.append(("bridge_circuit_breaker_open", {"upstream": upstream}, int(values["state"] != "closed")))
+        samples.append(("bridge_circuit_breaker_rejected", {"upstream": upstream}, values["rejected"]))
+    for name, value in d1.write_buffer.stats().items():
+        samples.append((f"bridge_d1_write_buffer_{name}", {}, value))
+    for name, value in admission.stats().items():
+        samples.append((f"bridge_admission_{name}", {}, value))
+    for name, value in fair_scheduler.stats().items():
+        samples.append((f"bridge_smartpasses_scheduler_{name}", {}, value))
+    for name, value in structured_log.stats().items():
+        samples.append((f"bridge_log_records_{name}", {}, value))
+    for status, value in push_dispatcher.stats().items():
+        samples.append(("bridge_push_jobs", {"status": status}, value))
+    for status, value in points_accumulator.stats().items():
+        samples.append(("bridge_points_journal", {"status": status}, value))
+    for name, value in profiler.stats().items():
+        samples.append((f"bridge_profiler_{name}", {}, value))
+    return samples
+
 # Para desarrollo local
 if __name__ == '__main__':
     app = create_app('development')
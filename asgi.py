@@ -0,0 +1,416 @@
+# asgi.py
+# Modo de servicio asíncrono (ASGI), alternativo a wsgi.py.
+#
+# Las rutas que pasan casi todo su tiempo esperando a D1, SmartPasses o GHL
+# (create_customer, create_customers_bulk y el callback de OAuth) se atienden
+# aquí con el cliente httpx compartido, así un solo proceso mantiene cientos de
+# llamadas salientes en vuelo. El resto de rutas se delega a la app Flask de
+# create_app() en un pool de hilos, por lo que se comportan igual que en WSGI.
+#
+#   uvicorn asgi:application --host 0.0.0.0 --port 5000
+#   gunicorn -k uvicorn.workers.UvicornWorker --workers 2 asgi:application
+
+import asyncio
+import json
+import logging
+import os
+import time
+from urllib.parse import parse_qs
+
+import httpx
+from a2wsgi import WSGIMiddleware
+
+import admission
+import async_client
+import circuit_breaker
+import d1
+import idempotency
+import location_limits
+import metrics
+import profiler
+import token_store
+import traffic_capture
+from app import create_app
+from auth_handler import OAUTH_ERROR_HTML, OAUTH_SUCCESS_HTML, build_token_request
+from actions.customer import (
+    BULK_MAX_CONTACTS,
+    BULK_MAX_WORKERS,
+    SMARTPASSES_API_BASE_URL,
+    SMARTPASSES_RATE_PER_KEY,
+    credentials_from_d1,
+    ghl_contact_id,
+    index_customer,
+    local_agency_credentials,
+    plan_bulk_contacts,
+    prepare_customer_payload,
+)
+from fair_scheduler import SlotTimeout, async_slot
+from rate_limit import get_bucket
+from structured_log import log_payload
+from token_store import GHL_OAUTH_TOKEN_URL
+
+logger = logging.getLogger(__name__)
+
+# Hilos para las rutas Flask que no tienen versión asíncrona
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 16))
+
+flask_app = create_app(os.environ.get('FLASK_ENV', 'production'))
+wsgi_fallback = WSGIMiddleware(flask_app, workers=ASGI_WSGI_THREADS)
+
+_credential_flight = async_client.AsyncSingleFlight()
+
+
+class SmartPassesError(Exception):
+    def __init__(self, status_code, text):
+        super().__init__(text)
+        self.status_code = status_code
+        self.text = text
+
+
+# -----------------------------------------------------------------------------
+# VERSIONES ASÍNCRONAS DE LAS LLAMADAS A D1, SMARTPASSES Y GHL
+# -----------------------------------------------------------------------------
+async def async_query_d1(sql, params=[]):
+    """Igual que d1.query, pero sin bloquear el event loop."""
+    statements = [(sql, params)]
+    url, headers, data, error = d1.build_request(statements)
+    if error:
+        return None, error
+
+    is_read = d1.is_read_only(statements)
+    try:
+        response = await async_client.post(url, headers=headers, json=data, idempotent=is_read)
+    except circuit_breaker.CircuitOpenError as err:
+        logger.warning("%s", err)
+        return None, (str(err), 503)
+    except httpx.HTTPError as err:
+        logger.error("Error de conexión con la API de D1: %s", err)
+        return None, (str(err), 502)
+    if response.is_error:
+        logger.error("Error en la API de D1: %s", response.text[:500])
+        return None, (response.text, response.status_code)
+    return response.json(), None
+
+
+async def async_get_agency_credentials(ghl_data):
+    """Igual que get_agency_credentials: caché, réplica y por último D1 (unificado por location)."""
+    location_id = ghl_data.get('locationId') or ghl_data.get('location_id')
+    if not location_id:
+        return None, {"error": "No se recibió el Location ID de la sub-cuenta."}, 400
+
+    # La caché compartida y la réplica son SQLite o Redis: se consultan fuera del event loop
+    local = await asyncio.to_thread(local_agency_credentials, location_id)
+    if local is not None:
+        return local
+
+    result, error = await _credential_flight.do(
+        location_id, lambda: async_query_d1(d1.CREDENTIALS_SQL, [location_id]))
+    return await asyncio.to_thread(credentials_from_d1, location_id, result, error)
+
+
+async def async_create_smartpasses_customer(smartpasses_api_key, program_id, payload, location_id=None):
+    create_url = f"{SMARTPASSES_API_BASE_URL}/programs/{program_id}/customers"
+    headers = {"Authorization": smartpasses_api_key, "Content-Type": "application/json"}
+    async with async_slot(location_id):
+        response = await async_client.post(create_url, json=payload, headers=headers)
+    if response.is_error:
+        raise SmartPassesError(response.status_code, response.text)
+    return response.json()
+
+
+async def async_exchange_oauth_code(auth_code):
+    response = await async_client.post(GHL_OAUTH_TOKEN_URL, data=build_token_request(auth_code))
+    response.raise_for_status()
+    return response.json()
+
+
+# -----------------------------------------------------------------------------
+# RUTAS ASÍNCRONAS
+# -----------------------------------------------------------------------------
+async def create_customer(request):
+    ghl_data = request.json()
+    if ghl_data is None:
+        return json_response({"error": "El cuerpo debe ser JSON."}, 400)
+    if not idempotency.IDEMPOTENCY_ENABLED:
+        return await _create_customer(ghl_data)
+
+    # Mismo almacén que la ruta Flask: los reintentos de GHL no tocan D1 ni SmartPasses
+    key = idempotency.fingerprint('create_customer', ghl_data, {'Idempotency-Key': request.headers.get('idempotency-key')})
+    try:
+        cached = await asyncio.to_thread(idempotency.acquire, key)
+    except idempotency.IdempotencyConflict:
+        return json_response({"error": "Una petición idéntica sigue en proceso. Intente de nuevo."}, 409)
+    if cached is not None:
+        return Response(cached['body'], cached['status_code'], cached['mimetype'])
+
+    try:
+        response = await _create_customer(ghl_data)
+    except BaseException:
+        await asyncio.to_thread(idempotency.release, key)
+        raise
+    if idempotency.is_final(response.status):
+        await asyncio.to_thread(idempotency.complete, key, response.status, response.content_type, response.body)
+    else:
+        await asyncio.to_thread(idempotency.release, key)
+    return response
+
+
+async def _create_customer(ghl_data):
+    log_payload(logger, 'create_customer', "📥 Datos recibidos de GHL (create_customer)", ghl_data,
+                location_id=ghl_data.get('locationId'))
+    agency_credentials, error_response, status_code = await async_get_agency_credentials(ghl_data)
+    if error_response:
+        return json_response(error_response, status_code)
+
+    smartpasses_api_key, program_id, payload = prepare_customer_payload(ghl_data, agency_credentials)
+    if not program_id or not payload['email']:
+        return json_response({"error": "El Program ID y el Email son obligatorios."}, 400)
+
+    try:
+        customer = await async_create_smartpasses_customer(
+            smartpasses_api_key, program_id, payload, ghl_data.get('locationId'))
+        await asyncio.to_thread(index_customer, ghl_data.get('locationId'), program_id, customer,
+                                ghl_contact_id(ghl_data), payload['email'])
+        return json_response(customer, 200)
+    except SmartPassesError as err:
+        return json_response({"error": "Fallo en la API de Smart Passes", "details": err.text}, err.status_code)
+    except (circuit_breaker.CircuitOpenError, SlotTimeout) as err:
+        return json_response({"error": "Smart Passes no está disponible temporalmente."}, 503,
+                             {"Retry-After": str(max(1, int(round(err.retry_after))))})
+    except Exception as e:
+        return json_response({"error": "Error interno del servidor.", "details": str(e)}, 500)
+
+
+async def create_customers_bulk(request):
+    ghl_data = request.json() or {}
+    contacts = ghl_data.get('contacts')
+    if not isinstance(contacts, list) or not contacts:
+        return json_response({"error": "Se requiere una lista 'contacts' no vacía."}, 400)
+    if len(contacts) > BULK_MAX_CONTACTS:
+        return json_response({"error": f"Máximo {BULK_MAX_CONTACTS} contactos por petición."}, 400)
+
+    agency_credentials, error_response, status_code = await async_get_agency_credentials(ghl_data)
+    if error_response:
+        return json_response(error_response, status_code)
+
+    smartpasses_api_key = agency_credentials.get('smartpasses_api_key')
+    program_id = ghl_data.get('program_id') or agency_credentials.get('default_program_id')
+    if not program_id:
+        return json_response({"error": "El Program ID es obligatorio."}, 400)
+
+    bucket = get_bucket(f"smartpasses:{smartpasses_api_key}", SMARTPASSES_RATE_PER_KEY)
+    semaphore = asyncio.Semaphore(BULK_MAX_WORKERS)
+    immediate, pending = plan_bulk_contacts(contacts)
+
+    location_id = ghl_data.get('locationId')
+
+    async def create_one(index, payload):
+        contact = contacts[index]
+        contact_id = contact.get('id') or ghl_contact_id(contact)
+        async with semaphore:
+            while True:
+                wait = bucket.try_acquire()
+                if not wait:
+                    break
+                await asyncio.sleep(wait)
+            result = {"index": index, "email": payload['email']}
+            try:
+                result["customer"] = await async_create_smartpasses_customer(
+                    smartpasses_api_key, program_id, payload, location_id)
+                result["status"] = "created"
+                await asyncio.to_thread(index_customer, location_id, program_id, result["customer"],
+                                        contact_id, payload['email'])
+            except SmartPassesError as err:
+                result["status"] = "duplicate" if err.status_code == 409 else "failed"
+                result["error"] = err.text
+            except Exception as e:
+                result["status"] = "failed"
+                result["error"] = str(e)
+            return result
+
+    tasks = [asyncio.ensure_future(create_one(index, payload)) for index, payload in pending]
+
+    if request.wants_ndjson():
+        async def lines():
+            try:
+                for item in immediate:
+                    yield json.dumps(item) + "\n"
+                for task in asyncio.as_completed(tasks):
+                    yield json.dumps(await task) + "\n"
+            finally:
+                for task in tasks:
+                    task.cancel()
+        return StreamingResponse(lines(), 'application/x-ndjson')
+
+    items = sorted(immediate + list(await asyncio.gather(*tasks)), key=lambda item: item['index'])
+    summary = {status: sum(1 for item in items if item['status'] == status)
+               for status in ('created', 'duplicate', 'failed')}
+    return json_response({"program_id": program_id, "summary": summary, "results": items}, 200)
+
+
+async def oauth_callback(request):
+    auth_code = request.query.get('code')
+    if not auth_code:
+        return Response("Error: No se recibió el código de autorización de GoHighLevel.", 400)
+
+    try:
+        token_data = await async_exchange_oauth_code(auth_code)
+        location_id = await asyncio.to_thread(token_store.save_tokens, token_data)
+        logger.info("Tokens guardados para Location ID: %s", location_id)
+        return Response(OAUTH_SUCCESS_HTML, 200, 'text/html; charset=utf-8')
+    except Exception as e:
+        logger.exception("Error en el callback de OAuth: %s", e)
+        return Response(OAUTH_ERROR_HTML, 500, 'text/html; charset=utf-8')
+
+
+ROUTES = {
+    ('POST', '/actions/create_customer'): create_customer,
+    ('POST', '/actions/create_customers_bulk'): create_customers_bulk,
+    ('GET', '/oauth/callback'): oauth_callback,
+}
+
+# Rutas nativas que en Flask pertenecen a un blueprint de traffic_capture.CAPTURED_BLUEPRINTS
+CAPTURED_PATHS = frozenset(('/actions/create_customer', '/actions/create_customers_bulk'))
+
+
+# -----------------------------------------------------------------------------
+# INFRAESTRUCTURA ASGI MÍNIMA
+# -----------------------------------------------------------------------------
+class Request:
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.path = scope.get('path')
+        self.body = body
+        self.query = {k: v[0] for k, v in parse_qs(scope.get('query_string', b'').decode('latin-1')).items()}
+        self.headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+
+    def json(self):
+        if not hasattr(self, '_json'):
+            try:
+                self._json = json.loads(self.body or b'null')
+            except ValueError:
+                self._json = None
+        return self._json
+
+    def wants_ndjson(self):
+        return self.query.get('stream') in ('1', 'true') or 'application/x-ndjson' in self.headers.get('accept', '')
+
+
+class Response:
+    def __init__(self, body, status=200, content_type='text/plain; charset=utf-8', headers=None):
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self.status = status
+        self.content_type = content_type
+        self.headers = headers or {}
+
+    async def send(self, send):
+        headers = [(b'content-type', self.content_type.encode()),
+                   (b'content-length', str(len(self.body)).encode())]
+        headers += [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in self.headers.items()]
+        await send({'type': 'http.response.start', 'status': self.status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+class StreamingResponse:
+    def __init__(self, chunks, content_type, status=200):
+        self.chunks = chunks
+        self.content_type = content_type
+        self.status = status
+
+    async def send(self, send):
+        await send({'type': 'http.response.start', 'status': self.status,
+                    'headers': [(b'content-type', self.content_type.encode())]})
+        async for chunk in self.chunks:
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+def json_response(data, status, headers=None):
+    return Response(json.dumps(data), status, 'application/json', headers)
+
+
+def _limit(request):
+    """location_limits._limit para las rutas nativas: 429 si la sub-cuenta agotó su límite."""
+    if not location_limits.RATE_LIMIT_ENABLED or not request.path.startswith(location_limits.LIMITED_PREFIXES):
+        return None
+    data = request.json()
+    location_id = (data.get('locationId') or data.get('location_id')) if isinstance(data, dict) else None
+    location_id = location_id or request.query.get('locationId')
+    if not location_id:
+        return None
+    retry_after = location_limits.throttle(location_id, request.path)
+    if not retry_after:
+        return None
+    return json_response({"error": location_limits.THROTTLED_MESSAGE}, 429, {"Retry-After": str(retry_after)})
+
+
+def _admit(request):
+    """admission._admit para las rutas nativas. Devuelve (respuesta 503 o None, admitida)."""
+    if not admission.ADMISSION_ENABLED:
+        return None, False
+    if admission.enter(admission.queue_ms(request.headers.get('x-request-start')), 'async'):
+        return None, True
+    return json_response({"error": "Servidor saturado, intente más tarde."}, 503,
+                         {"Retry-After": str(max(1, admission.ADMISSION_RETRY_AFTER))}), False
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+
+    if scope['type'] == 'http' and not any(name == b'x-request-start' for name, _ in scope.get('headers', [])):
+        # Sin proxy que la marque, la llegada se marca aquí: admission mide así la
+        # espera por un hilo de wsgi_fallback
+        scope = dict(scope, headers=list(scope.get('headers', [])) + [(b'x-request-start', f"t={time.time():.3f}".encode())])
+
+    handler = ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+    if handler is None:
+        return await wsgi_fallback(scope, receive, send)
+
+    started = time.perf_counter()
+    request = Request(scope, await _read_body(receive))
+    # Los mismos hooks que la app Flask registra en create_app, en el mismo orden
+    capture = traffic_capture.start() if request.path in CAPTURED_PATHS else None
+    stages = metrics.start_async_request()
+    response = _limit(request)
+    admitted = False
+    if response is None:
+        response, admitted = _admit(request)
+    try:
+        if response is None:
+            response = await handler(request)
+        await response.send(send)
+    finally:
+        if admitted:
+            admission.leave('async')
+
+        # También si el handler falló o el cliente se fue: la petición queda registrada
+        status = response.status if response is not None else 500
+        elapsed = time.perf_counter() - started
+        metrics.finish_async_request(request.path, scope['method'], status, elapsed)
+        profiler.record_request(scope['method'], request.path, request.path, status, elapsed, stages)
+        if capture is not None:
+            query = scope.get('query_string', b'').decode('latin-1')
+            traffic_capture.record(capture, scope['method'], request.path + (f"?{query}" if query else ''),
+                                   request.headers.get('content-type'), request.body,
+                                   'x-webhook-signature' in request.headers, status)
@@ -0,0 +1,125 @@
+# async_client.py
+# Cliente HTTP asíncrono compartido (httpx) para el modo de servicio ASGI.
+# Usa los mismos timeouts, tamaños de pool y política de reintentos que
+# http_client, pero un solo proceso puede mantener cientos de llamadas en vuelo.
+
+import asyncio
+import os
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+import metrics
+from circuit_breaker import BREAKER_ENABLED, get_breaker, is_failure
+from http_client import (
+    HTTP_BACKOFF_FACTOR,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_MAX_RETRIES,
+    HTTP_READ_TIMEOUT,
+    IDEMPOTENT_METHODS,
+    RETRY_STATUS_CODES,
+)
+
+# Conexiones simultáneas por proceso (todas las llamadas salientes)
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.environ.get('ASYNC_HTTP_MAX_CONNECTIONS', 500))
+ASYNC_HTTP_MAX_KEEPALIVE = int(os.environ.get('ASYNC_HTTP_MAX_KEEPALIVE', 100))
+
+_client = None
+
+
+def get_client():
+    """Cliente compartido; se crea dentro del event loop la primera vez."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=ASYNC_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=ASYNC_HTTP_MAX_KEEPALIVE,
+            ),
+        )
+    return _client
+
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def request(method, url, idempotent=None, **kwargs):
+    """
+    Versión asíncrona de http_client.request: reintenta con backoff las llamadas
+    idempotentes ante errores de conexión, timeouts y 429/502/503/504.
+    Comparte los cortacircuitos por host con http_client.
+    """
+    method = method.upper()
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+
+    client = get_client()
+    host = urlsplit(url).netloc
+    attempts = 1 + (HTTP_MAX_RETRIES if idempotent else 0)
+    breaker = get_breaker(host) if BREAKER_ENABLED else None
+
+    for attempt in range(attempts):
+        last_attempt = attempt == attempts - 1
+        if breaker is not None:
+            breaker.check()
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except (httpx.TransportError, httpx.TimeoutException):
+            elapsed = time.perf_counter() - started
+            metrics.observe_upstream(host, method, 'error', elapsed)
+            if breaker is not None:
+                breaker.record(False, elapsed)
+            if last_attempt:
+                raise
+        except BaseException:
+            # Otros errores y CancelledError (el cliente se desconectó) liberan la sonda de medio abierto
+            if breaker is not None:
+                breaker.record(False, time.perf_counter() - started)
+            raise
+        else:
+            elapsed = time.perf_counter() - started
+            metrics.observe_upstream(host, method, response.status_code, elapsed)
+            if breaker is not None:
+                breaker.record(not is_failure(response.status_code), elapsed)
+            if last_attempt or response.status_code not in RETRY_STATUS_CODES:
+                return response
+        await asyncio.sleep(HTTP_BACKOFF_FACTOR * (2 ** attempt))
+
+
+async def post(url, **kwargs):
+    return await request('POST', url, **kwargs)
+
+
+async def get(url, **kwargs):
+    return await request('GET', url, **kwargs)
+
+
+class AsyncSingleFlight:
+    """Equivalente asíncrono de single_flight.SingleFlight para un event loop."""
+
+    def __init__(self):
+        self._inflight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, coro_fn):
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        self.calls += 1
+        future = asyncio.ensure_future(coro_fn())
+        self._inflight[key] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
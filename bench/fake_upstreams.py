@@ -0,0 +1,231 @@
+# bench/fake_upstreams.py
+# Servidores locales que imitan Cloudflare D1, SmartPasses y el endpoint de
+# tokens/contactos de GHL, con latencia y tasa de errores configurables.
+
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+D1_QUERY_PATH = re.compile(r"^/client/v4/accounts/[^/]+/d1/database/[^/]+/query$")
+SMARTPASSES_PATH = re.compile(
+    r"^/api/v1/loyalty/programs/(?P<program_id>[^/]+)/(?P<resource>customers|broadcast|offers)"
+    r"(?:/(?P<item>[^/?]+))?(?:/(?P<increment>points|stamps))?"
+)
+
+
+class FakeUpstream:
+    """
+    Servidor HTTP en un hilo. `latency` (segundos) se aplica a cada respuesta con
+    un jitter de ±`jitter`; `error_rate` es la fracción de respuestas 503.
+    """
+
+    def __init__(self, name, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def handle(self, method, path, body):
+        """Devuelve (status, dict). Cada upstream lo implementa."""
+        raise NotImplementedError
+
+    def start(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def _respond(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                with upstream._lock:
+                    upstream.requests += 1
+
+                delay = upstream.latency + random.uniform(-upstream.jitter, upstream.jitter)
+                if delay > 0:
+                    time.sleep(delay)
+
+                if upstream.error_rate and random.random() < upstream.error_rate:
+                    with upstream._lock:
+                        upstream.errors += 1
+                    status, payload = 503, {"error": "injected failure"}
+                else:
+                    status, payload = upstream.handle(self.command, self.path, raw)
+
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            # Cola de conexiones amplia para soportar cientos de clientes concurrentes
+            request_queue_size = 1024
+
+        self._server = Server(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name=f"fake-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def stats(self):
+        return {"requests": self.requests, "injected_errors": self.errors}
+
+
+class FakeD1(FakeUpstream):
+    """Imita POST /client/v4/accounts/<id>/d1/database/<id>/query sobre sub_account_credentials."""
+
+    def __init__(self, locations=100, **kwargs):
+        super().__init__('d1', **kwargs)
+        self.rows = {}
+        self._rowid = 0
+        for i in range(locations):
+            self._upsert(f"loc-{i}", f"key-{i}", f"prog-{i}")
+
+    def add_location(self, location_id, api_key, program_id):
+        """Precarga las credenciales de una sub-cuenta (p. ej. las de una captura)."""
+        with self._lock:
+            self._upsert(location_id, api_key, program_id)
+
+    def _upsert(self, location_id, api_key, program_id):
+        # Como INSERT OR REPLACE en SQLite: cada escritura recibe un rowid nuevo
+        self._rowid += 1
+        self.rows.pop(location_id, None)
+        self.rows[location_id] = {
+            "rowid": self._rowid, "location_id": location_id, "api_key": api_key, "program_id": program_id,
+        }
+
+    def _execute(self, sql, params):
+        normalized = " ".join(sql.split()).upper()
+        if normalized.startswith("INSERT OR REPLACE INTO SUB_ACCOUNT_CREDENTIALS"):
+            self._upsert(*params[:3])
+            return []
+        if normalized.startswith("SELECT") and "WHERE LOCATION_ID IN" in normalized:
+            wanted = set(params)
+            return [dict(row) for row in self.rows.values() if row["location_id"] in wanted]
+        if normalized.startswith("SELECT") and "WHERE LOCATION_ID = ?" in normalized:
+            row = self.rows.get(params[0])
+            return [dict(row)] if row else []
+        if normalized.startswith("SELECT") and "ROWID >" in normalized:
+            return [dict(row, row_version=row["rowid"]) for row in self.rows.values() if row["rowid"] > params[0]]
+        return []
+
+    def handle(self, method, path, body):
+        if method != 'POST' or not D1_QUERY_PATH.match(path):
+            return 404, {"success": False, "errors": [{"message": "not found"}]}
+        request = json.loads(body or b'{}')
+        if isinstance(request, dict) and 'batch' in request:
+            statements = request['batch']
+        else:
+            statements = request if isinstance(request, list) else [request]
+        result = [{"results": self._execute(st.get("sql", ""), st.get("params") or []), "success": True, "meta": {}}
+                  for st in statements]
+        return 200, {"success": True, "errors": [], "messages": [], "result": result}
+
+
+class FakeSmartPasses(FakeUpstream):
+    """Imita la API de lealtad de SmartPasses (/api/v1/loyalty/programs/...)."""
+
+    def __init__(self, **kwargs):
+        super().__init__('smartpasses', **kwargs)
+        self._next_id = 0
+        # Clientes creados por programa, en orden de creación (para el listado paginado)
+        self.customers = {}
+        # Llamadas de suma de puntos/sellos recibidas
+        self.increments = 0
+
+    def handle(self, method, path, body):
+        match = SMARTPASSES_PATH.match(path)
+        if not match:
+            return 404, {"error": "not found"}
+        payload = json.loads(body or b'{}') if body else {}
+        resource = match.group('resource')
+        program_id = match.group('program_id')
+        if resource == 'customers' and method == 'POST' and match.group('increment'):
+            kind = match.group('increment')
+            with self._lock:
+                self.increments += 1
+                stored = self.customers.setdefault(program_id, {}).setdefault(
+                    match.group('item'), {"id": match.group('item'), "programId": program_id})
+                stored[kind] = stored.get(kind, 0) + int(payload.get(kind) or 0)
+                return 200, dict(stored)
+        if resource == 'customers' and method == 'POST':
+            with self._lock:
+                self._next_id += 1
+                customer = dict(payload, id=f"cust-{self._next_id}", programId=program_id)
+                self.customers.setdefault(program_id, {})[customer['id']] = customer
+            return 201, customer
+        if resource == 'customers' and method == 'GET' and not match.group('item'):
+            query = parse_qs(urlsplit(path).query)
+            page = int(query.get('page', ['1'])[0])
+            limit = int(query.get('limit', ['100'])[0])
+            with self._lock:
+                customers = list(self.customers.get(program_id, {}).values())
+            return 200, {"data": customers[(page - 1) * limit:page * limit], "total": len(customers)}
+        if resource == 'customers' and method in ('PUT', 'GET'):
+            with self._lock:
+                stored = self.customers.get(program_id, {}).get(match.group('item'))
+                if stored is not None and method == 'PUT':
+                    stored.update(payload)
+            return 200, dict(stored or payload, id=match.group('item'), programId=program_id)
+        if resource == 'broadcast':
+            return 200, {"status": "sent"}
+        if resource == 'offers':
+            return 200, {"data": [], "total": 0}
+        return 405, {"error": "method not allowed"}
+
+
+class FakeGHL(FakeUpstream):
+    """Imita POST /oauth/token y el listado paginado GET /contacts/ de GHL."""
+
+    def __init__(self, **kwargs):
+        super().__init__('ghl', **kwargs)
+        # Contactos por locationId, en orden (para el listado con startAfterId)
+        self.contacts = {}
+
+    def handle(self, method, path, body):
+        if method == 'GET' and path.startswith('/contacts/'):
+            query = parse_qs(urlsplit(path).query)
+            limit = int(query.get('limit', ['100'])[0])
+            after = query.get('startAfterId', [None])[0]
+            with self._lock:
+                contacts = list(self.contacts.get(query.get('locationId', [''])[0], []))
+            start = next((i + 1 for i, contact in enumerate(contacts) if contact['id'] == after), 0)
+            page = contacts[start:start + limit]
+            meta = {"total": len(contacts)}
+            if page:
+                meta.update(startAfterId=page[-1]['id'], startAfter=start + len(page))
+            return 200, {"contacts": page, "meta": meta}
+        if method != 'POST' or not path.startswith('/oauth/token'):
+            return 404, {"error": "not found"}
+        suffix = f"{time.time():.6f}"
+        return 200, {
+            "access_token": f"access-{suffix}", "refresh_token": f"refresh-{suffix}",
+            "expires_in": 86399, "locationId": "loc-0", "userType": "Location",
+        }
@@ -0,0 +1,244 @@
+# bench/replay.py
+# Reproduce una captura de traffic_capture.py contra una instancia local.
+#
+# Levanta los mismos servidores falsos de D1, SmartPasses y GHL que run_bench.py
+# (con las sub-cuentas de la captura precargadas en D1), arranca create_app() y
+# envía las peticiones respetando los intervalos originales entre ellas, más
+# rápido (--speed 5 = cinco veces más rápido) o sin esperas (--speed max). Los
+# webhooks se vuelven a firmar con el GHL_SHARED_SECRET de prueba. El reporte
+# tiene el mismo formato que el de run_bench.py, por ruta, más la latencia que
+# se midió al capturar:
+#
+#   python bench/replay.py capture.jsonl --speed 1 --output replay_before.json
+#   python bench/replay.py capture.jsonl --speed max --output replay_after.json
+#   python bench/replay.py --compare replay_before.json replay_after.json
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fake_upstreams import FakeD1, FakeGHL, FakeSmartPasses  # noqa: E402
+from bench.run_bench import (  # noqa: E402
+    BENCH_SHARED_SECRET, bench_environment, compare, git_revision, percentile, start_gunicorn_server,
+    start_inprocess_server,
+)
+
+
+def read_capture(path):
+    """Líneas de la captura una a una (las que no se pueden leer se saltan)."""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def route_of(record):
+    return record['p'].split('?', 1)[0]
+
+
+def scan(path):
+    """Sub-cuentas y primer instante de la captura, sin cargarla completa en memoria."""
+    locations = set()
+    first = None
+    total = 0
+    for record in read_capture(path):
+        total += 1
+        first = record['t'] if first is None else min(first, record['t'])
+        try:
+            body = json.loads(record['b']) if record.get('b') else {}
+        except ValueError:
+            body = {}
+        if isinstance(body, dict):
+            location_id = body.get('locationId') or body.get('location_id')
+            if location_id:
+                locations.add(location_id)
+    return locations, first, total
+
+
+def build_request(record, shared_secret):
+    """(método, ruta, cuerpo, cabeceras) de una línea de la captura."""
+    body = (record.get('b') or '').encode('utf-8')
+    headers = {"Content-Type": record.get('ct') or "application/json"}
+    if record.get('sig'):
+        headers["x-webhook-signature"] = hmac.new(shared_secret.encode(), body, hashlib.sha256).hexdigest()
+    return record['m'], record['p'], body, headers
+
+
+def summarize(latencies, statuses, wall):
+    latencies.sort()
+    total = len(latencies)
+    errors = sum(count for status, count in statuses.items() if status == 'error' or status >= 500)
+    return {
+        "requests": total,
+        "errors": errors,
+        "statuses": {str(k): v for k, v in sorted(statuses.items(), key=lambda kv: str(kv[0]))},
+        "requests_per_second": round(total / wall, 2) if wall else 0.0,
+        "mean_ms": round(sum(latencies) / total * 1000, 3) if total else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+    }
+
+
+def replay(base_url, path, first, speed, concurrency, shared_secret):
+    """
+    Envía la captura respetando sus intervalos divididos por `speed` (None = sin esperas).
+    Devuelve {ruta: estadísticas} de la reproducción y de la captura original.
+    """
+    import requests
+
+    local = threading.local()
+    lock = threading.Lock()
+    by_route = {}
+    # Como mucho 2x concurrency peticiones pendientes: la captura se lee a medida que se envía
+    pending = threading.BoundedSemaphore(concurrency * 2)
+    lag = []
+
+    def one(record):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        method, target, body, headers = build_request(record, shared_secret)
+        started = time.perf_counter()
+        try:
+            status = session.request(method, base_url + target, data=body, headers=headers, timeout=60).status_code
+        except Exception:
+            status = 'error'
+        elapsed = time.perf_counter() - started
+        with lock:
+            route = by_route.setdefault(route_of(record), {"latencies": [], "statuses": {}, "original": []})
+            route["latencies"].append(elapsed)
+            route["statuses"][status] = route["statuses"].get(status, 0) + 1
+            route["original"].append(record.get('d', 0) / 1000)
+        pending.release()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for record in read_capture(path):
+            if speed:
+                due = started + (record['t'] - first) / speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    lag.append(-delay)
+            pending.acquire()
+            executor.submit(one, record)
+    wall = time.perf_counter() - started
+
+    results = {}
+    for route, data in sorted(by_route.items()):
+        results[route] = summarize(data["latencies"], data["statuses"], wall)
+        original = sorted(data["original"])
+        results[route]["captured_p50_ms"] = round(percentile(original, 0.50) * 1000, 3)
+        results[route]["captured_p95_ms"] = round(percentile(original, 0.95) * 1000, 3)
+    lag.sort()
+    schedule = {
+        "wall_seconds": round(wall, 3),
+        "late_requests": len(lag),
+        "p95_lag_ms": round(percentile(lag, 0.95) * 1000, 3),
+    }
+    return results, schedule
+
+
+def run(args):
+    locations, first, total = scan(args.capture)
+    if not total:
+        raise SystemExit(f"{args.capture} no tiene peticiones")
+
+    latency = args.upstream_latency_ms / 1000
+    jitter = args.upstream_jitter_ms / 1000
+    d1 = FakeD1(locations=0, latency=latency, jitter=jitter).start()
+    for location_id in sorted(locations):
+        d1.add_location(location_id, f"replay-key-{location_id}", f"replay-program-{location_id}")
+    smartpasses = FakeSmartPasses(latency=latency, jitter=jitter).start()
+    ghl = FakeGHL(latency=latency, jitter=jitter).start()
+    data_dir = tempfile.mkdtemp(prefix='smartpasses-replay-')
+    env = bench_environment(args, d1, smartpasses, ghl, data_dir)
+    env["GHL_SHARED_SECRET"] = args.shared_secret
+    # Se reproduce la captura, no se vuelve a capturar
+    env["TRAFFIC_CAPTURE_FILE"] = ""
+
+    if args.server == 'gunicorn':
+        base_url, stop = start_gunicorn_server(env, args.workers, args.threads, args.port)
+    else:
+        base_url, stop = start_inprocess_server(env, args.threads)
+
+    speed = None if args.speed == 'max' else float(args.speed)
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "config": {
+            "capture": os.path.basename(args.capture), "captured_requests": total, "locations": len(locations),
+            "speed": args.speed, "server": args.server, "workers": args.workers, "threads": args.threads,
+            "concurrency": args.concurrency, "upstream_latency_ms": args.upstream_latency_ms,
+            "upstream_jitter_ms": args.upstream_jitter_ms,
+        },
+    }
+    try:
+        report["results"], report["schedule"] = replay(
+            base_url, args.capture, first, speed, args.concurrency, args.shared_secret)
+        for route, result in report["results"].items():
+            print(f"{route}: {result}", file=sys.stderr)
+    finally:
+        stop()
+        report["upstreams"] = {u.name: u.stats() for u in (d1, smartpasses, ghl)}
+        for upstream in (d1, smartpasses, ghl):
+            upstream.stop()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reproduce una captura de tráfico de GHL contra una instancia local")
+    parser.add_argument('capture', nargs='?', help="archivo de TRAFFIC_CAPTURE_FILE")
+    parser.add_argument('--speed', default='1', help="1 = ritmo original, N = N veces más rápido, max = sin esperas")
+    parser.add_argument('--concurrency', type=int, default=64, help="peticiones simultáneas como máximo")
+    parser.add_argument('--shared-secret', default=BENCH_SHARED_SECRET, help="secreto para volver a firmar webhooks")
+    parser.add_argument('--upstream-latency-ms', type=float, default=40)
+    parser.add_argument('--upstream-jitter-ms', type=float, default=10)
+    parser.add_argument('--server', choices=('inprocess', 'gunicorn'), default='inprocess')
+    parser.add_argument('--workers', type=int, default=2, help="workers de gunicorn")
+    parser.add_argument('--threads', type=int, default=4, help="hilos por worker de gunicorn")
+    parser.add_argument('--port', type=int, default=5056)
+    parser.add_argument('--output', help="archivo JSON de salida (por defecto stdout)")
+    parser.add_argument('--compare', nargs=2, metavar=('ANTES', 'DESPUES'), help="compara dos reportes")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        result = compare(*args.compare)
+    elif args.capture:
+        if args.speed != 'max':
+            try:
+                if float(args.speed) <= 0:
+                    raise ValueError
+            except ValueError:
+                parser.error("--speed debe ser un número mayor que 0 o 'max'")
+        result = run(args)
+    else:
+        parser.error("indique el archivo de captura o --compare")
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
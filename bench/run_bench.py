@@ -0,0 +1,281 @@
+# bench/run_bench.py
+# Banco de pruebas de carga reproducible para el servidor intermediario.
+#
+# Levanta servidores locales que imitan D1, SmartPasses y GHL, arranca create_app()
+# apuntando a ellos y lanza peticiones concurrentes contra cada endpoint.
+# El resultado (p50/p95/p99 y peticiones por segundo) se escribe en JSON para
+# poder compararlo entre commits:
+#
+#   python bench/run_bench.py --requests 2000 --concurrency 32 --output bench_before.json
+#   python bench/run_bench.py --compare bench_before.json bench_after.json
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fake_upstreams import FakeD1, FakeGHL, FakeSmartPasses  # noqa: E402
+
+ENDPOINTS = ('create_customer', 'send_push', 'webhook', 'settings_save')
+BENCH_SHARED_SECRET = 'bench-shared-secret'
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def build_request(endpoint, locations, rng):
+    """Devuelve (método, ruta, cuerpo en bytes, cabeceras) para una petición del endpoint."""
+    location_id = f"loc-{rng.randrange(locations)}"
+    n = rng.randrange(1_000_000_000)
+    if endpoint == 'create_customer':
+        body = {"locationId": location_id, "inputs": {
+            "contact_email": f"bench-{n}@example.com", "contact_first_name": "Bench", "contact_last_name": str(n)}}
+        return 'POST', '/actions/create_customer', json.dumps(body).encode(), {}
+    if endpoint == 'send_push':
+        body = {"locationId": location_id, "message": f"Mensaje de prueba {n}"}
+        return 'POST', '/actions/send_push', json.dumps(body).encode(), {}
+    if endpoint == 'webhook':
+        raw = json.dumps({"type": "ContactUpdate", "id": f"evt-{n}", "locationId": location_id,
+                          "contact": {"id": f"contact-{n % 5000}", "email": f"bench-{n % 5000}@example.com"}}).encode()
+        signature = hmac.new(BENCH_SHARED_SECRET.encode(), raw, hashlib.sha256).hexdigest()
+        return 'POST', '/webhook/ghl', raw, {"x-webhook-signature": signature}
+    if endpoint == 'settings_save':
+        body = {"locationId": location_id, "apiKey": f"key-{n}", "programId": f"prog-{n % 10}"}
+        return 'POST', '/settings/save', json.dumps(body).encode(), {}
+    raise ValueError(endpoint)
+
+
+def drive(base_url, endpoint, total, concurrency, locations, seed):
+    """Ejecuta `total` peticiones con `concurrency` hilos y devuelve las estadísticas."""
+    import requests
+
+    rng_lock = threading.Lock()
+    rng = random.Random(seed)
+    local = threading.local()
+    latencies = []
+    statuses = {}
+    stats_lock = threading.Lock()
+
+    def one(_):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        with rng_lock:
+            method, path, body, headers = build_request(endpoint, locations, rng)
+        headers = dict(headers, **{"Content-Type": "application/json"})
+        started = time.perf_counter()
+        try:
+            status = session.request(method, base_url + path, data=body, headers=headers, timeout=60).status_code
+        except Exception:
+            status = 'error'
+        elapsed = time.perf_counter() - started
+        with stats_lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total)))
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    errors = sum(count for status, count in statuses.items() if status == 'error' or status >= 500)
+    return {
+        "requests": total,
+        "errors": errors,
+        "statuses": {str(k): v for k, v in sorted(statuses.items(), key=lambda kv: str(kv[0]))},
+        "requests_per_second": round(total / wall, 2) if wall else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+    }
+
+
+def bench_environment(args, d1, smartpasses, ghl, data_dir):
+    """Variables de entorno que apuntan la app a los servidores falsos."""
+    return {
+        "FLASK_ENV": "production",
+        "CF_ACCOUNT_ID": "bench-account",
+        "CF_D1_DATABASE_ID": "bench-db",
+        "CF_API_TOKEN": "bench-token",
+        "CF_API_BASE_URL": d1.url,
+        "SMARTPASSES_API_BASE_URL": f"{smartpasses.url}/api/v1/loyalty",
+        "SMARTPASSES_API_KEY": "bench-global-key",
+        "GHL_API_BASE_URL": ghl.url,
+        "GHL_CLIENT_ID": "bench-client",
+        "GHL_CLIENT_SECRET": "bench-secret",
+        "GHL_SHARED_SECRET": BENCH_SHARED_SECRET,
+        "SECRET_KEY": "bench",
+        "LOCAL_DB_DIR": data_dir,
+        # Sin deduplicación de push para que cada petición encole trabajo real
+        "PUSH_DEDUPE_WINDOW": "0",
+    }
+
+
+def start_inprocess_server(env, threads):
+    """create_app() en un servidor WSGI con hilos, dentro de este proceso."""
+    os.environ.update(env)
+    from werkzeug.serving import make_server
+    from app import create_app
+
+    app = create_app('production')
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="bench-app", daemon=True)
+    thread.start()
+    host, port = server.server_address
+    return f"http://{host}:{port}", server.shutdown
+
+
+def start_gunicorn_server(env, workers, threads, port):
+    """create_app() bajo gunicorn con los mismos parámetros que start.sh."""
+    command = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}',
+               '--workers', str(workers), '--threads', str(threads), '--log-level', 'warning', 'wsgi:application']
+    return _start_subprocess_server(command, env, port)
+
+
+def _start_subprocess_server(command, env, port):
+    process = subprocess.Popen(command, cwd=ROOT, env=dict(os.environ, **env))
+    base_url = f"http://127.0.0.1:{port}"
+
+    import requests
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(base_url + '/health', timeout=1).status_code == 200:
+                break
+        except Exception:
+            time.sleep(0.2)
+    else:
+        process.terminate()
+        raise RuntimeError(f"{command[2]} no arrancó a tiempo")
+
+    def stop():
+        process.terminate()
+        process.wait(timeout=10)
+
+    return base_url, stop
+
+
+def start_asgi_server(env, workers, port):
+    """El modo asíncrono de asgi.py bajo uvicorn."""
+    command = [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1',
+               '--port', str(port), '--workers', str(workers), '--log-level', 'warning']
+    return _start_subprocess_server(command, env, port)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    latency = args.upstream_latency_ms / 1000
+    jitter = args.upstream_jitter_ms / 1000
+    d1 = FakeD1(locations=args.locations, latency=latency, jitter=jitter, error_rate=args.error_rate).start()
+    smartpasses = FakeSmartPasses(latency=latency, jitter=jitter, error_rate=args.error_rate).start()
+    ghl = FakeGHL(latency=latency, jitter=jitter, error_rate=args.error_rate).start()
+    data_dir = tempfile.mkdtemp(prefix='smartpasses-bench-')
+    env = bench_environment(args, d1, smartpasses, ghl, data_dir)
+
+    if args.server == 'gunicorn':
+        base_url, stop = start_gunicorn_server(env, args.workers, args.threads, args.port)
+    elif args.server == 'asgi':
+        base_url, stop = start_asgi_server(env, args.workers, args.port)
+    else:
+        base_url, stop = start_inprocess_server(env, args.threads)
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "config": {
+            "server": args.server, "workers": args.workers, "threads": args.threads,
+            "requests": args.requests, "concurrency": args.concurrency, "locations": args.locations,
+            "upstream_latency_ms": args.upstream_latency_ms, "upstream_jitter_ms": args.upstream_jitter_ms,
+            "error_rate": args.error_rate, "seed": args.seed,
+        },
+        "results": {},
+    }
+    try:
+        for endpoint in args.endpoints:
+            if args.warmup:
+                drive(base_url, endpoint, args.warmup, args.concurrency, args.locations, args.seed + 1)
+            report["results"][endpoint] = drive(
+                base_url, endpoint, args.requests, args.concurrency, args.locations, args.seed)
+            print(f"{endpoint}: {report['results'][endpoint]}", file=sys.stderr)
+    finally:
+        stop()
+        report["upstreams"] = {u.name: u.stats() for u in (d1, smartpasses, ghl)}
+        for upstream in (d1, smartpasses, ghl):
+            upstream.stop()
+    return report
+
+
+def compare(before_path, after_path):
+    """Diferencia porcentual entre dos reportes (negativo = más rápido en latencia)."""
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    diff = {"before": before.get("revision"), "after": after.get("revision"), "results": {}}
+    for endpoint, new in after["results"].items():
+        old = before["results"].get(endpoint)
+        if not old:
+            continue
+        diff["results"][endpoint] = {
+            key: {"before": old[key], "after": new[key],
+                  "change_pct": round((new[key] - old[key]) / old[key] * 100, 2) if old[key] else None}
+            for key in ('requests_per_second', 'p50_ms', 'p95_ms', 'p99_ms', 'errors')
+        }
+    return diff
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Banco de pruebas de carga del SmartPasses GHL Bridge")
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument('--requests', type=int, default=1000, help="peticiones por endpoint")
+    parser.add_argument('--warmup', type=int, default=50, help="peticiones de calentamiento por endpoint")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--locations', type=int, default=100, help="sub-cuentas precargadas en el D1 falso")
+    parser.add_argument('--upstream-latency-ms', type=float, default=40)
+    parser.add_argument('--upstream-jitter-ms', type=float, default=10)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fracción de respuestas 503 inyectadas")
+    parser.add_argument('--server', choices=('inprocess', 'gunicorn', 'asgi'), default='inprocess')
+    parser.add_argument('--workers', type=int, default=2, help="workers de gunicorn/uvicorn")
+    parser.add_argument('--threads', type=int, default=1, help="hilos por worker de gunicorn")
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--output', help="archivo JSON de salida (por defecto stdout)")
+    parser.add_argument('--compare', nargs=2, metavar=('ANTES', 'DESPUES'), help="compara dos reportes")
+    args = parser.parse_args(argv)
+
+    result = compare(*args.compare) if args.compare else run(args)
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+# circuit_breaker.py
+# Cortacircuitos por upstream (D1, SmartPasses, GHL).
+#
+# Cada host lleva una ventana deslizante de BREAKER_WINDOW segundos con las
+# llamadas, los fallos (errores de conexión, timeouts y 5xx) y las llamadas
+# lentas. Si la proporción de fallos o de lentas supera el umbral, el circuito se
+# abre y las llamadas fallan de inmediato durante BREAKER_OPEN_SECONDS. Después
+# se deja pasar una sola llamada de prueba (semiabierto): si va bien se cierra,
+# si falla se vuelve a abrir.
+
+import os
+import threading
+import time
+from collections import deque
+
+import requests
+
+BREAKER_ENABLED = os.environ.get('BREAKER_ENABLED', 'true').lower() == 'true'
+BREAKER_WINDOW = float(os.environ.get('BREAKER_WINDOW', 30))
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', 20))
+BREAKER_ERROR_RATE = float(os.environ.get('BREAKER_ERROR_RATE', 0.5))
+BREAKER_SLOW_CALL_SECONDS = float(os.environ.get('BREAKER_SLOW_CALL_SECONDS', 5))
+BREAKER_SLOW_CALL_RATE = float(os.environ.get('BREAKER_SLOW_CALL_RATE', 0.8))
+BREAKER_OPEN_SECONDS = float(os.environ.get('BREAKER_OPEN_SECONDS', 15))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    El circuito del upstream está abierto. Hereda de ConnectionError para que los
+    manejadores existentes de requests.exceptions.RequestException lo traten
+    como un upstream caído.
+    """
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"Circuito abierto para {name}; reintentar en {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, name, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 error_rate=BREAKER_ERROR_RATE, slow_call_seconds=BREAKER_SLOW_CALL_SECONDS,
+                 slow_call_rate=BREAKER_SLOW_CALL_RATE, open_seconds=BREAKER_OPEN_SECONDS):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        # Cubetas de un segundo: [segundo, llamadas, fallos, lentas]
+        self._buckets = deque()
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.times_opened = 0
+
+    def _trim(self, now):
+        cutoff = int(now - self.window)
+        while self._buckets and self._buckets[0][0] <= cutoff:
+            self._buckets.popleft()
+
+    def _totals(self):
+        calls = failures = slow = 0
+        for _, c, f, s in self._buckets:
+            calls += c
+            failures += f
+            slow += s
+        return calls, failures, slow
+
+    def retry_after(self):
+        """Segundos hasta que se permita la siguiente llamada de prueba."""
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+
+    def allow(self):
+        """True si la llamada puede salir. En semiabierto solo pasa una prueba a la vez."""
+        now = time.monotonic()
+        with self._lock:
+            if self.state == OPEN and now - self._opened_at >= self.open_seconds:
+                self.state = HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def check(self):
+        """Como allow(), pero lanza CircuitOpenError si la llamada no puede salir."""
+        if not self.allow():
+            raise CircuitOpenError(self.name, self.retry_after() or self.open_seconds)
+
+    def record(self, success, seconds):
+        """Registra el resultado de una llamada que pasó por allow()."""
+        now = time.monotonic()
+        slow = seconds >= self.slow_call_seconds
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probe_in_flight = False
+                if success and not slow:
+                    self.state = CLOSED
+                    self._buckets.clear()
+                else:
+                    self._open(now)
+                return
+
+            second = int(now)
+            if not self._buckets or self._buckets[-1][0] != second:
+                self._buckets.append([second, 0, 0, 0])
+            bucket = self._buckets[-1]
+            bucket[1] += 1
+            bucket[2] += 0 if success else 1
+            bucket[3] += 1 if slow else 0
+            self._trim(now)
+
+            if self.state == CLOSED:
+                calls, failures, slow_calls = self._totals()
+                if calls >= self.min_calls and (
+                        failures / calls >= self.error_rate or slow_calls / calls >= self.slow_call_rate):
+                    self._open(now)
+
+    def _open(self, now):
+        self.state = OPEN
+        self._opened_at = now
+        self.times_opened += 1
+
+    def stats(self):
+        with self._lock:
+            self._trim(time.monotonic())
+            calls, failures, slow = self._totals()
+            state = self.state
+        return {
+            "state": state,
+            "calls": calls,
+            "failures": failures,
+            "slow_calls": slow,
+            "rejected": self.rejected,
+            "times_opened": self.times_opened,
+            "retry_after": round(self.retry_after(), 1),
+        }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """Cortacircuitos compartido del upstream `name` (normalmente el host)."""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(name, CircuitBreaker(name))
+    return breaker
+
+
+def is_failure(status_code):
+    """Los 5xx cuentan como fallo del upstream; los 4xx son errores del cliente."""
+    return status_code >= 500
+
+
+def stats():
+    return {name: breaker.stats() for name, breaker in list(_breakers.items())}
+
+
+def any_open():
+    return any(breaker.state == OPEN for breaker in list(_breakers.values()))
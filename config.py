@@ -22,6 +22,9 @@ class Config:
     # Configuración del servidor
     HOST = os.environ.get('HOST', '0.0.0.0')
     PORT = int(os.environ.get('PORT', 5000))
+
+    # Calentamiento de cachés y conexiones al arrancar cada worker (ver warmup.py)
+    WARMUP_ENABLED = os.environ.get('WARMUP_ENABLED', 'true').lower() == 'true'
     
     @staticmethod
     def init_app(app):
@@ -31,6 +34,7 @@ class Config:
 class DevelopmentConfig(Config):
     """Configuración para desarrollo"""
     DEBUG = True
+    WARMUP_ENABLED = False
 
 class ProductionConfig(Config):
     """Configuración para producción"""
@@ -41,22 +45,11 @@ class ProductionConfig(Config):
     def init_app(app):
         Config.init_app(app)
         
-        # Log de errores a archivo
-        import logging
-        from logging.handlers import RotatingFileHandler
-        
+        # Logs JSON a stdout y a archivo rotativo, escritos desde un hilo aparte
+        import structured_log
+
         if not app.debug:
-            if not os.path.exists('logs'):
-                os.mkdir('logs')
-            
-            file_handler = RotatingFileHandler('logs/smartpasses.log', maxBytes=10240, backupCount=10)
-            file_handler.setFormatter(logging.Formatter(
-                '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-            ))
-            file_handler.setLevel(logging.INFO)
-            app.logger.addHandler(file_handler)
-            
-            app.logger.setLevel(logging.INFO)
+            structured_log.configure(log_file=os.environ.get('LOG_FILE', 'logs/smartpasses.log'))
             app.logger.info('SmartPasses Smart Passes Server startup')
 
 config = {
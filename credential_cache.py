@@ -0,0 +1,117 @@
+# credential_cache.py
+# Caché en memoria (TTL + LRU) de las credenciales por sub-cuenta de GHL, con un
+# nivel compartido entre workers detrás (ver shared_cache.py y CACHE_BACKEND).
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from shared_cache import TieredCache, create_backend
+
+# Configuración por variables de entorno
+CREDENTIAL_CACHE_TTL = float(os.environ.get('CREDENTIAL_CACHE_TTL', 300))
+CREDENTIAL_CACHE_NEGATIVE_TTL = float(os.environ.get('CREDENTIAL_CACHE_NEGATIVE_TTL', 30))
+CREDENTIAL_CACHE_MAX_SIZE = int(os.environ.get('CREDENTIAL_CACHE_MAX_SIZE', 1024))
+
+# Valor centinela para las sub-cuentas que aún no tienen credenciales guardadas
+NOT_CONFIGURED = object()
+
+
+class TTLCache:
+    """
+    Caché acotada con expiración por entrada y expulsión LRU.
+    Es segura para usarse desde varios hilos del mismo worker.
+    """
+
+    def __init__(self, max_size=1024, ttl=300, negative_ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Devuelve el valor guardado o None si no existe o ya expiró."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at <= now:
+                # La entrada vencida se conserva (hasta que la expulse el LRU) para get_stale()
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get_stale(self, key):
+        """Devuelve el valor aunque haya expirado (para cuando el upstream está caído)."""
+        with self._lock:
+            entry = self._data.get(key)
+            return entry[0] if entry is not None else None
+
+    def set(self, key, value, ttl=None):
+        """Guarda un valor. Los NOT_CONFIGURED usan el TTL negativo."""
+        if ttl is None:
+            ttl = self.negative_ttl if value is NOT_CONFIGURED else self.ttl
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def _create_credential_cache():
+    local = TTLCache(
+        max_size=CREDENTIAL_CACHE_MAX_SIZE,
+        ttl=CREDENTIAL_CACHE_TTL,
+        negative_ttl=CREDENTIAL_CACHE_NEGATIVE_TTL,
+    )
+    backend = create_backend()
+    if backend is None:
+        return local
+    return TieredCache('credentials', local, backend, sentinel=NOT_CONFIGURED)
+
+
+# Instancia compartida por todos los blueprints del worker
+credential_cache = _create_credential_cache()
+
+
+def invalidate_location(location_id):
+    """Elimina las credenciales de una sub-cuenta en este worker y en los demás."""
+    credential_cache.invalidate(location_id)
+
+
+def invalidate_locations(location_ids):
+    """Elimina de la caché varias sub-cuentas (p. ej. tras sincronizar la réplica)."""
+    if hasattr(credential_cache, 'invalidate_many'):
+        credential_cache.invalidate_many(location_ids)
+        return
+    for location_id in location_ids:
+        credential_cache.invalidate(location_id)
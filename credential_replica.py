@@ -0,0 +1,214 @@
+# credential_replica.py
+# Réplica local (SQLite) de la tabla sub_account_credentials de Cloudflare D1.
+#
+# Modos (CREDENTIAL_REPLICA_MODE):
+#   local - se lee primero la réplica; si no está la fila se consulta D1 (por defecto)
+#   d1    - se lee primero D1; la réplica solo se usa si D1 falla
+#   off   - la réplica no se usa
+#
+# La réplica se carga completa al arrancar y luego se sincroniza de forma
+# incremental usando el rowid de D1: como save_settings usa INSERT OR REPLACE,
+# cada escritura genera un rowid nuevo mayor que el último sincronizado.
+# Cada cierto número de ciclos se hace una carga completa para reflejar borrados.
+
+import logging
+import os
+import threading
+import time
+
+import d1
+from local_db import get_connection
+
+logger = logging.getLogger(__name__)
+
+CREDENTIAL_REPLICA_MODE = os.environ.get('CREDENTIAL_REPLICA_MODE', 'local').lower()
+CREDENTIAL_REPLICA_SYNC_INTERVAL = float(os.environ.get('CREDENTIAL_REPLICA_SYNC_INTERVAL', 60))
+CREDENTIAL_REPLICA_FULL_SYNC_EVERY = int(os.environ.get('CREDENTIAL_REPLICA_FULL_SYNC_EVERY', 30))
+
+DB_NAME = 'credentials'
+
+_schema_ready = False
+_sync_thread = None
+_sync_lock = threading.Lock()
+_ready = threading.Event()
+
+
+def _db():
+    global _schema_ready
+    conn = get_connection(DB_NAME)
+    if not _schema_ready:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sub_account_credentials (
+                location_id TEXT PRIMARY KEY,
+                api_key TEXT NOT NULL,
+                program_id TEXT NOT NULL,
+                synced_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS replica_meta (
+                key TEXT PRIMARY KEY,
+                value REAL NOT NULL
+            );
+        """)
+        _schema_ready = True
+    return conn
+
+
+def _get_meta(conn, key, default=0):
+    row = conn.execute("SELECT value FROM replica_meta WHERE key = ?;", [key]).fetchone()
+    return row['value'] if row else default
+
+
+def _set_meta(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO replica_meta (key, value) VALUES (?, ?);", [key, value])
+
+
+def is_enabled():
+    return CREDENTIAL_REPLICA_MODE in ('local', 'd1')
+
+
+def is_ready():
+    """Indica si la carga inicial desde D1 ya terminó (en este u otro worker)."""
+    if _ready.is_set():
+        return True
+    if _get_meta(_db(), 'last_full_sync'):
+        _ready.set()
+        return True
+    return False
+
+
+def get(location_id):
+    """Devuelve las credenciales de la réplica o None si no existen."""
+    row = _db().execute(
+        "SELECT api_key, program_id FROM sub_account_credentials WHERE location_id = ?;",
+        [location_id]
+    ).fetchone()
+    if row is None:
+        return None
+    return {"smartpasses_api_key": row['api_key'], "default_program_id": row['program_id']}
+
+
+def get_many(location_ids):
+    """Credenciales de la réplica para varias locations: {location_id: credenciales}."""
+    conn = _db()
+    found = {}
+    location_ids = list(location_ids)
+    # Se parte en grupos para no superar el límite de parámetros de SQLite
+    for start in range(0, len(location_ids), 500):
+        chunk = location_ids[start:start + 500]
+        rows = conn.execute(
+            f"SELECT location_id, api_key, program_id FROM sub_account_credentials "
+            f"WHERE location_id IN ({', '.join('?' * len(chunk))});",
+            chunk
+        ).fetchall()
+        for row in rows:
+            found[row['location_id']] = {"smartpasses_api_key": row['api_key'], "default_program_id": row['program_id']}
+    return found
+
+
+def recent_location_ids(limit):
+    """Locations sincronizadas o escritas más recientemente."""
+    rows = _db().execute(
+        "SELECT location_id FROM sub_account_credentials ORDER BY synced_at DESC LIMIT ?;", [limit]
+    ).fetchall()
+    return [row['location_id'] for row in rows]
+
+
+def upsert(location_id, api_key, program_id):
+    """Escritura directa (write-through) desde save_settings o tras leer D1."""
+    if not is_enabled():
+        return
+    _db().execute(
+        "INSERT OR REPLACE INTO sub_account_credentials (location_id, api_key, program_id, synced_at) "
+        "VALUES (?, ?, ?, ?);",
+        [location_id, api_key, program_id, time.time()]
+    )
+
+
+def sync(full=False):
+    """
+    Trae de D1 las filas nuevas o modificadas. Devuelve los location_id
+    actualizados o None si D1 respondió con error.
+    """
+    conn = _db()
+    started_at = time.time()
+    high_water = 0 if full else int(_get_meta(conn, 'high_water'))
+    result, error = d1.query(
+        "SELECT rowid AS row_version, location_id, api_key, program_id "
+        "FROM sub_account_credentials WHERE rowid > ? ORDER BY rowid;",
+        [high_water]
+    )
+    if error:
+        logger.error("🚨 ERROR sincronizando la réplica de credenciales: %s", error[0])
+        return None
+
+    rows = d1.rows(result)
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        if full:
+            # Se conservan las filas escritas (write-through) durante la consulta
+            conn.execute("DELETE FROM sub_account_credentials WHERE synced_at < ?;", [started_at])
+        conn.executemany(
+            "INSERT OR REPLACE INTO sub_account_credentials (location_id, api_key, program_id, synced_at) "
+            "VALUES (?, ?, ?, ?);",
+            [(row['location_id'], row['api_key'], row['program_id'], now) for row in rows]
+        )
+        if rows:
+            high_water = max(high_water, max(int(row['row_version']) for row in rows))
+        _set_meta(conn, 'high_water', high_water)
+        _set_meta(conn, 'last_full_sync' if full else 'last_incremental_sync', now)
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+
+    if full:
+        _ready.set()
+    return [row['location_id'] for row in rows]
+
+
+def _sync_loop(on_change):
+    cycle = 0
+    while True:
+        full = cycle % CREDENTIAL_REPLICA_FULL_SYNC_EVERY == 0
+        try:
+            # Si otro worker ya sincronizó hace poco, este ciclo se omite
+            last = _get_meta(_db(), 'last_full_sync' if full else 'last_incremental_sync')
+            if time.time() - last >= CREDENTIAL_REPLICA_SYNC_INTERVAL / 2:
+                changed = sync(full=full)
+                if changed and on_change:
+                    on_change(changed)
+            elif full:
+                _ready.set()
+        except Exception as e:
+            logger.exception("💥 Error inesperado en la sincronización de credenciales: %s", e)
+        cycle += 1
+        time.sleep(CREDENTIAL_REPLICA_SYNC_INTERVAL)
+
+
+def start_sync(on_change=None):
+    """
+    Arranca (una vez por proceso) el hilo que carga y mantiene la réplica.
+    `on_change` recibe la lista de location_id que trajo cada sincronización.
+    """
+    global _sync_thread
+    with _sync_lock:
+        if _sync_thread is not None or not is_enabled():
+            return
+        _sync_thread = threading.Thread(
+            target=_sync_loop, args=(on_change,), name="credential-replica-sync", daemon=True
+        )
+        _sync_thread.start()
+
+
+def stats():
+    conn = _db()
+    count = conn.execute("SELECT COUNT(*) FROM sub_account_credentials;").fetchone()[0]
+    now = time.time()
+    last_sync = max(_get_meta(conn, 'last_full_sync'), _get_meta(conn, 'last_incremental_sync'))
+    return {
+        "mode": CREDENTIAL_REPLICA_MODE,
+        "rows": count,
+        "ready": is_ready(),
+        "last_sync_age_seconds": round(now - last_sync, 1) if last_sync else None,
+    }
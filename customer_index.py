@@ -0,0 +1,232 @@
+# customer_index.py
+# Índice local (locationId, contactId de GHL o email) -> (programId, customerId de SmartPasses).
+#
+# create_customer devolvía la respuesta de SmartPasses y la olvidaba, así que
+# cualquier operación posterior sobre el cliente (puntos, consultas, webhooks de
+# actualización) tenía que buscarlo antes por email. El índice se llena al crear
+# clientes y con los webhooks de contactos; para los clientes que ya existían se
+# carga con el backfill:
+#
+#   python customer_index.py backfill [--location LOCATION_ID ...] [--page-size 100]
+
+import argparse
+import json
+import logging
+import os
+import time
+
+import requests
+
+import d1
+import http_client
+from local_db import get_connection
+
+logger = logging.getLogger(__name__)
+
+# URL base de la API de SmartPasses
+SMARTPASSES_API_BASE_URL = os.environ.get('SMARTPASSES_API_BASE_URL', "https://pass.smartpasses.io/api/v1/loyalty")
+CUSTOMER_INDEX_PAGE_SIZE = int(os.environ.get('CUSTOMER_INDEX_PAGE_SIZE', 100))
+
+DB_NAME = 'customer_index'
+
+# Tipos de clave que apuntan a un cliente
+CONTACT = 'contact'
+EMAIL = 'email'
+
+_schema_ready = False
+
+
+def _db():
+    global _schema_ready
+    conn = get_connection(DB_NAME)
+    if not _schema_ready:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS customer_index (
+                location_id TEXT NOT NULL,
+                key_type TEXT NOT NULL,
+                key TEXT NOT NULL,
+                program_id TEXT NOT NULL,
+                customer_id TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (location_id, key_type, key)
+            );
+            CREATE INDEX IF NOT EXISTS idx_customer_index_customer
+                ON customer_index (location_id, customer_id);
+        """)
+        _schema_ready = True
+    return conn
+
+
+def _keys(contact_id=None, email=None):
+    keys = []
+    if contact_id:
+        keys.append((CONTACT, str(contact_id)))
+    if email:
+        keys.append((EMAIL, email.strip().lower()))
+    return keys
+
+
+def record(location_id, program_id, customer_id, contact_id=None, email=None):
+    """
+    Guarda (o actualiza) las claves del cliente. Si cambia su email, la clave del
+    email anterior se elimina para que no apunte a un cliente equivocado.
+    """
+    keys = _keys(contact_id, email)
+    if not location_id or not customer_id or not keys:
+        return
+    conn = _db()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        if email:
+            conn.execute(
+                "DELETE FROM customer_index WHERE location_id = ? AND customer_id = ? AND key_type = ? AND key != ?;",
+                [location_id, str(customer_id), EMAIL, email.strip().lower()]
+            )
+        conn.executemany(
+            "INSERT OR REPLACE INTO customer_index (location_id, key_type, key, program_id, customer_id, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?);",
+            [(location_id, key_type, key, str(program_id), str(customer_id), now) for key_type, key in keys]
+        )
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+
+
+def lookup(location_id, contact_id=None, email=None, since=0):
+    """
+    Cliente de SmartPasses para el contacto: {"program_id", "customer_id"} o None.
+    Se busca primero por contactId y después por email; con `since` solo cuentan
+    las claves registradas desde ese instante.
+    """
+    conn = _db()
+    for key_type, key in _keys(contact_id, email):
+        row = conn.execute(
+            "SELECT program_id, customer_id FROM customer_index "
+            "WHERE location_id = ? AND key_type = ? AND key = ? AND updated_at >= ?;",
+            [location_id, key_type, key, since]
+        ).fetchone()
+        if row is not None:
+            return {"program_id": row['program_id'], "customer_id": row['customer_id']}
+    return None
+
+
+def link(location_id, contact_id=None, email=None):
+    """
+    Completa las claves de un cliente ya indexado (p. ej. un webhook trae el
+    contactId de un cliente que solo conocíamos por email). Devuelve el cliente o None.
+    """
+    customer = lookup(location_id, contact_id, email)
+    if customer is not None:
+        record(location_id, customer['program_id'], customer['customer_id'], contact_id, email)
+    return customer
+
+
+def forget(location_id, contact_id=None, email=None):
+    """Elimina todas las claves del cliente al que apunta el contacto."""
+    customer = lookup(location_id, contact_id, email)
+    if customer is None:
+        return
+    _db().execute(
+        "DELETE FROM customer_index WHERE location_id = ? AND customer_id = ?;",
+        [location_id, customer['customer_id']]
+    )
+
+
+def stats():
+    row = _db().execute(
+        "SELECT COUNT(*) AS keys, COUNT(DISTINCT location_id || ':' || customer_id) AS customers FROM customer_index;"
+    ).fetchone()
+    return {"keys": row['keys'], "customers": row['customers']}
+
+
+# -----------------------------------------------------------------------------
+# BACKFILL DESDE SMARTPASSES
+# -----------------------------------------------------------------------------
+
+def iter_customer_pages(smartpasses_api_key, program_id, page_size=CUSTOMER_INDEX_PAGE_SIZE, start_page=1):
+    """
+    Recorre los clientes del programa página a página: genera (número de página,
+    clientes), con una sola página en memoria. Lanza requests.exceptions.RequestException
+    si la API falla.
+    """
+    url = f"{SMARTPASSES_API_BASE_URL}/programs/{program_id}/customers"
+    headers = {"Authorization": smartpasses_api_key}
+    page = start_page
+    while True:
+        response = http_client.get(url, params={"page": page, "limit": page_size}, headers=headers)
+        response.raise_for_status()
+        body = response.json()
+        customers = body.get('data', []) if isinstance(body, dict) else body
+        if not isinstance(customers, list):
+            return
+        yield page, customers
+        if len(customers) < page_size:
+            return
+        page += 1
+
+
+def iter_customers(smartpasses_api_key, program_id, page_size=CUSTOMER_INDEX_PAGE_SIZE):
+    """Clientes del programa uno a uno (ver iter_customer_pages)."""
+    for _, customers in iter_customer_pages(smartpasses_api_key, program_id, page_size):
+        yield from customers
+
+
+def backfill_location(location_id, smartpasses_api_key, program_id, page_size=CUSTOMER_INDEX_PAGE_SIZE):
+    """Indexa por email los clientes existentes del programa. Devuelve cuántos se indexaron."""
+    indexed = 0
+    for customer in iter_customers(smartpasses_api_key, program_id, page_size):
+        customer_id = customer.get('id')
+        email = customer.get('email')
+        if customer_id and email:
+            record(location_id, program_id, customer_id, email=email)
+            indexed += 1
+    return indexed
+
+
+def _configured_locations(location_ids=None):
+    """{location_id: credenciales} de las sub-cuentas indicadas, o de todas."""
+    if location_ids:
+        return d1.fetch_credentials(location_ids)
+    result, error = d1.query("SELECT location_id, api_key, program_id FROM sub_account_credentials;")
+    if error:
+        return None, error
+    return {row['location_id']: d1.credentials_from_row(row) for row in d1.rows(result)}, None
+
+
+def backfill(location_ids=None, page_size=CUSTOMER_INDEX_PAGE_SIZE):
+    """Backfill de varias sub-cuentas. Devuelve {location_id: indexados | "error: ..."}."""
+    locations, error = _configured_locations(location_ids)
+    if error:
+        raise RuntimeError(f"No se pudieron leer las credenciales desde D1: {error[0]}")
+
+    report = {}
+    for location_id, credentials in locations.items():
+        try:
+            report[location_id] = backfill_location(
+                location_id, credentials['smartpasses_api_key'], credentials['default_program_id'], page_size
+            )
+            logger.info("📇 Backfill de %s: %s clientes indexados", location_id, report[location_id])
+        except requests.exceptions.RequestException as e:
+            logger.error("❌ Backfill de %s falló: %s", location_id, e)
+            report[location_id] = f"error: {e}"
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Índice local de clientes de SmartPasses por contacto de GHL")
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = subcommands.add_parser('backfill', help="indexa los clientes que ya existen en SmartPasses")
+    backfill_parser.add_argument('--location', action='append', dest='locations',
+                                 help="locationId a indexar (se puede repetir; por defecto todas)")
+    backfill_parser.add_argument('--page-size', type=int, default=CUSTOMER_INDEX_PAGE_SIZE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'backfill':
+        print(json.dumps(backfill(args.locations, args.page_size), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
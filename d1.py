@@ -0,0 +1,232 @@
+# d1.py
+# Acceso a Cloudflare D1 a través de su API REST.
+#
+# Reemplaza las dos copias de query_d1 que vivían en actions/customer.py y
+# settings_handler.py. Además de la consulta simple ofrece:
+#   - batch(): varias sentencias en una sola petición HTTPS ({"batch": [...]})
+#   - fetch_credentials(): credenciales de muchas sub-cuentas con IN (...)
+#   - write(): búfer de escritura que agrupa las escrituras pequeñas concurrentes
+#     y las envía juntas cuando se llena o pasa D1_WRITE_FLUSH_MS
+#
+# Todas las funciones devuelven (resultado, error) con error = (mensaje, status),
+# igual que el antiguo query_d1.
+
+import functools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import requests
+
+import http_client
+from circuit_breaker import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# URL base de la API de Cloudflare (configurable para pruebas de carga locales)
+CF_API_BASE_URL = os.environ.get('CF_API_BASE_URL', "https://api.cloudflare.com")
+
+# Sentencias por petición y parámetros por sentencia (límite de D1: 100 por consulta)
+D1_BATCH_MAX_STATEMENTS = int(os.environ.get('D1_BATCH_MAX_STATEMENTS', 50))
+D1_MAX_BOUND_PARAMS = 100
+# Búfer de escritura: se envía al juntar D1_WRITE_BUFFER_SIZE sentencias o tras D1_WRITE_FLUSH_MS
+D1_WRITE_BUFFER_SIZE = int(os.environ.get('D1_WRITE_BUFFER_SIZE', 20))
+D1_WRITE_FLUSH_MS = float(os.environ.get('D1_WRITE_FLUSH_MS', 20))
+D1_WRITE_TIMEOUT = float(os.environ.get('D1_WRITE_TIMEOUT', 30))
+
+CREDENTIALS_SQL = "SELECT api_key, program_id FROM sub_account_credentials WHERE location_id = ?;"
+CREDENTIALS_IN_SQL = "SELECT location_id, api_key, program_id FROM sub_account_credentials WHERE location_id IN ({});"
+
+
+@functools.lru_cache(maxsize=256)
+def prepare(sql):
+    """
+    Texto SQL normalizado (espacios colapsados) y si es de solo lectura. Se cachea
+    por texto, así las sentencias que se repiten no se vuelven a procesar.
+    """
+    normalized = " ".join(sql.split())
+    return normalized, normalized.upper().startswith('SELECT')
+
+
+@functools.lru_cache(maxsize=128)
+def in_clause_sql(template, count):
+    """Sentencia con `count` marcadores en su IN ({}), cacheada por tamaño."""
+    return prepare(template.format(", ".join("?" * count)))[0]
+
+
+def build_request(statements):
+    """
+    Arma la URL, cabeceras y cuerpo para una o varias sentencias [(sql, params), ...].
+    Devuelve (url, headers, data, None) o (None, None, None, error).
+    """
+    account_id = os.environ.get('CF_ACCOUNT_ID')
+    db_id = os.environ.get('CF_D1_DATABASE_ID')
+    api_token = os.environ.get('CF_API_TOKEN')
+
+    if not all([account_id, db_id, api_token]):
+        logger.error("🚨 ERROR: Faltan secretos de Cloudflare (CF_ACCOUNT_ID, CF_D1_DATABASE_ID, CF_API_TOKEN).")
+        return None, None, None, ("Faltan secretos de configuración del servidor.", 500)
+
+    url = f"{CF_API_BASE_URL}/client/v4/accounts/{account_id}/d1/database/{db_id}/query"
+    headers = {"Authorization": f"Bearer {api_token}", "Content-Type": "application/json"}
+    bodies = [{"sql": prepare(sql)[0], "params": list(params)} for sql, params in statements]
+    data = bodies[0] if len(bodies) == 1 else {"batch": bodies}
+    return url, headers, data, None
+
+
+def is_read_only(statements):
+    return all(prepare(sql)[1] for sql, _ in statements)
+
+
+def _post(statements):
+    url, headers, data, error = build_request(statements)
+    if error:
+        return None, error
+
+    # Las lecturas se pueden reintentar sin riesgo aunque D1 use POST
+    try:
+        response = http_client.post(url, headers=headers, json=data, idempotent=is_read_only(statements))
+        response.raise_for_status()
+        return response.json(), None
+    except requests.exceptions.HTTPError as err:
+        logger.error("Error en la API de D1: %s", err.response.text[:500])
+        return None, (err.response.text, err.response.status_code)
+    except CircuitOpenError as err:
+        # D1 está degradado: se falla de inmediato sin ocupar el worker
+        logger.warning("%s", err)
+        return None, (str(err), 503)
+    except requests.exceptions.RequestException as err:
+        logger.error("Error de conexión con la API de D1: %s", err)
+        return None, (str(err), 502)
+
+
+def query(sql, params=()):
+    """Ejecuta una sentencia. Devuelve (respuesta JSON de D1, error)."""
+    return _post([(sql, params)])
+
+
+def batch(statements):
+    """
+    Ejecuta varias sentencias [(sql, params), ...] en el menor número de peticiones.
+    Devuelve (lista de filas por sentencia, error). Si un grupo falla, se devuelve su error.
+    """
+    results = []
+    for start in range(0, len(statements), D1_BATCH_MAX_STATEMENTS):
+        chunk = statements[start:start + D1_BATCH_MAX_STATEMENTS]
+        response, error = _post(chunk)
+        if error:
+            return None, error
+        results.extend(statement_rows(response, len(chunk)))
+    return results, None
+
+
+def rows(result):
+    """Extrae las filas de una respuesta de la API de D1 (todas las sentencias juntas)."""
+    if not result:
+        return []
+    if 'results' in result:
+        return result['results'] or []
+    # Formato de la API REST: {"result": [{"results": [...]}]}
+    return [row for statement in result.get('result') or [] for row in statement.get('results') or []]
+
+
+def statement_rows(result, count):
+    """Filas de cada sentencia de una respuesta, en orden (una lista por sentencia)."""
+    statements = (result or {}).get('result') or []
+    per_statement = [statement.get('results') or [] for statement in statements]
+    return per_statement + [[] for _ in range(count - len(per_statement))]
+
+
+def credentials_from_row(row):
+    return {"smartpasses_api_key": row['api_key'], "default_program_id": row['program_id']}
+
+
+def fetch_credentials(location_ids):
+    """
+    Credenciales de muchas sub-cuentas con sentencias IN (...) de hasta 100
+    parámetros, todas en la misma petición. Devuelve ({location_id: credenciales}, error);
+    las sub-cuentas sin configurar no aparecen en el diccionario.
+    """
+    location_ids = list(dict.fromkeys(location_ids))
+    statements = [
+        (in_clause_sql(CREDENTIALS_IN_SQL, len(chunk)), chunk)
+        for chunk in (location_ids[i:i + D1_MAX_BOUND_PARAMS] for i in range(0, len(location_ids), D1_MAX_BOUND_PARAMS))
+    ]
+    if not statements:
+        return {}, None
+    results, error = batch(statements)
+    if error:
+        return None, error
+    return {row['location_id']: credentials_from_row(row) for chunk in results for row in chunk}, None
+
+
+class WriteBuffer:
+    """
+    Agrupa escrituras concurrentes. Quien escribe recibe un Future con (filas, error)
+    de su sentencia; el hilo de envío manda el grupo en una sola petición batch.
+    """
+
+    def __init__(self, max_size=D1_WRITE_BUFFER_SIZE, flush_ms=D1_WRITE_FLUSH_MS):
+        self.max_size = max_size
+        self.flush_seconds = flush_ms / 1000
+        self._pending = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self.flushes = 0
+        self.statements = 0
+
+    def submit(self, sql, params=()):
+        future = Future()
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="d1-write-buffer", daemon=True)
+                self._thread.start()
+            self._pending.append((sql, list(params), future, time.monotonic()))
+            self._condition.notify()
+        return future
+
+    def _take(self):
+        with self._condition:
+            while True:
+                if not self._pending:
+                    self._condition.wait()
+                    continue
+                wait = self._pending[0][3] + self.flush_seconds - time.monotonic()
+                if len(self._pending) >= self.max_size or wait <= 0:
+                    taken, self._pending = self._pending[:self.max_size], self._pending[self.max_size:]
+                    return taken
+                self._condition.wait(wait)
+
+    def _run(self):
+        while True:
+            taken = self._take()
+            try:
+                results, error = batch([(sql, params) for sql, params, _, _ in taken])
+            except Exception as e:
+                logger.exception("💥 Error inesperado enviando escrituras a D1: %s", e)
+                results, error = None, (str(e), 500)
+            self.flushes += 1
+            self.statements += len(taken)
+            for index, (_, _, future, _) in enumerate(taken):
+                future.set_result((None, error) if error else (results[index], None))
+
+    def stats(self):
+        with self._condition:
+            pending = len(self._pending)
+        return {"pending": pending, "flushes": self.flushes, "statements": self.statements}
+
+
+write_buffer = WriteBuffer()
+
+
+def write(sql, params=(), timeout=D1_WRITE_TIMEOUT):
+    """
+    Escritura agrupada con las demás que lleguen en la misma ventana. Espera a que
+    D1 confirme y devuelve (filas, error) como query().
+    """
+    try:
+        return write_buffer.submit(sql, params).result(timeout=timeout)
+    except FutureTimeoutError:
+        return None, ("Tiempo de espera agotado escribiendo en D1.", 504)
@@ -0,0 +1,191 @@
+# fair_scheduler.py
+# Reparto justo (ponderado) de las llamadas salientes a SmartPasses entre sub-cuentas.
+#
+# Cada worker admite como máximo SMARTPASSES_MAX_CONCURRENCY llamadas a la vez.
+# Mientras haya huecos, las llamadas pasan sin esperar; cuando se llenan, las
+# que esperan se atienden por etiqueta de tiempo virtual (start-time fair
+# queuing): cada llamada de una sub-cuenta suma 1/peso a la etiqueta de esa
+# sub-cuenta, así una carga masiva de una agencia se intercala con las llamadas
+# de las demás en lugar de ir delante de todas. El peso sale del nivel de la
+# sub-cuenta (location_limits.RATE_LIMIT_TIERS). En modo ASGI, async_slot() usa
+# el mismo planificador y espera en hilos aparte para no bloquear el event loop.
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+
+import requests
+
+import metrics
+from location_limits import tier_for, weight_for
+
+logger = logging.getLogger(__name__)
+
+SMARTPASSES_MAX_CONCURRENCY = int(os.environ.get('SMARTPASSES_MAX_CONCURRENCY', 8))
+SMARTPASSES_SLOT_TIMEOUT = float(os.environ.get('SMARTPASSES_SLOT_TIMEOUT', 30))
+
+# Se olvidan las etiquetas de sub-cuentas inactivas al superar este número
+MAX_TRACKED_KEYS = 1000
+
+# Hilos que esperan un hueco en nombre de las rutas asíncronas
+MAX_ASYNC_WAITERS = 64
+
+SLOT_WAIT = metrics.histogram(
+    'bridge_smartpasses_slot_wait_seconds', "Espera por un hueco de llamada a SmartPasses",
+    labels=('tier',),
+)
+
+
+class SlotTimeout(requests.exceptions.ConnectionError):
+    """
+    No se obtuvo hueco a tiempo. Hereda de ConnectionError para que los manejadores
+    de requests.exceptions.RequestException lo traten como un upstream saturado.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Sin hueco para llamar a SmartPasses; reintentar en {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class FairScheduler:
+    """Semáforo de `max_concurrency` huecos que atiende a los que esperan por etiqueta."""
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = []          # heap de (etiqueta, secuencia, ticket)
+        self._live = 0              # tickets en espera no cancelados
+        self._finish = {}           # clave -> etiqueta final de su última llamada
+        self._virtual = 0.0         # etiqueta de inicio de la última llamada atendida
+        self._sequence = itertools.count()
+        self.granted = 0
+        self.queued = 0
+        self.timeouts = 0
+
+    def _start_tag(self, key, weight):
+        # Una sub-cuenta que estuvo inactiva empieza en el tiempo virtual actual, sin crédito acumulado
+        start = max(self._virtual, self._finish.get(key, 0.0))
+        self._finish[key] = start + 1.0 / weight
+        if len(self._finish) > MAX_TRACKED_KEYS:
+            self._finish = {k: v for k, v in self._finish.items() if v > self._virtual}
+        return start
+
+    def try_acquire(self, key, weight=1.0):
+        """Toma un hueco solo si hay uno libre y nadie espera. Devuelve True si lo tomó."""
+        with self._cond:
+            if self._active >= self.max_concurrency or self._live:
+                return False
+            self._virtual = max(self._virtual, self._start_tag(key, weight))
+            self._active += 1
+            self.granted += 1
+            return True
+
+    def acquire(self, key, weight=1.0, timeout=None):
+        """Espera un hueco. Devuelve los segundos esperados o lanza SlotTimeout."""
+        started = time.monotonic()
+        with self._cond:
+            tag = self._start_tag(key, weight)
+            if self._active < self.max_concurrency and not self._live:
+                self._virtual = max(self._virtual, tag)
+                self._active += 1
+                self.granted += 1
+                return 0.0
+
+            ticket = {"granted": False, "cancelled": False}
+            heapq.heappush(self._waiting, (tag, next(self._sequence), ticket))
+            self._live += 1
+            self.queued += 1
+            self._dispatch()
+            deadline = None if timeout is None else started + timeout
+            while not ticket["granted"]:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    ticket["cancelled"] = True
+                    self._live -= 1
+                    self.timeouts += 1
+                    raise SlotTimeout(timeout)
+                self._cond.wait(remaining)
+            return time.monotonic() - started
+
+    def _dispatch(self):
+        """Entrega los huecos libres a los tickets con menor etiqueta (con el lock tomado)."""
+        woke = False
+        while self._waiting and self._active < self.max_concurrency:
+            tag, _, ticket = heapq.heappop(self._waiting)
+            if ticket["cancelled"]:
+                continue
+            ticket["granted"] = True
+            self._live -= 1
+            self._virtual = max(self._virtual, tag)
+            self._active += 1
+            self.granted += 1
+            woke = True
+        if woke:
+            self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._dispatch()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "active": self._active,
+                "waiting": self._live,
+                "max_concurrency": self.max_concurrency,
+                "granted": self.granted,
+                "queued": self.queued,
+                "timeouts": self.timeouts,
+            }
+
+
+smartpasses_scheduler = FairScheduler(SMARTPASSES_MAX_CONCURRENCY)
+
+_async_waiters = ThreadPoolExecutor(max_workers=MAX_ASYNC_WAITERS, thread_name_prefix="slot-wait")
+
+
+@contextmanager
+def slot(location_id, timeout=SMARTPASSES_SLOT_TIMEOUT):
+    """Ocupa un hueco de llamada a SmartPasses en nombre de la sub-cuenta."""
+    key = location_id or ''
+    waited = smartpasses_scheduler.acquire(key, weight_for(key), timeout)
+    SLOT_WAIT.observe(waited, tier_for(key))
+    try:
+        yield
+    finally:
+        smartpasses_scheduler.release()
+
+
+@asynccontextmanager
+async def async_slot(location_id, timeout=SMARTPASSES_SLOT_TIMEOUT):
+    """Igual que slot() para las rutas asíncronas: si hay que esperar, espera en un hilo."""
+    key = location_id or ''
+    weight = weight_for(key)
+    waited = 0.0
+    if not smartpasses_scheduler.try_acquire(key, weight):
+        future = asyncio.get_running_loop().run_in_executor(
+            _async_waiters, smartpasses_scheduler.acquire, key, weight, timeout)
+        try:
+            waited = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # El cliente se fue: el hueco que llegue después se devuelve en cuanto llegue
+            future.add_done_callback(
+                lambda f: f.cancelled() or f.exception() or smartpasses_scheduler.release())
+            raise
+    SLOT_WAIT.observe(waited, tier_for(key))
+    try:
+        yield
+    finally:
+        smartpasses_scheduler.release()
+
+
+def stats():
+    return smartpasses_scheduler.stats()
@@ -0,0 +1,169 @@
+# http_client.py
+# Cliente HTTP compartido con conexiones persistentes (keep-alive) por host.
+# Todas las llamadas salientes (Cloudflare D1, SmartPasses, GHL) pasan por aquí
+# para que cada worker de gunicorn reutilice conexiones TLS ya abiertas.
+
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from circuit_breaker import BREAKER_ENABLED, get_breaker, is_failure
+from single_flight import get_group
+
+# Configuración por variables de entorno
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 15))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 2))
+HTTP_BACKOFF_FACTOR = float(os.environ.get('HTTP_BACKOFF_FACTOR', 0.3))
+
+# Métodos que se pueden reintentar sin efectos secundarios
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+# Códigos de estado transitorios que justifican un reintento
+RETRY_STATUS_CODES = frozenset([429, 502, 503, 504])
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _host_key(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def get_session(url):
+    """
+    Devuelve la sesión asociada al host de la URL, creándola la primera vez.
+    Cada host tiene su propio pool de conexiones keep-alive.
+    """
+    key = _host_key(url)
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            # Los reintentos se gestionan en request() para poder aplicarlos
+            # también a POST idempotentes (por ejemplo, SELECT en D1).
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+            session.mount(key, adapter)
+            _sessions[key] = session
+    return session
+
+
+def request(method, url, idempotent=None, timeout=None, **kwargs):
+    """
+    Ejecuta una petición HTTP usando el pool del host correspondiente.
+    Si la llamada es idempotente, se reintenta con backoff exponencial ante
+    errores de conexión, timeouts y respuestas 429/502/503/504.
+    Si el circuito del host está abierto lanza circuit_breaker.CircuitOpenError
+    sin llegar a conectar.
+    """
+    method = method.upper()
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+    session = get_session(url)
+    attempts = 1 + (HTTP_MAX_RETRIES if idempotent else 0)
+
+    host = urlsplit(url).netloc
+    breaker = get_breaker(host) if BREAKER_ENABLED else None
+
+    for attempt in range(attempts):
+        last_attempt = attempt == attempts - 1
+        if breaker is not None:
+            breaker.check()
+        started = time.perf_counter()
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            elapsed = time.perf_counter() - started
+            metrics.observe_upstream(host, method, 'error', elapsed)
+            if breaker is not None:
+                breaker.record(False, elapsed)
+            if last_attempt:
+                raise
+        except BaseException:
+            # Cualquier otro error (ChunkedEncodingError, TooManyRedirects...) también cuenta
+            # como fallo: si era la sonda de medio abierto, el circuito no queda bloqueado
+            if breaker is not None:
+                breaker.record(False, time.perf_counter() - started)
+            raise
+        else:
+            elapsed = time.perf_counter() - started
+            metrics.observe_upstream(host, method, response.status_code, elapsed)
+            if breaker is not None:
+                breaker.record(not is_failure(response.status_code), elapsed)
+            if last_attempt or response.status_code not in RETRY_STATUS_CODES:
+                return response
+            response.close()
+        time.sleep(HTTP_BACKOFF_FACTOR * (2 ** attempt))
+
+
+def preconnect(url, connections=1, timeout=None):
+    """
+    Abre `connections` conexiones keep-alive con el host de la URL (un HEAD en
+    paralelo por conexión) para que las primeras peticiones reales no paguen el
+    handshake TCP/TLS. Devuelve cuántas quedaron abiertas.
+    """
+    session = get_session(url)
+    base_url = _host_key(url) + "/"
+    timeout = timeout or (HTTP_CONNECT_TIMEOUT, HTTP_CONNECT_TIMEOUT)
+    opened = []
+
+    def open_one():
+        try:
+            # Cualquier respuesta (incluso 404) deja la conexión en el pool
+            session.head(base_url, timeout=timeout, allow_redirects=False).close()
+            opened.append(True)
+        except requests.exceptions.RequestException:
+            pass
+
+    threads = [threading.Thread(target=open_one, daemon=True) for _ in range(min(connections, HTTP_POOL_SIZE))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(opened)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def coalesced_get(url, params=None, headers=None, **kwargs):
+    """
+    GET de solo lectura unificado: peticiones concurrentes a la misma URL, con los
+    mismos parámetros y las mismas cabeceras, comparten una sola llamada al upstream.
+    """
+    headers = headers or {}
+    key = (url, tuple(sorted((params or {}).items())), tuple(sorted(headers.items())))
+
+    def fetch():
+        response = request('GET', url, params=params, headers=headers, **kwargs)
+        # Se lee el cuerpo ahora para que todos los que esperan puedan usarlo
+        response.content
+        return response
+
+    return get_group(f"GET {_host_key(url)}").do(key, fetch)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
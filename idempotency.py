@@ -0,0 +1,191 @@
+# idempotency.py
+# Almacén de idempotencia para las acciones de GHL (create_customer, send_push).
+#
+# GHL reintenta las acciones de workflow cuando vencen sus timeouts. Cada petición
+# se identifica con una huella: la cabecera Idempotency-Key, el id de ejecución
+# de GHL o, si no vienen, un hash de (acción, location, datos). La primera
+# petición se ejecuta y su respuesta se guarda durante IDEMPOTENCY_TTL; los
+# reintentos reciben esa respuesta sin tocar D1 ni SmartPasses, y los que llegan
+# mientras la original sigue en curso esperan su resultado.
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import time
+
+from flask import make_response, request
+
+from local_db import get_connection
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_ENABLED = os.environ.get('IDEMPOTENCY_ENABLED', 'true').lower() == 'true'
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 3600))
+IDEMPOTENCY_LEASE = float(os.environ.get('IDEMPOTENCY_LEASE', 60))
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.environ.get('IDEMPOTENCY_WAIT_TIMEOUT', 30))
+IDEMPOTENCY_POLL_INTERVAL = 0.05
+
+# Campos donde GHL puede enviar el identificador de la ejecución del workflow
+EXECUTION_ID_FIELDS = ('executionId', 'workflowExecutionId', 'execution_id')
+
+DB_NAME = 'idempotency'
+
+_schema_ready = False
+_operations = 0
+
+
+class IdempotencyConflict(Exception):
+    """La petición original sigue en curso y se agotó la espera."""
+
+
+def _db():
+    global _schema_ready
+    conn = get_connection(DB_NAME)
+    if not _schema_ready:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                status_code INTEGER,
+                mimetype TEXT,
+                body BLOB,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency_keys (expires_at);
+        """)
+        _schema_ready = True
+    return conn
+
+
+def fingerprint(action, ghl_data, headers, body_fallback=True):
+    """
+    Clave de idempotencia de una petición. Sin clave explícita se usa el hash del
+    cuerpo, salvo con body_fallback=False, en cuyo caso devuelve None.
+    """
+    explicit = headers.get('Idempotency-Key')
+    location_id = ''
+    if isinstance(ghl_data, dict):
+        location_id = ghl_data.get('locationId') or ghl_data.get('location_id') or ''
+    if not explicit and isinstance(ghl_data, dict):
+        extras = ghl_data.get('extras') if isinstance(ghl_data.get('extras'), dict) else {}
+        for field in EXECUTION_ID_FIELDS:
+            explicit = ghl_data.get(field) or extras.get(field)
+            if explicit:
+                break
+    if explicit:
+        # La clave la elige cada sub-cuenta: dos sub-cuentas pueden repetir el mismo valor
+        raw = f"{action}\x1fid\x1f{location_id}\x1f{explicit}"
+    elif not body_fallback:
+        return None
+    else:
+        raw = f"{action}\x1fbody\x1f{json.dumps(ghl_data, sort_keys=True, separators=(',', ':'))}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _purge_expired(conn, now):
+    # Limpieza ocasional para que la tabla no crezca sin límite
+    global _operations
+    _operations += 1
+    if _operations % 200 == 0:
+        conn.execute("DELETE FROM idempotency_keys WHERE expires_at < ?;", [now])
+
+
+def acquire(key):
+    """
+    Devuelve la respuesta guardada {status_code, mimetype, body} si la petición ya
+    se completó, o None si esta petición es la que debe ejecutarse.
+    Si otra petición con la misma clave está en curso, espera a que termine.
+    """
+    conn = _db()
+    deadline = time.time() + IDEMPOTENCY_WAIT_TIMEOUT
+    while True:
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            row = conn.execute(
+                "SELECT status, status_code, mimetype, body, expires_at FROM idempotency_keys WHERE key = ?;",
+                [key]
+            ).fetchone()
+            if row is None or row['expires_at'] <= now:
+                conn.execute(
+                    "INSERT OR REPLACE INTO idempotency_keys (key, status, expires_at) VALUES (?, 'in_progress', ?);",
+                    [key, now + IDEMPOTENCY_LEASE]
+                )
+                _purge_expired(conn, now)
+            conn.execute("COMMIT;")
+        except Exception:
+            conn.execute("ROLLBACK;")
+            raise
+
+        if row is None or row['expires_at'] <= now:
+            return None
+        if row['status'] == 'done':
+            return {"status_code": row['status_code'], "mimetype": row['mimetype'], "body": row['body']}
+        if now > deadline:
+            raise IdempotencyConflict(key)
+        time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+
+def complete(key, status_code, mimetype, body):
+    """Guarda la respuesta final para servir los reintentos."""
+    _db().execute(
+        "UPDATE idempotency_keys SET status = 'done', status_code = ?, mimetype = ?, body = ?, expires_at = ? "
+        "WHERE key = ?;",
+        [status_code, mimetype, body, time.time() + IDEMPOTENCY_TTL, key]
+    )
+
+
+def release(key):
+    """Libera la clave sin guardar nada (respuesta no definitiva: el reintento debe ejecutarse de nuevo)."""
+    _db().execute("DELETE FROM idempotency_keys WHERE key = ? AND status = 'in_progress';", [key])
+
+
+def is_final(status_code):
+    # Un 4xx (p. ej. sub-cuenta sin configurar o 401 de SmartPasses) puede dejar de
+    # serlo cuando se corrige la configuración: solo se guardan éxitos y conflictos
+    return 200 <= status_code < 300 or status_code == 409
+
+
+def idempotent(action, body_fallback=True):
+    """
+    Decorador para rutas de acciones de GHL. Solo se guardan las respuestas
+    definitivas (2xx y 409), así un error se puede reintentar.
+    Con body_fallback=False solo se deduplican las peticiones con clave explícita
+    (para acciones donde dos triggers idénticos son legítimos, como sumar puntos).
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not IDEMPOTENCY_ENABLED:
+                return view(*args, **kwargs)
+
+            key = fingerprint(action, request.get_json(silent=True), request.headers, body_fallback)
+            if key is None:
+                return view(*args, **kwargs)
+            try:
+                cached = acquire(key)
+            except IdempotencyConflict:
+                return {"error": "Una petición idéntica sigue en proceso. Intente de nuevo."}, 409
+
+            if cached is not None:
+                logger.info("♻️ Respuesta idempotente reutilizada para %s.", action)
+                response = make_response(cached['body'], cached['status_code'])
+                response.mimetype = cached['mimetype']
+                response.headers['Idempotent-Replay'] = 'true'
+                return response
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                release(key)
+                raise
+
+            if is_final(response.status_code) and not response.is_streamed:
+                complete(key, response.status_code, response.mimetype, response.get_data())
+            else:
+                release(key)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,38 @@
+# local_db.py
+# Utilidades para las bases SQLite locales que viven en el directorio instance/.
+
+import os
+import sqlite3
+import threading
+
+INSTANCE_DIR = os.environ.get(
+    'LOCAL_DB_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
+)
+
+_local = threading.local()
+
+
+def db_path(name):
+    """Ruta del archivo SQLite para un almacén local (p. ej. 'webhook_queue')."""
+    return os.path.join(INSTANCE_DIR, f"{name}.db")
+
+
+def get_connection(name):
+    """
+    Devuelve una conexión SQLite propia del hilo actual.
+    Se usa WAL para que varios workers de gunicorn puedan leer mientras otro escribe.
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(name)
+    if conn is None:
+        os.makedirs(INSTANCE_DIR, exist_ok=True)
+        conn = sqlite3.connect(db_path(name), timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        connections[name] = conn
+    return conn
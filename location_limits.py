@@ -0,0 +1,123 @@
+# location_limits.py
+# Límites por sub-cuenta (locationId) en la entrada, con niveles configurables.
+#
+# Todas las sub-cuentas comparten los mismos workers: una agencia que lanza un
+# workflow enorme contra /actions/create_customer o /actions/send_push no debe
+# dejar sin servicio a las demás. Cada locationId tiene un token bucket según su
+# nivel; al agotarlo la petición recibe 429 + Retry-After (GHL la reintenta).
+#
+# Niveles (RATE_LIMIT_TIERS): nombre=peticiones_por_segundo:ráfaga:peso
+#   default=5:20:1,premium=20:60:4
+# El peso lo usa fair_scheduler para repartir las llamadas a SmartPasses.
+# Asignación (RATE_LIMIT_LOCATION_TIERS): locationId=nivel,otroId=nivel
+# Los límites son por worker, igual que los de admission.py.
+
+import logging
+import os
+
+from flask import jsonify, request
+
+import metrics
+from rate_limit import get_bucket
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_TIERS = os.environ.get('RATE_LIMIT_TIERS', 'default=5:20:1,premium=20:60:4')
+RATE_LIMIT_LOCATION_TIERS = os.environ.get('RATE_LIMIT_LOCATION_TIERS', '')
+
+# Rutas con locationId que consumen SmartPasses o D1
+LIMITED_PREFIXES = ('/actions/', '/offer/')
+
+THROTTLED_MESSAGE = "Demasiadas peticiones para esta sub-cuenta, intente más tarde."
+
+THROTTLED = metrics.counter(
+    'bridge_location_throttled_total', "Peticiones rechazadas por el límite de su sub-cuenta",
+    labels=('tier', 'route'),
+)
+
+
+def parse_tiers(spec):
+    """'default=5:20:1,premium=20:60:4' -> {nivel: (rate, burst, weight)}."""
+    tiers = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        try:
+            name, values = item.split('=', 1)
+            rate, burst, weight = (list(map(float, values.split(':'))) + [None, None])[:3]
+            tiers[name.strip()] = (rate, burst if burst is not None else max(rate, 1), weight or 1.0)
+        except ValueError:
+            logger.warning("Nivel de límite inválido en RATE_LIMIT_TIERS: %s", item)
+    tiers.setdefault('default', (5.0, 20.0, 1.0))
+    return tiers
+
+
+def parse_assignments(spec):
+    """'locA=premium,locB=premium' -> {locationId: nivel}."""
+    pairs = (part.split('=', 1) for part in spec.split(',') if '=' in part)
+    return {location_id.strip(): tier.strip() for location_id, tier in pairs}
+
+
+TIERS = parse_tiers(RATE_LIMIT_TIERS)
+LOCATION_TIERS = parse_assignments(RATE_LIMIT_LOCATION_TIERS)
+
+
+def tier_for(location_id):
+    tier = LOCATION_TIERS.get(location_id, 'default')
+    return tier if tier in TIERS else 'default'
+
+
+def weight_for(location_id):
+    return TIERS[tier_for(location_id)][2]
+
+
+def request_location_id():
+    """El mismo locationId que usa get_agency_credentials (cuerpo JSON o query string)."""
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        location_id = data.get('locationId') or data.get('location_id')
+        if location_id:
+            return location_id
+    return request.args.get('locationId')
+
+
+def check(location_id):
+    """Consume un token de la sub-cuenta. Devuelve 0 o los segundos hasta el siguiente."""
+    rate, burst, _ = TIERS[tier_for(location_id)]
+    return get_bucket(f"ingress:{location_id}", rate, burst).try_acquire()
+
+
+def throttle(location_id, route):
+    """
+    Aplica el límite de la sub-cuenta a una petición de `route`. Devuelve 0 si pasa
+    o los segundos para el Retry-After del 429 (ya contada en THROTTLED).
+    """
+    wait = check(location_id)
+    if not wait:
+        return 0
+    tier = tier_for(location_id)
+    THROTTLED.inc(tier, route)
+    logger.info("⏳ Límite de la sub-cuenta %s (%s) alcanzado en %s", location_id, tier, route)
+    return max(1, int(wait + 0.999))
+
+
+def _limit():
+    if request.method == 'OPTIONS' or not request.path.startswith(LIMITED_PREFIXES):
+        return None
+    location_id = request_location_id()
+    if not location_id:
+        return None
+
+    retry_after = throttle(location_id, request.url_rule.rule if request.url_rule else 'unmatched')
+    if not retry_after:
+        return None
+    response = jsonify({"error": THROTTLED_MESSAGE})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def init_app(app):
+    """Registra el límite de entrada por sub-cuenta en la app."""
+    if not RATE_LIMIT_ENABLED:
+        return
+    app.before_request(_limit)
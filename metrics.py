@@ -0,0 +1,231 @@
+# metrics.py
+# Métricas en memoria (contadores e histogramas) con salida en formato de texto de
+# Prometheus para el endpoint /metrics.
+#
+# Cada petición acumula el tiempo por etapa (credential_lookup, upstream,
+# serialization) en flask.g, y al terminar se vuelca a los histogramas. Las rutas
+# nativas de asgi.py no tienen flask.g: acumulan sus etapas en una ContextVar.
+# Las métricas son por proceso: con varios workers de gunicorn, cada scrape
+# ve el worker que atendió la petición (los gauges llevan la etiqueta `pid`).
+
+import contextvars
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+from flask.json.provider import DefaultJSONProvider
+
+# Límites de los buckets en segundos
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = list(self._values.items())
+        for label_values, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(key, (list(s[0]), s[1], s[2])) for key, s in self._series.items()]
+        for label_values, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels + ('le',), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total:.6f}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+_metrics = []
+_collectors = []
+
+
+def counter(name, help_text, labels=()):
+    metric = Counter(name, help_text, labels)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+    metric = Histogram(name, help_text, labels, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def register_collector(fn):
+    """
+    Registra una función que devuelve [(nombre, {etiquetas}, valor), ...] con
+    valores instantáneos (gauges), p. ej. el tamaño de la caché o de una cola.
+    """
+    _collectors.append(fn)
+    return fn
+
+
+# Etapas de la petición asíncrona en curso (asgi.py); None fuera de ellas
+_async_stage_times = contextvars.ContextVar('async_stage_times', default=None)
+
+REQUEST_DURATION = histogram(
+    'bridge_request_duration_seconds', 'Duración total de las peticiones por ruta.',
+    labels=('route', 'method', 'status')
+)
+STAGE_DURATION = histogram(
+    'bridge_stage_duration_seconds', 'Tiempo por etapa dentro de cada petición.',
+    labels=('route', 'stage')
+)
+UPSTREAM_DURATION = histogram(
+    'bridge_upstream_request_duration_seconds', 'Duración de las llamadas HTTP salientes.',
+    labels=('host', 'method', 'status')
+)
+
+
+def add_stage_time(stage, seconds):
+    """Suma tiempo a una etapa de la petición en curso (si hay una)."""
+    if has_request_context():
+        stages = g.setdefault('stage_times', {})
+    else:
+        stages = _async_stage_times.get()
+        if stages is None:
+            return
+    stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def stage(name):
+    """
+    Mide un bloque como etapa de la petición en curso. Las llamadas upstream
+    hechas dentro del bloque cuentan para esta etapa y no para 'upstream'.
+    """
+    if not has_request_context() or g.get('active_stage'):
+        yield
+        return
+    g.active_stage = name
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.active_stage = None
+        add_stage_time(name, time.perf_counter() - start)
+
+
+def observe_upstream(host, method, status, seconds):
+    UPSTREAM_DURATION.observe(seconds, host, method, status)
+    if not has_request_context() or not g.get('active_stage'):
+        add_stage_time('upstream', seconds)
+
+
+def start_request():
+    g.request_started = time.perf_counter()
+    g.stage_times = {}
+
+
+def finish_request(route, method, status):
+    """Vuelca la duración total y las etapas de la petición a los histogramas."""
+    started = g.get('request_started')
+    if started is None:
+        return
+    _observe_request(route, method, status, time.perf_counter() - started, g.get('stage_times') or {})
+
+
+def start_async_request():
+    """start_request para las rutas nativas de asgi.py, que no tienen contexto de Flask."""
+    stages = {}
+    _async_stage_times.set(stages)
+    return stages
+
+
+def finish_async_request(route, method, status, total):
+    stages = _async_stage_times.get() or {}
+    _observe_request(route, method, status, total, stages)
+
+
+def _observe_request(route, method, status, total, stages):
+    REQUEST_DURATION.observe(total, route, method, status)
+    for name, seconds in stages.items():
+        STAGE_DURATION.observe(seconds, route, name)
+    # Lo que no es D1, upstream ni serialización es código propio
+    STAGE_DURATION.observe(max(total - sum(stages.values()), 0.0), route, 'app')
+
+
+def render():
+    """Texto completo para /metrics."""
+    pid = os.getpid()
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        try:
+            samples = collector()
+        except Exception as e:
+            lines.append(f"# collector {getattr(collector, '__name__', collector)} falló: {e}")
+            continue
+        for name, labels, value in samples:
+            labels = dict(labels, pid=pid)
+            lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Proveedor JSON de Flask que mide la (de)serialización como etapa 'serialization'."""
+
+    def dumps(self, obj, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            add_stage_time('serialization', time.perf_counter() - start)
+
+    def loads(self, s, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().loads(s, **kwargs)
+        finally:
+            add_stage_time('serialization', time.perf_counter() - start)
@@ -0,0 +1,296 @@
+# points_accumulator.py
+# Acumulador de puntos y sellos por cliente con diario persistente.
+#
+# Los workflows de GHL disparan /actions/add_points y /actions/add_stamp en
+# ráfagas (varios triggers por compra). Cada trigger se escribe primero en el
+# diario (instance/points_journal.db) y recibe su propio id; los hilos de este
+# módulo esperan POINTS_COMBINE_WINDOW_MS y envían todos los incrementos
+# pendientes del mismo cliente en UNA sola llamada a SmartPasses. Cada trigger
+# queda marcado con el resultado de esa llamada, así su respuesta (o la consulta
+# /actions/add_points/<trigger_id>) refleja el saldo final.
+#
+# Si un worker muere, los incrementos siguen en el diario: los que estaban en
+# envío se vuelven a tomar cuando vence su lease (POINTS_LEASE).
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from local_db import get_connection
+from push_dispatcher import RetryLater
+
+logger = logging.getLogger(__name__)
+
+POINTS_WORKERS = int(os.environ.get('POINTS_WORKERS', 1))
+POINTS_COMBINE_WINDOW_MS = float(os.environ.get('POINTS_COMBINE_WINDOW_MS', 250))
+POINTS_ACK_TIMEOUT = float(os.environ.get('POINTS_ACK_TIMEOUT', 3))
+POINTS_MAX_ATTEMPTS = int(os.environ.get('POINTS_MAX_ATTEMPTS', 5))
+POINTS_RETRY_DELAY = float(os.environ.get('POINTS_RETRY_DELAY', 2))
+POINTS_LEASE = float(os.environ.get('POINTS_LEASE', 60))
+POINTS_JOURNAL_TTL = float(os.environ.get('POINTS_JOURNAL_TTL', 86400))
+# Si el lote lo aplica otro worker no llega el aviso en memoria: se relee el diario con esta frecuencia
+POINTS_RECHECK_INTERVAL = 0.5
+
+# Tipos de incremento y el campo que se envía a SmartPasses
+KINDS = ('points', 'stamps')
+
+DB_NAME = 'points_journal'
+
+_wakeup = threading.Event()
+_waiters = {}                   # trigger_id -> Event de las peticiones que esperan su resultado
+_waiters_lock = threading.Lock()
+_workers = []
+_workers_lock = threading.Lock()
+_schema_ready = False
+
+
+def _db():
+    global _schema_ready
+    conn = get_connection(DB_NAME)
+    if not _schema_ready:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS points_journal (
+                id TEXT PRIMARY KEY,
+                location_id TEXT,
+                program_id TEXT NOT NULL,
+                customer_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                amount INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                batch_id TEXT,
+                result TEXT,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_points_journal_pending
+                ON points_journal (status, available_at);
+            CREATE INDEX IF NOT EXISTS idx_points_journal_customer
+                ON points_journal (program_id, customer_id, kind, status);
+            CREATE INDEX IF NOT EXISTS idx_points_journal_batch
+                ON points_journal (batch_id);
+        """)
+        _schema_ready = True
+    return conn
+
+
+def submit(location_id, program_id, customer_id, kind, amount):
+    """Registra el incremento en el diario y devuelve el id del trigger."""
+    trigger_id = uuid.uuid4().hex
+    now = time.time()
+    _db().execute(
+        "INSERT INTO points_journal (id, location_id, program_id, customer_id, kind, amount, available_at, created_at, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);",
+        [trigger_id, location_id, str(program_id), str(customer_id), kind, int(amount),
+         now + POINTS_COMBINE_WINDOW_MS / 1000, now, now]
+    )
+    _wakeup.set()
+    return trigger_id
+
+
+def get_trigger(trigger_id):
+    """Estado de un trigger con el resultado de la llamada combinada, o None si no existe."""
+    row = _db().execute(
+        "SELECT id, location_id, program_id, customer_id, kind, amount, status, attempts, batch_id, "
+        "result, last_error, created_at, updated_at FROM points_journal WHERE id = ?;",
+        [trigger_id]
+    ).fetchone()
+    if row is None:
+        return None
+    trigger = dict(row)
+    trigger['result'] = json.loads(trigger['result']) if trigger['result'] else None
+    return trigger
+
+
+def wait(trigger_id, timeout=POINTS_ACK_TIMEOUT):
+    """
+    Espera a que el trigger se aplique o falle. Devuelve su estado (puede seguir
+    'queued'). El worker de este proceso avisa al terminar el lote; como el lote
+    puede aplicarlo otro worker, además se relee el diario cada POINTS_RECHECK_INTERVAL.
+    """
+    event = threading.Event()
+    with _waiters_lock:
+        _waiters[trigger_id] = event
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            trigger = get_trigger(trigger_id)
+            remaining = deadline - time.monotonic()
+            if trigger is None or trigger['status'] in ('applied', 'failed') or remaining <= 0:
+                return trigger
+            event.wait(min(remaining, POINTS_RECHECK_INTERVAL))
+    finally:
+        with _waiters_lock:
+            _waiters.pop(trigger_id, None)
+
+
+def _claim():
+    """
+    Toma el cliente con el incremento pendiente más antiguo y todos sus
+    incrementos en cola del mismo tipo. Un lote cuyo envío quedó a medias (lease
+    vencido) se retoma tal cual, con el mismo batch_id y sin sumarle incrementos
+    nuevos, para que el reenvío lleve la misma clave de idempotencia.
+    Devuelve el lote o None.
+    """
+    conn = _db()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        head = conn.execute(
+            "SELECT location_id, program_id, customer_id, kind, status, batch_id FROM points_journal "
+            "WHERE status IN ('queued', 'sending') AND available_at <= ? ORDER BY available_at LIMIT 1;",
+            [now]
+        ).fetchone()
+        if head is None:
+            conn.execute("COMMIT;")
+            return None
+
+        if head['status'] == 'sending':
+            batch_id = head['batch_id']
+            rows = conn.execute(
+                "SELECT id, amount, attempts FROM points_journal WHERE batch_id = ? AND status = 'sending';",
+                [batch_id]
+            ).fetchall()
+        else:
+            batch_id = uuid.uuid4().hex
+            rows = conn.execute(
+                "SELECT id, amount, attempts FROM points_journal "
+                "WHERE program_id = ? AND customer_id = ? AND kind = ? AND status = 'queued';",
+                [head['program_id'], head['customer_id'], head['kind']]
+            ).fetchall()
+        ids = [row['id'] for row in rows]
+        conn.execute(
+            f"UPDATE points_journal SET status = 'sending', batch_id = ?, available_at = ?, updated_at = ? "
+            f"WHERE id IN ({', '.join('?' * len(ids))});",
+            [batch_id, now + POINTS_LEASE, now] + ids
+        )
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+
+    return {
+        "batch_id": batch_id,
+        "location_id": head['location_id'],
+        "program_id": head['program_id'],
+        "customer_id": head['customer_id'],
+        "kind": head['kind'],
+        "amount": sum(row['amount'] for row in rows),
+        "triggers": len(rows),
+        "attempts": max(row['attempts'] for row in rows) + 1,
+    }
+
+
+def _finish(batch_id, **fields):
+    fields['updated_at'] = time.time()
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    conn = _db()
+    conn.execute(f"UPDATE points_journal SET {assignments} WHERE batch_id = ?;", list(fields.values()) + [batch_id])
+    if fields.get('status') in ('applied', 'failed') and _waiters:
+        ids = [row['id'] for row in conn.execute("SELECT id FROM points_journal WHERE batch_id = ?;", [batch_id])]
+        with _waiters_lock:
+            for trigger_id in ids:
+                event = _waiters.get(trigger_id)
+                if event is not None:
+                    event.set()
+
+
+def _retry_later(batch, error):
+    """Deja el lote para otro intento con espera exponencial, o lo da por fallido al agotarlos."""
+    if batch['attempts'] >= POINTS_MAX_ATTEMPTS:
+        _finish(batch['batch_id'], status='failed', attempts=batch['attempts'], last_error=str(error))
+    else:
+        # Sigue en 'sending': el reintento retoma el mismo lote con la misma clave de idempotencia
+        delay = POINTS_RETRY_DELAY * (2 ** (batch['attempts'] - 1))
+        _finish(batch['batch_id'], status='sending', attempts=batch['attempts'], last_error=str(error),
+                available_at=time.time() + delay)
+
+
+def _process(batch, resolve_api_key, send):
+    try:
+        api_key, error = resolve_api_key(batch['location_id'])
+    except RetryLater as e:
+        # D1 no respondió: los puntos siguen pendientes, no se descartan
+        _retry_later(batch, e)
+        return
+    if error:
+        _finish(batch['batch_id'], status='failed', last_error=error)
+        return
+
+    try:
+        # El batch_id viaja como clave de idempotencia por si el lote se reenvía tras una caída
+        customer = send(api_key, batch['program_id'], batch['customer_id'], batch['kind'],
+                        batch['amount'], batch['batch_id'], batch['location_id'])
+    except RetryLater as e:
+        _retry_later(batch, e)
+        return
+    except Exception as e:
+        _finish(batch['batch_id'], status='failed', attempts=batch['attempts'], last_error=str(e))
+        logger.warning("❌ %s para el cliente %s fallaron: %s", batch['kind'], batch['customer_id'], e)
+        return
+
+    result = {"combined_triggers": batch['triggers'], "combined_amount": batch['amount'], "customer": customer}
+    _finish(batch['batch_id'], status='applied', attempts=batch['attempts'], last_error=None,
+            result=json.dumps(result))
+    logger.info("✅ %s %s aplicados al cliente %s (%s triggers)",
+                batch['amount'], batch['kind'], batch['customer_id'], batch['triggers'])
+
+
+def _purge():
+    _db().execute(
+        "DELETE FROM points_journal WHERE status IN ('applied', 'failed') AND updated_at < ?;",
+        [time.time() - POINTS_JOURNAL_TTL]
+    )
+
+
+def _worker_loop(resolve_api_key, send):
+    last_purge = 0.0
+    while True:
+        try:
+            batch = _claim()
+            if time.monotonic() - last_purge > 3600:
+                _purge()
+                last_purge = time.monotonic()
+        except Exception as e:
+            logger.exception("💥 Error leyendo el diario de puntos: %s", e)
+            time.sleep(1)
+            continue
+
+        if batch is None:
+            # Se revisa al menos una vez por ventana para respetar la espera de combinación
+            _wakeup.wait(POINTS_COMBINE_WINDOW_MS / 1000)
+            _wakeup.clear()
+            continue
+
+        try:
+            _process(batch, resolve_api_key, send)
+        except Exception as e:
+            logger.exception("💥 Error inesperado aplicando el lote %s: %s", batch['batch_id'], e)
+
+
+def start_workers(resolve_api_key, send):
+    """
+    Arranca los hilos que vacían el diario (una sola vez por proceso).
+    - resolve_api_key(location_id) -> (api_key, error); lanza RetryLater si el error es transitorio.
+    - send(api_key, program_id, customer_id, kind, amount, batch_id, location_id) -> cliente
+      actualizado; lanza RetryLater ante errores transitorios.
+    """
+    with _workers_lock:
+        if _workers:
+            return
+        for i in range(POINTS_WORKERS):
+            thread = threading.Thread(
+                target=_worker_loop, args=(resolve_api_key, send), name=f"points-worker-{i}", daemon=True
+            )
+            thread.start()
+            _workers.append(thread)
+
+
+def stats():
+    rows = _db().execute("SELECT status, COUNT(*) AS total FROM points_journal GROUP BY status;").fetchall()
+    return {row['status']: row['total'] for row in rows}
@@ -0,0 +1,267 @@
+# profiler.py
+# Perfilado bajo demanda y registro de peticiones lentas.
+#
+# - Muestreo: durante N segundos un hilo toma la pila de cada hilo del proceso
+#   cada PROFILER_INTERVAL_MS y cuenta las pilas en formato "collapsed"
+#   (marco;marco;marco cuenta), compatible con flamegraph.pl y speedscope. No
+#   cuesta nada mientras no está activo. Se activa con:
+#     GET /admin/profile?seconds=10   (Authorization: Bearer $PROFILER_TOKEN)
+#     kill -USR2 <pid del worker>     (con PROFILER_SIGNAL=true; se guarda en
+#                                      instance/profiles/)
+# - Peticiones lentas: un hilo vigía revisa las peticiones en curso y, a las que
+#   superan SLOW_REQUEST_MS, les toma la pila cada PROFILER_INTERVAL_MS. Al
+#   terminar, la petición queda en un buffer circular de SLOW_REQUEST_BUFFER
+#   entradas con su duración, sus etapas (metrics) y sus pilas:
+#     GET /admin/slow_requests         (Authorization: Bearer $PROFILER_TOKEN)
+#   Las rutas nativas de asgi.py también se registran, pero sin pilas: corren en
+#   el event loop y no en un hilo propio que el vigía pueda muestrear.
+#
+# Todo es por proceso: con varios workers, cada petición ve el worker que la atendió.
+
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+from flask import Response, g, request
+
+logger = logging.getLogger(__name__)
+
+PROFILER_TOKEN = os.environ.get('PROFILER_TOKEN')
+PROFILER_SIGNAL = os.environ.get('PROFILER_SIGNAL', 'false').lower() == 'true'
+PROFILER_SIGNAL_SECONDS = float(os.environ.get('PROFILER_SIGNAL_SECONDS', 30))
+PROFILER_INTERVAL_MS = float(os.environ.get('PROFILER_INTERVAL_MS', 10))
+PROFILER_MAX_SECONDS = float(os.environ.get('PROFILER_MAX_SECONDS', 60))
+PROFILER_DIR = os.environ.get('PROFILER_DIR', os.path.join('instance', 'profiles'))
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 2000))
+SLOW_REQUEST_BUFFER = int(os.environ.get('SLOW_REQUEST_BUFFER', 50))
+
+# Pilas distintas que se guardan por petición lenta
+SLOW_REQUEST_MAX_STACKS = 20
+# Sin peticiones lentas en curso, el vigía revisa con esta frecuencia
+SLOW_REQUEST_CHECK_INTERVAL = 0.1
+
+# Los endpoints de administración no se perfilan a sí mismos
+ADMIN_PREFIX = '/admin/'
+
+_profile_lock = threading.Lock()
+_in_flight = {}                 # ident del hilo -> petición en curso
+_in_flight_lock = threading.Lock()
+_slow_requests = deque(maxlen=SLOW_REQUEST_BUFFER)
+_watchdog = None
+_watchdog_lock = threading.Lock()
+_own_threads = set()
+
+
+def _frame_name(code):
+    path = code.co_filename.replace('\\', '/').rsplit('/', 2)
+    return f"{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+
+
+def collapse(frame, root=None):
+    """Pila del frame en formato collapsed, de la raíz al frame actual."""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    if root:
+        names.append(root)
+    return ";".join(reversed(names))
+
+
+def sample(seconds, interval=None):
+    """
+    Muestrea todos los hilos del proceso durante `seconds` (bloquea al que llama).
+    Devuelve un Counter {pila collapsed: muestras}. Lanza RuntimeError si ya hay
+    un perfilado en curso.
+    """
+    interval = (interval or PROFILER_INTERVAL_MS) / 1000
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("Ya hay un perfilado en curso en este worker.")
+    try:
+        own = threading.get_ident()
+        names = {}
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frames = sys._current_frames()
+            if len(names) != len(frames):
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == own or ident in _own_threads:
+                    continue
+                stacks[collapse(frame, names.get(ident, str(ident)))] += 1
+            del frames
+            time.sleep(interval)
+        return stacks
+    finally:
+        _profile_lock.release()
+
+
+def render_collapsed(stacks):
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def _profile_to_file(seconds):
+    try:
+        stacks = sample(seconds)
+    except RuntimeError as e:
+        logger.warning("Perfilado por señal ignorado: %s", e)
+        return
+    os.makedirs(PROFILER_DIR, exist_ok=True)
+    path = os.path.join(PROFILER_DIR, f"profile-{os.getpid()}-{int(time.time())}.collapsed")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(render_collapsed(stacks))
+    logger.info("🔥 Perfil de %ss guardado en %s (%s muestras)", seconds, path, sum(stacks.values()))
+
+
+def _on_signal(signum, frame):
+    # El manejador corre en el hilo principal: el muestreo va en su propio hilo
+    threading.Thread(target=_profile_to_file, args=(PROFILER_SIGNAL_SECONDS,),
+                     name="profiler-signal", daemon=True).start()
+
+
+# -----------------------------------------------------------------------------
+# PETICIONES LENTAS
+# -----------------------------------------------------------------------------
+
+def _start_request():
+    if request.path.startswith(ADMIN_PREFIX):
+        return
+    entry = {"started": time.perf_counter(), "stacks": Counter()}
+    g.profiler_entry = entry
+    with _in_flight_lock:
+        _in_flight[threading.get_ident()] = entry
+
+
+def _finish_request(response):
+    entry = g.pop('profiler_entry', None)
+    if entry is None:
+        return response
+    with _in_flight_lock:
+        _in_flight.pop(threading.get_ident(), None)
+        stacks = dict(entry['stacks'].most_common(SLOW_REQUEST_MAX_STACKS))
+    record_request(request.method, request.url_rule.rule if request.url_rule else 'unmatched', request.path,
+                   response.status_code, time.perf_counter() - entry['started'], g.get('stage_times'), stacks)
+    return response
+
+
+def record_request(method, route, path, status, seconds, stage_times=None, stacks=None):
+    """
+    Guarda la petición en el buffer si superó SLOW_REQUEST_MS. Las rutas nativas de
+    asgi.py la llaman directamente; como no ocupan un hilo, llegan sin pilas.
+    """
+    duration_ms = seconds * 1000
+    if SLOW_REQUEST_MS <= 0 or duration_ms < SLOW_REQUEST_MS:
+        return
+    _slow_requests.append({
+        "at": time.time(),
+        "method": method,
+        "route": route,
+        "path": path,
+        "status": status,
+        "duration_ms": round(duration_ms, 1),
+        "stages_ms": {name: round(value * 1000, 1) for name, value in (stage_times or {}).items()},
+        "stacks": stacks or {},
+    })
+
+
+def _discard_request(exc=None):
+    # Si la respuesta no llegó a after_request (error no manejado), el hilo deja de vigilarse
+    with _in_flight_lock:
+        _in_flight.pop(threading.get_ident(), None)
+
+
+def _watchdog_loop():
+    interval = PROFILER_INTERVAL_MS / 1000
+    threshold = SLOW_REQUEST_MS / 1000
+    slow = []
+    while True:
+        # Solo se muestrea a ritmo de PROFILER_INTERVAL_MS mientras haya peticiones lentas
+        time.sleep(interval if slow else SLOW_REQUEST_CHECK_INTERVAL)
+        try:
+            now = time.perf_counter()
+            with _in_flight_lock:
+                slow = [(ident, entry) for ident, entry in _in_flight.items() if now - entry['started'] >= threshold]
+            if not slow:
+                continue
+            frames = sys._current_frames()
+            stacks = [(ident, entry, collapse(frames[ident])) for ident, entry in slow if ident in frames]
+            del frames
+            with _in_flight_lock:
+                # La petición pudo terminar mientras se tomaba la pila
+                for ident, entry, stack in stacks:
+                    if _in_flight.get(ident) is entry:
+                        entry['stacks'][stack] += 1
+        except Exception as e:
+            logger.exception("💥 Error en el vigía de peticiones lentas: %s", e)
+
+
+def _start_watchdog():
+    global _watchdog
+    with _watchdog_lock:
+        if _watchdog is not None:
+            return
+        _watchdog = threading.Thread(target=_watchdog_loop, name="slow-request-watchdog", daemon=True)
+        _watchdog.start()
+        _own_threads.add(_watchdog.ident)
+
+
+def slow_requests():
+    """Peticiones lentas recientes, de la más nueva a la más antigua."""
+    return list(reversed(_slow_requests))
+
+
+# -----------------------------------------------------------------------------
+# ENDPOINTS
+# -----------------------------------------------------------------------------
+
+def _authorized():
+    return bool(PROFILER_TOKEN) and request.headers.get('Authorization') == f"Bearer {PROFILER_TOKEN}"
+
+
+def profile_endpoint():
+    if not _authorized():
+        return {"error": "No autorizado."}, 401
+    try:
+        seconds = float(request.args.get('seconds', 10))
+    except ValueError:
+        return {"error": "'seconds' debe ser un número."}, 400
+    seconds = min(max(seconds, 0.1), PROFILER_MAX_SECONDS)
+    try:
+        stacks = sample(seconds)
+    except RuntimeError as e:
+        return {"error": str(e)}, 409
+    return Response(render_collapsed(stacks), mimetype='text/plain')
+
+
+def slow_requests_endpoint():
+    if not _authorized():
+        return {"error": "No autorizado."}, 401
+    return {"threshold_ms": SLOW_REQUEST_MS, "pid": os.getpid(), "requests": slow_requests()}, 200
+
+
+def init_app(app):
+    """Registra los endpoints de perfilado, el registro de peticiones lentas y la señal."""
+    app.add_url_rule('/admin/profile', 'admin_profile', profile_endpoint)
+    app.add_url_rule('/admin/slow_requests', 'admin_slow_requests', slow_requests_endpoint)
+    if SLOW_REQUEST_MS > 0 and SLOW_REQUEST_BUFFER > 0:
+        app.before_request(_start_request)
+        app.after_request(_finish_request)
+        app.teardown_request(_discard_request)
+        _start_watchdog()
+    if PROFILER_SIGNAL:
+        try:
+            signal.signal(signal.SIGUSR2, _on_signal)
+        except ValueError:
+            # signal.signal solo funciona desde el hilo principal
+            logger.warning("No se pudo registrar SIGUSR2 para el perfilado (no es el hilo principal).")
+
+
+def stats():
+    with _in_flight_lock:
+        in_flight = len(_in_flight)
+    return {"slow_requests": len(_slow_requests), "in_flight": in_flight, "profiling": int(_profile_lock.locked())}
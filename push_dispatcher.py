@@ -0,0 +1,263 @@
+# push_dispatcher.py
+# Despacho asíncrono de notificaciones push (broadcast) a SmartPasses.
+#
+# /actions/send_push solo encola el trabajo y devuelve su id. Los hilos de este
+# módulo lo envían respetando un token bucket por programa/API key; si el bucket
+# no tiene tokens, el trabajo se reprograma en vez de bloquear al hilo, así un
+# programa muy activo no frena a los demás. Los mensajes idénticos dentro de la
+# ventana de deduplicación reutilizan el trabajo existente.
+#
+# Los buckets viven en memoria de cada proceso: con varios workers de gunicorn,
+# el ritmo por programa (PUSH_RATE_PER_PROGRAM) se multiplica por el número de
+# workers. Los trabajos terminados se borran pasado PUSH_JOB_TTL.
+
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+
+import requests
+
+from local_db import get_connection
+from rate_limit import get_bucket
+
+logger = logging.getLogger(__name__)
+
+PUSH_WORKERS = int(os.environ.get('PUSH_WORKERS', 2))
+PUSH_RATE_PER_PROGRAM = float(os.environ.get('PUSH_RATE_PER_PROGRAM', 1))
+PUSH_BURST_PER_PROGRAM = float(os.environ.get('PUSH_BURST_PER_PROGRAM', 3))
+PUSH_DEDUPE_WINDOW = float(os.environ.get('PUSH_DEDUPE_WINDOW', 300))
+PUSH_MAX_ATTEMPTS = int(os.environ.get('PUSH_MAX_ATTEMPTS', 5))
+PUSH_RETRY_DELAY = float(os.environ.get('PUSH_RETRY_DELAY', 5))
+PUSH_LEASE = float(os.environ.get('PUSH_LEASE', 120))
+PUSH_POLL_INTERVAL = float(os.environ.get('PUSH_POLL_INTERVAL', 1))
+PUSH_JOB_TTL = float(os.environ.get('PUSH_JOB_TTL', 86400))
+
+# Respuestas de SmartPasses que vale la pena reintentar
+RETRYABLE_STATUS_CODES = frozenset([429, 502, 503, 504])
+
+DB_NAME = 'push_jobs'
+
+_wakeup = threading.Event()
+_workers = []
+_workers_lock = threading.Lock()
+_schema_ready = False
+
+
+class RetryLater(Exception):
+    """Error transitorio: el trabajo se vuelve a intentar más tarde."""
+
+
+def _db():
+    global _schema_ready
+    conn = get_connection(DB_NAME)
+    if not _schema_ready:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS push_jobs (
+                id TEXT PRIMARY KEY,
+                location_id TEXT,
+                program_id TEXT NOT NULL,
+                message TEXT NOT NULL,
+                dedupe_key TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                sent_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_push_jobs_pending
+                ON push_jobs (status, available_at);
+            CREATE INDEX IF NOT EXISTS idx_push_jobs_dedupe
+                ON push_jobs (dedupe_key, created_at);
+        """)
+        _schema_ready = True
+    return conn
+
+
+def _dedupe_key(location_id, program_id, message):
+    raw = f"{location_id or ''}\x1f{program_id}\x1f{message}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def submit(location_id, program_id, message):
+    """
+    Encola un broadcast. Devuelve (job_id, deduplicated): si el mismo mensaje
+    para el mismo programa ya se encoló dentro de la ventana, se devuelve ese id.
+    """
+    conn = _db()
+    now = time.time()
+    dedupe_key = _dedupe_key(location_id, program_id, message)
+
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        row = conn.execute(
+            "SELECT id FROM push_jobs WHERE dedupe_key = ? AND created_at > ? AND status != 'failed' "
+            "ORDER BY created_at DESC LIMIT 1;",
+            [dedupe_key, now - PUSH_DEDUPE_WINDOW]
+        ).fetchone()
+        if row is not None:
+            conn.execute("COMMIT;")
+            return row['id'], True
+
+        job_id = uuid.uuid4().hex
+        conn.execute(
+            "INSERT INTO push_jobs (id, location_id, program_id, message, dedupe_key, available_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+            [job_id, location_id, program_id, message, dedupe_key, now, now, now]
+        )
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+
+    _wakeup.set()
+    return job_id, False
+
+
+def get_job(job_id):
+    """Estado de un trabajo para el endpoint de progreso, o None si no existe."""
+    row = _db().execute(
+        "SELECT id, location_id, program_id, status, attempts, last_error, created_at, updated_at, sent_at "
+        "FROM push_jobs WHERE id = ?;",
+        [job_id]
+    ).fetchone()
+    return dict(row) if row is not None else None
+
+
+def _claim():
+    conn = _db()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        row = conn.execute(
+            "SELECT id, location_id, program_id, message, attempts FROM push_jobs "
+            "WHERE status IN ('queued', 'sending') AND available_at <= ? ORDER BY available_at LIMIT 1;",
+            [now]
+        ).fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE push_jobs SET status = 'sending', available_at = ?, updated_at = ? WHERE id = ?;",
+                [now + PUSH_LEASE, now, row['id']]
+            )
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+    return row
+
+
+def _update(job_id, **fields):
+    fields['updated_at'] = time.time()
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    _db().execute(f"UPDATE push_jobs SET {assignments} WHERE id = ?;", list(fields.values()) + [job_id])
+
+
+def _retry_later(job, attempts, error):
+    """Reprograma el trabajo con espera exponencial, o lo da por fallido al agotar los intentos."""
+    if attempts >= PUSH_MAX_ATTEMPTS:
+        _update(job['id'], status='failed', attempts=attempts, last_error=str(error))
+    else:
+        delay = PUSH_RETRY_DELAY * (2 ** (attempts - 1))
+        _update(job['id'], status='queued', attempts=attempts, last_error=str(error),
+                available_at=time.time() + delay)
+
+
+def _process(job, resolve_api_key, send):
+    try:
+        api_key, error = resolve_api_key(job['location_id'])
+    except RetryLater as e:
+        # D1 no respondió: no es un problema del trabajo, se reintenta como un envío fallido
+        _retry_later(job, job['attempts'] + 1, e)
+        return
+    if error:
+        _update(job['id'], status='failed', last_error=error)
+        return
+
+    # Límite por programa y API key. Sin tokens, se reprograma sin gastar un intento.
+    bucket = get_bucket(f"push:{api_key}:{job['program_id']}", PUSH_RATE_PER_PROGRAM, PUSH_BURST_PER_PROGRAM)
+    wait = bucket.try_acquire()
+    if wait:
+        _update(job['id'], status='queued', available_at=time.time() + wait)
+        return
+
+    attempts = job['attempts'] + 1
+    try:
+        send(api_key, job['program_id'], job['message'], job['location_id'])
+    except RetryLater as e:
+        _retry_later(job, attempts, e)
+        return
+    except Exception as e:
+        _update(job['id'], status='failed', attempts=attempts, last_error=str(e))
+        logger.warning("❌ Push %s falló: %s", job['id'], e)
+        return
+
+    _update(job['id'], status='sent', attempts=attempts, last_error=None, sent_at=time.time())
+    logger.info("✅ Push %s enviado al programa %s.", job['id'], job['program_id'])
+
+
+def _purge():
+    _db().execute(
+        "DELETE FROM push_jobs WHERE status IN ('sent', 'failed') AND updated_at < ?;",
+        [time.time() - PUSH_JOB_TTL]
+    )
+
+
+def _worker_loop(resolve_api_key, send):
+    last_purge = 0.0
+    while True:
+        try:
+            job = _claim()
+            if time.monotonic() - last_purge > 3600:
+                _purge()
+                last_purge = time.monotonic()
+        except Exception as e:
+            logger.exception("💥 Error leyendo la cola de push: %s", e)
+            time.sleep(PUSH_POLL_INTERVAL)
+            continue
+
+        if job is None:
+            _wakeup.wait(PUSH_POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+
+        try:
+            _process(job, resolve_api_key, send)
+        except Exception as e:
+            logger.exception("💥 Error inesperado procesando push %s: %s", job['id'], e)
+
+
+def start_workers(resolve_api_key, send):
+    """
+    Arranca los hilos de despacho (una sola vez por proceso).
+    - resolve_api_key(location_id) -> (api_key, error); lanza RetryLater si el error es transitorio.
+    - send(api_key, program_id, message, location_id) lanza RetryLater ante errores transitorios.
+    """
+    with _workers_lock:
+        if _workers:
+            return
+        for i in range(PUSH_WORKERS):
+            thread = threading.Thread(
+                target=_worker_loop, args=(resolve_api_key, send), name=f"push-worker-{i}", daemon=True
+            )
+            thread.start()
+            _workers.append(thread)
+
+
+def stats():
+    rows = _db().execute("SELECT status, COUNT(*) AS total FROM push_jobs GROUP BY status;").fetchall()
+    return {row['status']: row['total'] for row in rows}
+
+
+def raise_for_upstream(err):
+    """Convierte un error de requests en RetryLater si es transitorio."""
+    if isinstance(err, requests.exceptions.HTTPError):
+        if err.response.status_code in RETRYABLE_STATUS_CODES:
+            raise RetryLater(f"{err.response.status_code}: {err.response.text}") from err
+        raise err
+    if isinstance(err, requests.exceptions.ConnectionError):
+        raise RetryLater(str(err)) from err
+    raise err
@@ -0,0 +1,463 @@
+# reconcile.py
+# Reconciliación incremental de contactos de GHL con clientes de SmartPasses.
+#
+# Los webhooks se pueden perder y contact.created no crea nada, así que nada
+# garantiza que cada contacto con email tenga su cliente en SmartPasses. Por
+# cada sub-cuenta, una ejecución:
+#   1. 'ghl'   recorre los contactos de GHL página a página
+#   2. 'sp'    recorre los clientes del programa en SmartPasses página a página
+#   3. 'apply' compara ambos lados por email y aplica solo las diferencias
+#      (crear o actualizar el cliente) con concurrencia acotada
+# Cada página se guarda en tablas de trabajo de instance/reconcile.db junto con
+# el punto de control, así la memoria no depende del tamaño de la sub-cuenta y
+# una ejecución interrumpida continúa desde la última página o bloque aplicado.
+# Los clientes que solo existen en SmartPasses se cuentan pero no se borran.
+#
+#   python reconcile.py run [--location LOCATION_ID ...] [--dry-run] [--restart]
+#   python reconcile.py status
+#
+# Con RECONCILE_INTERVAL > 0 cada worker arranca un hilo que reconcilia las
+# sub-cuentas instaladas con esa frecuencia; un lease en SQLite evita que dos
+# workers reconcilien la misma sub-cuenta a la vez.
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import customer_index
+import http_client
+import token_store
+from actions.customer import (
+    create_smartpasses_customer, get_agency_credentials, index_customer, update_smartpasses_customer,
+)
+from local_db import get_connection
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL = float(os.environ.get('RECONCILE_INTERVAL', 0))
+RECONCILE_PAGE_SIZE = int(os.environ.get('RECONCILE_PAGE_SIZE', 100))
+RECONCILE_CHUNK_SIZE = int(os.environ.get('RECONCILE_CHUNK_SIZE', 100))
+RECONCILE_CONCURRENCY = int(os.environ.get('RECONCILE_CONCURRENCY', 4))
+RECONCILE_LEASE = float(os.environ.get('RECONCILE_LEASE', 300))
+RECONCILE_CHECK_INTERVAL = 60
+
+GHL_API_VERSION = '2021-07-28'
+
+# Campos que se comparan entre el contacto y el cliente
+FIELDS = ('first_name', 'last_name', 'phone')
+
+DB_NAME = 'reconcile'
+
+_schema_ready = False
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class ReconcileError(Exception):
+    """La sub-cuenta no se puede reconciliar (sin credenciales o sin token de GHL)."""
+
+
+class LeaseLost(Exception):
+    """Otro worker tomó la ejecución (el lease venció sin renovarse)."""
+
+
+def _db():
+    global _schema_ready
+    conn = get_connection(DB_NAME)
+    if not _schema_ready:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS reconcile_runs (
+                location_id TEXT PRIMARY KEY,
+                run_id TEXT NOT NULL,
+                phase TEXT NOT NULL,
+                ghl_cursor TEXT,
+                sp_page INTEGER NOT NULL DEFAULT 1,
+                apply_after TEXT NOT NULL DEFAULT '',
+                counters TEXT NOT NULL DEFAULT '{}',
+                dry_run INTEGER NOT NULL DEFAULT 0,
+                owner TEXT,
+                lease_until REAL NOT NULL DEFAULT 0,
+                started_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                finished_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS reconcile_ghl (
+                run_id TEXT NOT NULL,
+                email TEXT NOT NULL,
+                contact_id TEXT,
+                first_name TEXT NOT NULL,
+                last_name TEXT NOT NULL,
+                phone TEXT NOT NULL,
+                PRIMARY KEY (run_id, email)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS reconcile_sp (
+                run_id TEXT NOT NULL,
+                email TEXT NOT NULL,
+                customer_id TEXT NOT NULL,
+                first_name TEXT NOT NULL,
+                last_name TEXT NOT NULL,
+                phone TEXT NOT NULL,
+                PRIMARY KEY (run_id, email)
+            ) WITHOUT ROWID;
+        """)
+        _schema_ready = True
+    return conn
+
+
+def _owner():
+    return f"{os.getpid()}:{threading.get_ident()}"
+
+
+# -----------------------------------------------------------------------------
+# LECTURA PAGINADA DE AMBOS LADOS
+# -----------------------------------------------------------------------------
+
+def iter_ghl_contact_pages(location_id, access_token, cursor=None, page_size=RECONCILE_PAGE_SIZE):
+    """
+    Recorre los contactos de la sub-cuenta en GHL: genera (contactos, siguiente cursor),
+    con cursor None en la última página. Lanza requests.exceptions.RequestException.
+    """
+    url = f"{token_store.GHL_API_BASE_URL}/contacts/"
+    headers = {"Authorization": f"Bearer {access_token}", "Version": GHL_API_VERSION}
+    while True:
+        params = {"locationId": location_id, "limit": page_size}
+        params.update(cursor or {})
+        response = http_client.get(url, params=params, headers=headers)
+        response.raise_for_status()
+        body = response.json()
+        contacts = body.get('contacts') or []
+        meta = body.get('meta') or {}
+        last = len(contacts) < page_size or not meta.get('startAfterId')
+        cursor = None if last else {"startAfterId": meta['startAfterId'], "startAfter": meta.get('startAfter')}
+        yield contacts, cursor
+        if cursor is None:
+            return
+
+
+def _email(value):
+    return (value or '').strip().lower()
+
+
+def _ghl_row(run_id, contact):
+    return (run_id, _email(contact.get('email')), contact.get('id'), contact.get('firstName') or '',
+            contact.get('lastName') or '', contact.get('phone') or '')
+
+
+def _sp_row(run_id, customer):
+    return (run_id, _email(customer.get('email')), str(customer.get('id')), customer.get('firstName') or '',
+            customer.get('lastName') or '', customer.get('phone') or '')
+
+
+# -----------------------------------------------------------------------------
+# EJECUCIONES Y PUNTOS DE CONTROL
+# -----------------------------------------------------------------------------
+
+def _claim(location_id, owner, restart=False, dry_run=False):
+    """Toma (o retoma) la ejecución de la sub-cuenta. Devuelve la fila o None si otro la tiene."""
+    conn = _db()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        row = conn.execute("SELECT * FROM reconcile_runs WHERE location_id = ?;", [location_id]).fetchone()
+        if row is not None and row['lease_until'] > now and row['owner'] != owner:
+            conn.execute("COMMIT;")
+            return None
+
+        if row is None or row['phase'] == 'done' or restart or bool(row['dry_run']) != dry_run:
+            if row is not None:
+                _drop_staging(conn, row['run_id'])
+            conn.execute(
+                "INSERT OR REPLACE INTO reconcile_runs (location_id, run_id, phase, dry_run, owner, lease_until, "
+                "started_at, updated_at) VALUES (?, ?, 'ghl', ?, ?, ?, ?, ?);",
+                [location_id, uuid.uuid4().hex, int(dry_run), owner, now + RECONCILE_LEASE, now, now]
+            )
+        else:
+            conn.execute(
+                "UPDATE reconcile_runs SET owner = ?, lease_until = ?, updated_at = ? WHERE location_id = ?;",
+                [owner, now + RECONCILE_LEASE, now, location_id]
+            )
+        run = conn.execute("SELECT * FROM reconcile_runs WHERE location_id = ?;", [location_id]).fetchone()
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+    return dict(run)
+
+
+def _drop_staging(conn, run_id):
+    conn.execute("DELETE FROM reconcile_ghl WHERE run_id = ?;", [run_id])
+    conn.execute("DELETE FROM reconcile_sp WHERE run_id = ?;", [run_id])
+
+
+def _checkpoint(conn, run, counters, **fields):
+    """Guarda el avance y renueva el lease. Se llama dentro de la transacción de la página."""
+    now = time.time()
+    fields = dict({"counters": json.dumps(counters), "lease_until": now + RECONCILE_LEASE, "updated_at": now}, **fields)
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    cursor = conn.execute(
+        f"UPDATE reconcile_runs SET {assignments} WHERE location_id = ? AND run_id = ? AND owner = ?;",
+        list(fields.values()) + [run['location_id'], run['run_id'], run['owner']]
+    )
+    if cursor.rowcount != 1:
+        raise LeaseLost(f"La reconciliación de {run['location_id']} la tomó otro worker.")
+    run.update(fields)
+
+
+def _save_page(run, counters, table, rows, **fields):
+    """Inserta una página en la tabla de trabajo y guarda el punto de control en la misma transacción."""
+    conn = _db()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        if rows:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {table} (run_id, email, {'contact_id' if table == 'reconcile_ghl' else 'customer_id'}, "
+                f"first_name, last_name, phone) VALUES (?, ?, ?, ?, ?, ?);",
+                rows
+            )
+        _checkpoint(conn, run, counters, **fields)
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+
+
+def _update_run(run, counters, **fields):
+    conn = _db()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        _checkpoint(conn, run, counters, **fields)
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+
+
+# -----------------------------------------------------------------------------
+# FASES
+# -----------------------------------------------------------------------------
+
+def _fetch_ghl(run, counters, access_token):
+    cursor = json.loads(run['ghl_cursor']) if run['ghl_cursor'] else None
+    for contacts, next_cursor in iter_ghl_contact_pages(run['location_id'], access_token, cursor):
+        rows = [_ghl_row(run['run_id'], contact) for contact in contacts]
+        counters['ghl_contacts'] = counters.get('ghl_contacts', 0) + len(rows)
+        counters['skipped_no_email'] = counters.get('skipped_no_email', 0) + sum(1 for row in rows if not row[1])
+        _save_page(run, counters, 'reconcile_ghl', [row for row in rows if row[1]],
+                   ghl_cursor=json.dumps(next_cursor) if next_cursor else None,
+                   phase='ghl' if next_cursor else 'sp')
+
+
+def _fetch_sp(run, counters, api_key, program_id):
+    for page, customers in customer_index.iter_customer_pages(api_key, program_id, RECONCILE_PAGE_SIZE, run['sp_page']):
+        rows = [_sp_row(run['run_id'], customer) for customer in customers if customer.get('id')]
+        counters['sp_customers'] = counters.get('sp_customers', 0) + len(rows)
+        _save_page(run, counters, 'reconcile_sp', [row for row in rows if row[1]], sp_page=page + 1)
+    _update_run(run, counters, phase='apply')
+
+
+def _iter_deltas(run):
+    """Bloques de RECONCILE_CHUNK_SIZE contactos ordenados por email, desde el último aplicado."""
+    after = run['apply_after']
+    while True:
+        rows = _db().execute(
+            "SELECT g.email, g.contact_id, g.first_name, g.last_name, g.phone, s.customer_id, "
+            "s.first_name AS sp_first_name, s.last_name AS sp_last_name, s.phone AS sp_phone "
+            "FROM reconcile_ghl g LEFT JOIN reconcile_sp s ON s.run_id = g.run_id AND s.email = g.email "
+            "WHERE g.run_id = ? AND g.email > ? ORDER BY g.email LIMIT ?;",
+            [run['run_id'], after, RECONCILE_CHUNK_SIZE]
+        ).fetchall()
+        if not rows:
+            return
+        yield rows
+        after = rows[-1]['email']
+
+
+def classify(row):
+    """'create', 'update' o 'in_sync' para una fila de la comparación."""
+    if row['customer_id'] is None:
+        return 'create'
+    if any(row[field] != row[f"sp_{field}"] for field in FIELDS):
+        return 'update'
+    return 'in_sync'
+
+
+def _apply_one(run, credentials, row, action):
+    location_id = run['location_id']
+    api_key = credentials['smartpasses_api_key']
+    program_id = credentials['default_program_id']
+    payload = {"firstName": row['first_name'], "lastName": row['last_name'], "email": row['email'], "phone": row['phone']}
+    if action == 'create':
+        # Al retomar un bloque interrumpido, los clientes que ya se crearon en esta ejecución están indexados
+        if customer_index.lookup(location_id, row['contact_id'], row['email'], since=run['started_at']):
+            return
+        customer = create_smartpasses_customer(api_key, program_id, payload, location_id)
+        index_customer(location_id, program_id, customer, row['contact_id'], row['email'])
+    elif action == 'update':
+        update_smartpasses_customer(api_key, program_id, row['customer_id'], payload, location_id)
+        customer_index.record(location_id, program_id, row['customer_id'], row['contact_id'], row['email'])
+    else:
+        customer_index.record(location_id, program_id, row['customer_id'], row['contact_id'], row['email'])
+
+
+def _apply(run, counters, credentials, dry_run):
+    with ThreadPoolExecutor(max_workers=RECONCILE_CONCURRENCY) as executor:
+        for rows in _iter_deltas(run):
+            actions = [(row, classify(row)) for row in rows]
+            if dry_run:
+                for _, action in actions:
+                    counters[action] = counters.get(action, 0) + 1
+            else:
+                futures = [(action, executor.submit(_apply_one, run, credentials, row, action)) for row, action in actions]
+                for action, future in futures:
+                    try:
+                        future.result()
+                        counters[action] = counters.get(action, 0) + 1
+                    except requests.exceptions.RequestException as e:
+                        # Se reintenta en la próxima ejecución
+                        counters['failed'] = counters.get('failed', 0) + 1
+                        logger.warning("❌ Reconciliación (%s) falló en %s: %s", action, run['location_id'], e)
+                    except Exception as e:
+                        # Un registro con datos inesperados no detiene el resto de la ejecución
+                        counters['failed'] = counters.get('failed', 0) + 1
+                        logger.exception("💥 Error inesperado en la reconciliación (%s) de %s: %s",
+                                         action, run['location_id'], e)
+            # El bloque completo quedó aplicado: una reanudación empieza después de él
+            _update_run(run, counters, apply_after=rows[-1]['email'])
+
+    orphaned = _db().execute(
+        "SELECT COUNT(*) AS total FROM reconcile_sp s WHERE s.run_id = ? AND NOT EXISTS "
+        "(SELECT 1 FROM reconcile_ghl g WHERE g.run_id = s.run_id AND g.email = s.email);",
+        [run['run_id']]
+    ).fetchone()['total']
+    counters['only_in_smartpasses'] = orphaned
+
+    conn = _db()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        _checkpoint(conn, run, counters, phase='done', finished_at=time.time(), owner=None, lease_until=0)
+        _drop_staging(conn, run['run_id'])
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+
+
+def run_location(location_id, dry_run=False, restart=False):
+    """
+    Reconcilia una sub-cuenta, retomando la ejecución pendiente si la hay.
+    Devuelve el reporte {run_id, phase, counters} o {"status": "busy"} si otro worker la tiene.
+    """
+    credentials, error_response, _ = get_agency_credentials({'locationId': location_id})
+    if error_response:
+        raise ReconcileError(error_response['error'])
+    access_token, error = token_store.get_access_token(location_id)
+    if error:
+        raise ReconcileError(f"Sin token de GHL: {error[0]}")
+
+    run = _claim(location_id, _owner(), restart=restart, dry_run=dry_run)
+    if run is None:
+        return {"location_id": location_id, "status": "busy"}
+    counters = json.loads(run['counters'])
+    started = time.monotonic()
+    logger.info("🔁 Reconciliando %s (ejecución %s, fase %s)", location_id, run['run_id'], run['phase'])
+
+    if run['phase'] == 'ghl':
+        _fetch_ghl(run, counters, access_token)
+    if run['phase'] == 'sp':
+        _fetch_sp(run, counters, credentials['smartpasses_api_key'], credentials['default_program_id'])
+    if run['phase'] == 'apply':
+        _apply(run, counters, credentials, dry_run)
+
+    logger.info("✅ Reconciliación de %s terminada en %.1fs: %s", location_id, time.monotonic() - started, counters)
+    return {"location_id": location_id, "run_id": run['run_id'], "phase": run['phase'],
+            "dry_run": dry_run, "counters": counters}
+
+
+def status():
+    rows = _db().execute(
+        "SELECT location_id, run_id, phase, counters, dry_run, lease_until, started_at, updated_at, finished_at "
+        "FROM reconcile_runs ORDER BY location_id;"
+    ).fetchall()
+    return [dict(row, counters=json.loads(row['counters'])) for row in rows]
+
+
+# -----------------------------------------------------------------------------
+# TAREA PROGRAMADA
+# -----------------------------------------------------------------------------
+
+def _is_due(location_id, now):
+    row = _db().execute(
+        "SELECT phase, lease_until, finished_at FROM reconcile_runs WHERE location_id = ?;", [location_id]
+    ).fetchone()
+    if row is None:
+        return True
+    if row['phase'] != 'done':
+        # Ejecución interrumpida: se retoma cuando vence el lease de quien la tenía
+        return row['lease_until'] < now
+    return (row['finished_at'] or 0) < now - RECONCILE_INTERVAL
+
+
+def _scheduler_loop():
+    while True:
+        try:
+            for location_id in token_store.location_ids():
+                if not _is_due(location_id, time.time()):
+                    continue
+                try:
+                    run_location(location_id)
+                except (ReconcileError, LeaseLost) as e:
+                    logger.warning("Reconciliación de %s omitida: %s", location_id, e)
+                except requests.exceptions.RequestException as e:
+                    # Queda en su punto de control y se retoma al vencer el lease
+                    logger.warning("Reconciliación de %s interrumpida: %s", location_id, e)
+        except Exception as e:
+            logger.exception("💥 Error inesperado en la reconciliación programada: %s", e)
+        time.sleep(RECONCILE_CHECK_INTERVAL)
+
+
+def start_scheduler():
+    """Arranca (una vez por proceso) la reconciliación periódica si RECONCILE_INTERVAL > 0."""
+    global _scheduler
+    if RECONCILE_INTERVAL <= 0:
+        return
+    with _scheduler_lock:
+        if _scheduler is not None:
+            return
+        _scheduler = threading.Thread(target=_scheduler_loop, name="reconcile-scheduler", daemon=True)
+        _scheduler.start()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reconciliación de contactos de GHL con clientes de SmartPasses")
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    run_parser = subcommands.add_parser('run', help="reconcilia una o varias sub-cuentas")
+    run_parser.add_argument('--location', action='append', dest='locations',
+                            help="locationId a reconciliar (se puede repetir; por defecto todas las instaladas)")
+    run_parser.add_argument('--dry-run', action='store_true', help="solo cuenta las diferencias, no las aplica")
+    run_parser.add_argument('--restart', action='store_true', help="descarta la ejecución pendiente y empieza de cero")
+    subcommands.add_parser('status', help="estado y contadores de la última ejecución por sub-cuenta")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'status':
+        print(json.dumps(status(), indent=2, sort_keys=True))
+        return
+
+    reports = []
+    for location_id in args.locations or token_store.location_ids():
+        try:
+            reports.append(run_location(location_id, dry_run=args.dry_run, restart=args.restart))
+        except (ReconcileError, LeaseLost, requests.exceptions.RequestException) as e:
+            reports.append({"location_id": location_id, "error": str(e)})
+    print(json.dumps(reports, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+# shared_cache.py
+# Segundo nivel de caché compartido por todos los workers del host.
+#
+# Cada worker de gunicorn tiene su propia caché en memoria (credential_cache);
+# con varios workers las mismas credenciales se piden a D1 una vez por worker y
+# se pierden cada vez que un worker se recicla. Este módulo añade un nivel
+# compartido detrás de la caché en memoria:
+#   - sqlite: archivo en instance/ (sin dependencias, para un solo servidor)
+#   - redis:  cualquier servidor que hable el protocolo de Redis (RESP)
+#   - memory: sin nivel compartido (comportamiento anterior)
+#
+# La invalidación es por versión: save_settings borra la clave del nivel
+# compartido e incrementa la versión del espacio de nombres; los demás workers
+# ven el cambio en menos de CACHE_VERSION_CHECK_INTERVAL y vacían su nivel en
+# memoria, que se vuelve a llenar desde el nivel compartido.
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+from local_db import get_connection
+
+logger = logging.getLogger(__name__)
+
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'sqlite').lower()
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://127.0.0.1:6379/0')
+CACHE_REDIS_TIMEOUT = float(os.environ.get('CACHE_REDIS_TIMEOUT', 0.25))
+CACHE_VERSION_CHECK_INTERVAL = float(os.environ.get('CACHE_VERSION_CHECK_INTERVAL', 1))
+# Tras un fallo, segundos sin consultar el nivel compartido (evita pagar el timeout en cada petición)
+CACHE_RETRY_SECONDS = float(os.environ.get('CACHE_RETRY_SECONDS', 5))
+
+DB_NAME = 'shared_cache'
+# Cada cuántas escrituras se purgan las entradas vencidas del archivo SQLite
+SQLITE_PURGE_EVERY = 1000
+
+
+class SharedCacheError(Exception):
+    """El nivel compartido no respondió; se trata como un fallo de caché."""
+
+
+def encode(value, sentinel=None, ttl=None):
+    """
+    JSON para el nivel compartido; el centinela (p. ej. NOT_CONFIGURED) se marca aparte.
+    Con `ttl` se guarda también el vencimiento, para que otro worker no lo alargue.
+    """
+    data = {"sentinel": True} if sentinel is not None and value is sentinel else {"value": value}
+    if ttl is not None:
+        data["expires_at"] = time.time() + ttl
+    return json.dumps(data)
+
+
+def decode(raw, sentinel=None):
+    """(valor, segundos que le quedan o None si la entrada no guarda su vencimiento)."""
+    data = json.loads(raw)
+    value = sentinel if data.get("sentinel") else data.get("value")
+    expires_at = data.get("expires_at")
+    return value, None if expires_at is None else expires_at - time.time()
+
+
+class SQLiteBackend:
+    """Nivel compartido en instance/shared_cache.db (WAL, una conexión por hilo)."""
+
+    name = 'sqlite'
+
+    def __init__(self):
+        self._schema_ready = False
+        self._writes = 0
+
+    def _db(self):
+        conn = get_connection(DB_NAME)
+        if not self._schema_ready:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS cache_versions (
+                    key TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL
+                );
+            """)
+            self._schema_ready = True
+        return conn
+
+    def get(self, key):
+        row = self._db().execute(
+            "SELECT value FROM cache_entries WHERE key = ? AND expires_at > ?;", [key, time.time()]
+        ).fetchone()
+        return row['value'] if row else None
+
+    def set(self, key, value, ttl):
+        conn = self._db()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?);",
+            [key, value, time.time() + ttl]
+        )
+        self._writes += 1
+        if self._writes % SQLITE_PURGE_EVERY == 0:
+            conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?;", [time.time()])
+
+    def delete(self, *keys):
+        if keys:
+            self._db().execute(
+                f"DELETE FROM cache_entries WHERE key IN ({', '.join('?' * len(keys))});", list(keys)
+            )
+
+    def get_version(self, key):
+        row = self._db().execute("SELECT version FROM cache_versions WHERE key = ?;", [key]).fetchone()
+        return row['version'] if row else 0
+
+    def incr(self, key):
+        conn = self._db()
+        conn.execute(
+            "INSERT INTO cache_versions (key, version) VALUES (?, 1) "
+            "ON CONFLICT(key) DO UPDATE SET version = version + 1;",
+            [key]
+        )
+        return self.get_version(key)
+
+
+class RedisBackend:
+    """
+    Cliente mínimo del protocolo de Redis (RESP) con una conexión por hilo.
+    Solo usa GET, SET PX, DEL e INCR, así que sirve con Redis, Valkey o KeyDB.
+    """
+
+    name = 'redis'
+
+    def __init__(self, url=CACHE_REDIS_URL, timeout=CACHE_REDIS_TIMEOUT):
+        parts = urlsplit(url)
+        self.host = parts.hostname or '127.0.0.1'
+        self.port = parts.port or 6379
+        self.password = parts.password
+        self.db = int(parts.path.lstrip('/') or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._local.sock = sock
+        self._local.reader = sock.makefile('rb')
+        if self.password:
+            self._call('AUTH', self.password)
+        if self.db:
+            self._call('SELECT', self.db)
+
+    def _close(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+        self._local.sock = None
+
+    def _read_reply(self):
+        line = self._local.reader.readline()
+        if not line:
+            raise ConnectionError("Redis cerró la conexión")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            raise SharedCacheError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length == -1:
+                return None
+            return self._local.reader.read(length + 2)[:-2].decode()
+        if kind == b'*':
+            return [self._read_reply() for _ in range(int(payload))]
+        raise SharedCacheError(f"Respuesta de Redis no reconocida: {line!r}")
+
+    def _call(self, *args):
+        parts = [str(arg).encode() for arg in args]
+        command = b''.join([f"*{len(parts)}\r\n".encode()] +
+                           [f"${len(part)}\r\n".encode() + part + b"\r\n" for part in parts])
+        if getattr(self._local, 'sock', None) is None:
+            self._connect()
+        try:
+            self._local.sock.sendall(command)
+            return self._read_reply()
+        except (OSError, ConnectionError) as e:
+            # La conexión queda en un estado desconocido: se descarta
+            self._close()
+            raise SharedCacheError(str(e)) from e
+
+    def get(self, key):
+        return self._call('GET', key)
+
+    def set(self, key, value, ttl):
+        self._call('SET', key, value, 'PX', max(1, int(ttl * 1000)))
+
+    def delete(self, *keys):
+        if keys:
+            self._call('DEL', *keys)
+
+    def get_version(self, key):
+        return int(self._call('GET', key) or 0)
+
+    def incr(self, key):
+        return self._call('INCR', key)
+
+
+class TieredCache:
+    """
+    Caché en dos niveles: el TTLCache del worker delante del nivel compartido.
+    Ofrece la misma interfaz que TTLCache (get, get_stale, set, invalidate, clear, stats).
+    Si el nivel compartido falla, se comporta como la caché en memoria sola.
+    `sentinel` es el valor que usa el TTL negativo (NOT_CONFIGURED en las credenciales).
+    """
+
+    def __init__(self, namespace, local, backend, sentinel=None):
+        self.namespace = namespace
+        self.local = local
+        self.backend = backend
+        self.sentinel = sentinel
+        self._version_key = f"{namespace}:version"
+        self._version = None
+        self._version_checked = 0.0
+        self._down_until = 0.0
+        self._lock = threading.Lock()
+        self.shared_hits = 0
+        self.shared_misses = 0
+        self.shared_errors = 0
+
+    def _key(self, key):
+        return f"{self.namespace}:{key}"
+
+    def _shared(self, operation, *args):
+        if self._down_until > time.monotonic():
+            return None
+        try:
+            return operation(*args)
+        except Exception as e:
+            with self._lock:
+                self.shared_errors += 1
+            self._down_until = time.monotonic() + CACHE_RETRY_SECONDS
+            logger.warning("Caché compartida (%s) no disponible durante %ss: %s",
+                           self.backend.name, CACHE_RETRY_SECONDS, e)
+            return None
+
+    def _check_version(self):
+        """Vacía el nivel en memoria si otro worker invalidó algo desde la última revisión."""
+        now = time.monotonic()
+        if now - self._version_checked < CACHE_VERSION_CHECK_INTERVAL:
+            return
+        self._version_checked = now
+        version = self._shared(self.backend.get_version, self._version_key)
+        if version is None:
+            return
+        if self._version is not None and version != self._version:
+            self.local.clear()
+        self._version = version
+
+    def get(self, key):
+        self._check_version()
+        value = self.local.get(key)
+        if value is not None:
+            return value
+
+        raw = self._shared(self.backend.get, self._key(key))
+        value, remaining = decode(raw, self.sentinel) if raw is not None else (None, None)
+        if raw is None or (remaining is not None and remaining <= 0):
+            with self._lock:
+                self.shared_misses += 1
+            return None
+        with self._lock:
+            self.shared_hits += 1
+        # Solo por lo que le queda en el nivel compartido, no un TTL completo desde ahora
+        self.local.set(key, value, remaining)
+        return value
+
+    def get_stale(self, key):
+        return self.local.get_stale(key)
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.local.negative_ttl if value is self.sentinel else self.local.ttl
+        self.local.set(key, value, ttl)
+        self._shared(self.backend.set, self._key(key), encode(value, self.sentinel, ttl), ttl)
+
+    def invalidate_many(self, keys):
+        """Borra las claves en todos los niveles y avisa a los demás workers con una nueva versión."""
+        keys = list(keys)
+        if not keys:
+            return
+        for key in keys:
+            self.local.invalidate(key)
+        self._shared(self.backend.delete, *[self._key(key) for key in keys])
+        version = self._shared(self.backend.incr, self._version_key)
+        if version is None:
+            return
+        # Si otro worker también invalidó desde la última revisión, hay que vaciar este nivel
+        if self._version is not None and version != self._version + 1:
+            self.local.clear()
+        self._version = version
+
+    def invalidate(self, key):
+        self.invalidate_many([key])
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        stats = self.local.stats()
+        with self._lock:
+            stats.update(shared_hits=self.shared_hits, shared_misses=self.shared_misses,
+                         shared_errors=self.shared_errors)
+        return stats
+
+
+def create_backend(kind=CACHE_BACKEND):
+    """Backend compartido configurado en CACHE_BACKEND, o None para solo memoria."""
+    if kind == 'sqlite':
+        return SQLiteBackend()
+    if kind == 'redis':
+        return RedisBackend()
+    if kind != 'memory':
+        logger.warning("CACHE_BACKEND desconocido (%s): se usa solo la caché en memoria.", kind)
+    return None
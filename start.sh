@@ -24,9 +24,28 @@ echo "Iniciando servidor SmartPasses GHL Bridge..."
 # Crear directorio de logs si no existe
 mkdir -p logs
 
-# Iniciar el servidor con Gunicorn
+# Modo de servicio: 'wsgi' (por defecto) o 'asgi' (rutas de acciones asíncronas)
+export SERVER_MODE=${SERVER_MODE:-wsgi}
+
+if [ "$SERVER_MODE" = "asgi" ]; then
+    exec gunicorn --bind 0.0.0.0:5000 \
+                  --workers 2 \
+                  --worker-class uvicorn.workers.UvicornWorker \
+                  --timeout 120 \
+                  --keep-alive 2 \
+                  --max-requests 1000 \
+                  --max-requests-jitter 50 \
+                  --access-logfile logs/access.log \
+                  --error-logfile logs/error.log \
+                  --log-level info \
+                  asgi:application
+fi
+
+# Iniciar el servidor con Gunicorn. Con varios hilos por worker, /health sigue
+# respondiendo aunque haya peticiones esperando a un upstream lento.
 exec gunicorn --bind 0.0.0.0:5000 \
               --workers 2 \
+              --threads ${GUNICORN_THREADS:-4} \
               --timeout 120 \
               --keep-alive 2 \
               --max-requests 1000 \
@@ -0,0 +1,189 @@
+# structured_log.py
+# Logs estructurados (una línea JSON por evento) sin bloquear a quien registra.
+#
+# Los módulos usan logging.getLogger(__name__) como siempre. configure() pone en
+# el logger raíz un QueueHandler: el hilo de la petición solo encola el registro
+# y un hilo aparte lo serializa a JSON y lo escribe en stdout (y en archivo si se
+# configura). Si la cola se llena se descartan registros en vez de esperar.
+#
+# Los cuerpos de las peticiones se registran con log_payload(): se muestrean por
+# ruta, se ocultan los campos secretos y se recortan a LOG_PAYLOAD_MAX_BYTES.
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.environ.get('LOG_FILE')
+LOG_FILE_MAX_BYTES = int(os.environ.get('LOG_FILE_MAX_BYTES', 10 * 1024 * 1024))
+LOG_FILE_BACKUPS = int(os.environ.get('LOG_FILE_BACKUPS', 5))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_PAYLOAD_MAX_BYTES = int(os.environ.get('LOG_PAYLOAD_MAX_BYTES', 2048))
+# Fracción de cuerpos que se registran; por ruta con "create_customer=1,webhook=0.05"
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get('LOG_PAYLOAD_SAMPLE_RATE', 0.01))
+LOG_PAYLOAD_SAMPLE_RATES = os.environ.get('LOG_PAYLOAD_SAMPLE_RATES', '')
+
+# Claves cuyo valor nunca se escribe (comparación sin mayúsculas ni separadores)
+REDACTED_KEYS = frozenset((
+    'apikey', 'smartpassesapikey', 'authorization', 'accesstoken', 'refreshtoken',
+    'clientsecret', 'sharedsecret', 'secret', 'password', 'token',
+))
+REDACTED = '[REDACTED]'
+
+_configure_lock = threading.Lock()
+_listener = None
+_dropped = 0
+
+# Atributos estándar de LogRecord que no se copian como campos extra
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def _parse_rates(text):
+    rates = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        route, _, rate = item.partition('=')
+        try:
+            rates[route.strip()] = float(rate)
+        except ValueError:
+            continue
+    return rates
+
+
+_sample_rates = _parse_rates(LOG_PAYLOAD_SAMPLE_RATES)
+
+
+def _normalize_key(key):
+    return str(key).lower().replace('_', '').replace('-', '')
+
+
+def redact(value):
+    """Copia de `value` con los campos secretos reemplazados por [REDACTED]."""
+    if isinstance(value, dict):
+        return {k: REDACTED if _normalize_key(k) in REDACTED_KEYS else redact(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    return value
+
+
+def excerpt(payload, max_bytes=None):
+    """JSON compacto y sin secretos del payload, recortado a `max_bytes`."""
+    max_bytes = max_bytes or LOG_PAYLOAD_MAX_BYTES
+    if isinstance(payload, (bytes, bytearray)):
+        try:
+            payload = json.loads(payload)
+        except ValueError:
+            payload = payload.decode('utf-8', 'replace')
+    text = json.dumps(redact(payload), separators=(',', ':'), ensure_ascii=False, default=str)
+    if len(text) > max_bytes:
+        return f"{text[:max_bytes]}...(+{len(text) - max_bytes} chars)"
+    return text
+
+
+def should_sample(route):
+    rate = _sample_rates.get(route, LOG_PAYLOAD_SAMPLE_RATE)
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+def log_payload(logger, route, message, payload, **fields):
+    """
+    Registra `message` con los campos dados y, si la ruta sale en el muestreo, un
+    extracto del payload. El extracto solo se calcula cuando se va a escribir.
+    """
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    if should_sample(route):
+        fields['payload'] = excerpt(payload)
+    logger.info(message, extra=dict(fields, route=route))
+
+
+class JSONFormatter(logging.Formatter):
+    """Una línea JSON por registro; los `extra` del registro se incluyen como campos."""
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "pid": record.process,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que descarta en vez de bloquear cuando la cola está llena."""
+
+    def prepare(self, record):
+        # La traza se formatea aquí porque exc_info no viaja bien entre hilos
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        global _dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _dropped += 1
+
+
+def configure(log_file=None, level=None):
+    """
+    Instala el pipeline en el logger raíz (una vez por proceso). `log_file` añade
+    un RotatingFileHandler además de stdout; por defecto se usa LOG_FILE.
+    """
+    global _listener
+    with _configure_lock:
+        if _listener is not None:
+            return
+
+        formatter = JSONFormatter()
+        handlers = [logging.StreamHandler(sys.stdout)]
+        log_file = log_file or LOG_FILE
+        if log_file:
+            directory = os.path.dirname(log_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            handlers.append(logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(_NonBlockingQueueHandler(log_queue))
+        root.setLevel(level or LOG_LEVEL)
+
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        # Vacía la cola al terminar el proceso
+        atexit.register(shutdown)
+
+
+def shutdown():
+    """Escribe los registros pendientes y detiene el hilo de escritura."""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def stats():
+    return {"queued": _listener.queue.qsize() if _listener else 0, "dropped": _dropped}
@@ -0,0 +1,232 @@
+# token_store.py
+# Almacén persistente de tokens OAuth de GHL por locationId, con renovación
+# proactiva en segundo plano.
+#
+# - Los tokens se guardan en instance/oauth_tokens.db (compartido entre workers).
+# - get_access_token() sirve el token desde memoria sin llamadas de red mientras
+#   no esté por vencer.
+# - Un hilo renueva por lotes los tokens que vencen pronto. A cada instalación se
+#   le asigna un desfase fijo (jitter) para que no se renueven todas a la vez.
+# - Las renovaciones concurrentes de la misma location se unifican: dentro del
+#   proceso con un lock por location y entre workers con una marca en SQLite.
+#   Esto importa porque GHL invalida el refresh token al usarlo.
+
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import requests
+
+import http_client
+from local_db import get_connection
+
+logger = logging.getLogger(__name__)
+
+GHL_API_BASE_URL = os.environ.get('GHL_API_BASE_URL', "https://api.msgsndr.com")
+GHL_OAUTH_TOKEN_URL = f"{GHL_API_BASE_URL}/oauth/token"
+
+TOKEN_REFRESH_INTERVAL = float(os.environ.get('TOKEN_REFRESH_INTERVAL', 300))
+TOKEN_REFRESH_WINDOW = float(os.environ.get('TOKEN_REFRESH_WINDOW', 3600))
+TOKEN_REFRESH_JITTER = float(os.environ.get('TOKEN_REFRESH_JITTER', 1800))
+TOKEN_REFRESH_BATCH_SIZE = int(os.environ.get('TOKEN_REFRESH_BATCH_SIZE', 20))
+TOKEN_MIN_TTL = float(os.environ.get('TOKEN_MIN_TTL', 60))
+TOKEN_REFRESH_LEASE = 30
+
+DB_NAME = 'oauth_tokens'
+
+_schema_ready = False
+_memory = {}
+_locks = {}
+_locks_guard = threading.Lock()
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+def _db():
+    global _schema_ready
+    conn = get_connection(DB_NAME)
+    if not _schema_ready:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS oauth_tokens (
+                location_id TEXT PRIMARY KEY,
+                company_id TEXT,
+                access_token TEXT NOT NULL,
+                refresh_token TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                scope TEXT,
+                refreshing_until REAL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_oauth_tokens_expires ON oauth_tokens (expires_at);
+        """)
+        _schema_ready = True
+    return conn
+
+
+def _jitter(location_id):
+    """Desfase estable por location dentro de [0, TOKEN_REFRESH_JITTER)."""
+    digest = hashlib.sha1(location_id.encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'big') / 2 ** 32 * TOKEN_REFRESH_JITTER
+
+
+def _location_lock(location_id):
+    lock = _locks.get(location_id)
+    if lock is None:
+        with _locks_guard:
+            lock = _locks.setdefault(location_id, threading.Lock())
+    return lock
+
+
+def save_tokens(token_data):
+    """Guarda la respuesta del endpoint de tokens de GHL. Devuelve el locationId."""
+    location_id = token_data.get('locationId')
+    if not location_id:
+        return None
+
+    expires_at = time.time() + float(token_data.get('expires_in') or 0)
+    _db().execute(
+        "INSERT OR REPLACE INTO oauth_tokens "
+        "(location_id, company_id, access_token, refresh_token, expires_at, scope, refreshing_until, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, NULL, ?);",
+        [location_id, token_data.get('companyId'), token_data['access_token'],
+         token_data['refresh_token'], expires_at, token_data.get('scope'), time.time()]
+    )
+    _memory[location_id] = (token_data['access_token'], expires_at)
+    return location_id
+
+
+def _load(location_id):
+    row = _db().execute(
+        "SELECT access_token, refresh_token, expires_at FROM oauth_tokens WHERE location_id = ?;",
+        [location_id]
+    ).fetchone()
+    if row is not None:
+        _memory[location_id] = (row['access_token'], row['expires_at'])
+    return row
+
+
+def _claim_refresh(location_id):
+    """Marca la location como 'renovando' para que otros workers no lo hagan a la vez."""
+    now = time.time()
+    cursor = _db().execute(
+        "UPDATE oauth_tokens SET refreshing_until = ? "
+        "WHERE location_id = ? AND (refreshing_until IS NULL OR refreshing_until < ?);",
+        [now + TOKEN_REFRESH_LEASE, location_id, now]
+    )
+    return cursor.rowcount == 1
+
+
+def refresh(location_id, min_ttl=TOKEN_MIN_TTL):
+    """
+    Renueva el token de una location si le quedan menos de `min_ttl` segundos.
+    Devuelve (access_token, None) o (None, (mensaje, status)).
+    """
+    with _location_lock(location_id):
+        deadline = time.time() + TOKEN_REFRESH_LEASE
+        while True:
+            row = _load(location_id)
+            if row is None:
+                return None, ("No hay tokens guardados para esta location.", 404)
+            # Otro hilo u otro worker pudo haberlo renovado mientras esperábamos
+            if row['expires_at'] - time.time() > min_ttl:
+                return row['access_token'], None
+            if _claim_refresh(location_id):
+                break
+            if time.time() > deadline:
+                return None, ("Tiempo de espera agotado renovando el token.", 503)
+            time.sleep(0.5)
+
+        payload = {
+            'client_id': os.environ.get('GHL_CLIENT_ID'),
+            'client_secret': os.environ.get('GHL_CLIENT_SECRET'),
+            'grant_type': 'refresh_token',
+            'refresh_token': row['refresh_token'],
+            'user_type': 'Location'
+        }
+        try:
+            # El refresh token es de un solo uso: no se reintenta automáticamente
+            response = http_client.post(GHL_OAUTH_TOKEN_URL, data=payload, idempotent=False)
+            response.raise_for_status()
+            token_data = response.json()
+        except requests.exceptions.HTTPError as err:
+            _release_refresh(location_id)
+            logger.error("🚨 Error renovando token de %s: %s", location_id, err.response.text[:500])
+            return None, (err.response.text, err.response.status_code)
+        except requests.exceptions.RequestException as err:
+            _release_refresh(location_id)
+            logger.error("🚨 Error de conexión renovando token de %s: %s", location_id, err)
+            return None, (str(err), 502)
+
+        token_data.setdefault('locationId', location_id)
+        save_tokens(token_data)
+        logger.info("🔑 Token renovado para Location ID: %s", location_id)
+        return token_data['access_token'], None
+
+
+def _release_refresh(location_id):
+    _db().execute("UPDATE oauth_tokens SET refreshing_until = NULL WHERE location_id = ?;", [location_id])
+
+
+def get_access_token(location_id):
+    """
+    Devuelve un access token válido para la location.
+    En el camino normal se responde desde memoria; solo si está por vencer se renueva.
+    """
+    cached = _memory.get(location_id)
+    if cached is not None and cached[1] - time.time() > TOKEN_MIN_TTL:
+        return cached[0], None
+    return refresh(location_id)
+
+
+def location_ids(limit=None):
+    """Locations con la app instalada, de la más a la menos recientemente renovada."""
+    rows = _db().execute(
+        "SELECT location_id FROM oauth_tokens ORDER BY updated_at DESC LIMIT ?;", [limit or -1]
+    ).fetchall()
+    return [row['location_id'] for row in rows]
+
+
+def _due_locations(now):
+    """Locations cuyo token vence dentro de la ventana más su desfase propio."""
+    rows = _db().execute(
+        "SELECT location_id, expires_at FROM oauth_tokens WHERE expires_at < ? ORDER BY expires_at;",
+        [now + TOKEN_REFRESH_WINDOW + TOKEN_REFRESH_JITTER]
+    ).fetchall()
+    return [row['location_id'] for row in rows
+            if row['expires_at'] - _jitter(row['location_id']) < now + TOKEN_REFRESH_WINDOW]
+
+
+def _refresh_loop():
+    while True:
+        try:
+            due = _due_locations(time.time())
+            for start in range(0, len(due), TOKEN_REFRESH_BATCH_SIZE):
+                for location_id in due[start:start + TOKEN_REFRESH_BATCH_SIZE]:
+                    refresh(location_id, min_ttl=TOKEN_REFRESH_WINDOW + _jitter(location_id))
+                # Pausa entre lotes para no saturar el endpoint de GHL
+                time.sleep(1)
+        except Exception as e:
+            logger.exception("💥 Error inesperado en la renovación de tokens: %s", e)
+        time.sleep(TOKEN_REFRESH_INTERVAL)
+
+
+def start_refresher():
+    """Arranca (una vez por proceso) el hilo de renovación proactiva."""
+    global _refresher
+    with _refresher_lock:
+        if _refresher is not None:
+            return
+        _refresher = threading.Thread(target=_refresh_loop, name="oauth-token-refresher", daemon=True)
+        _refresher.start()
+
+
+def stats():
+    conn = _db()
+    now = time.time()
+    row = conn.execute(
+        "SELECT COUNT(*) AS total, SUM(CASE WHEN expires_at < ? THEN 1 ELSE 0 END) AS expired FROM oauth_tokens;",
+        [now]
+    ).fetchone()
+    return {"locations": row['total'], "expired": row['expired'] or 0}
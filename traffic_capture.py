@@ -0,0 +1,192 @@
+# traffic_capture.py
+# Captura opcional del tráfico real de acciones y webhooks de GHL para reproducirlo
+# después con bench/replay.py.
+#
+# Con TRAFFIC_CAPTURE_FILE configurado, cada petición a los blueprints de acciones
+# de clientes, de programa y de webhooks se agrega al archivo como una línea JSON
+# compacta con su instante de llegada, método, ruta, cuerpo, estado y duración.
+# Antes de escribirse, el cuerpo pierde los secretos (structured_log.redact) y los
+# datos personales (emails, teléfonos y nombres) se reemplazan por seudónimos
+# estables, así el mismo contacto sigue siendo el mismo al reproducir. La firma
+# de los webhooks no se guarda: replay.py vuelve a firmar con un secreto de prueba.
+# En modo ASGI, asgi.py captura sus rutas nativas con start() y record().
+#
+# Como los logs, la escritura va en un hilo aparte: la petición solo encola la
+# línea y si la cola se llena se descarta. Cada worker agrega líneas completas
+# (O_APPEND), así varios workers pueden compartir el archivo.
+
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+
+from flask import g, request
+
+from structured_log import redact
+
+logger = logging.getLogger(__name__)
+
+TRAFFIC_CAPTURE_FILE = os.environ.get('TRAFFIC_CAPTURE_FILE')
+TRAFFIC_CAPTURE_SAMPLE_RATE = float(os.environ.get('TRAFFIC_CAPTURE_SAMPLE_RATE', 1))
+TRAFFIC_CAPTURE_MAX_BODY = int(os.environ.get('TRAFFIC_CAPTURE_MAX_BODY', 64 * 1024))
+TRAFFIC_CAPTURE_QUEUE_SIZE = int(os.environ.get('TRAFFIC_CAPTURE_QUEUE_SIZE', 10000))
+# Sal de los seudónimos: cambiarla hace que dos capturas no se puedan cruzar
+TRAFFIC_CAPTURE_SALT = os.environ.get('TRAFFIC_CAPTURE_SALT', '')
+
+# Blueprints cuyo tráfico se captura
+CAPTURED_BLUEPRINTS = frozenset(('customer_actions', 'program_actions', 'webhook'))
+
+# Claves con datos personales (sin mayúsculas ni separadores) que se reemplazan por seudónimos
+PERSONAL_KEYS = ('email', 'phone', 'firstname', 'lastname', 'fullname', 'name')
+
+EMAIL_PATTERN = re.compile(r"[^@\s\"']+@[^@\s\"']+\.[A-Za-z]{2,}")
+
+# Versión del formato de cada línea
+FORMAT_VERSION = 1
+
+_queue = queue.Queue(maxsize=TRAFFIC_CAPTURE_QUEUE_SIZE)
+_writer = None
+_writer_lock = threading.Lock()
+_stats = {"captured": 0, "dropped": 0, "skipped_body": 0}
+
+
+def _pseudonym(value, kind):
+    digest = hashlib.sha256(f"{TRAFFIC_CAPTURE_SALT}\x1f{value}".encode('utf-8')).hexdigest()
+    if kind == 'email':
+        return f"u-{digest[:12]}@example.com"
+    if kind == 'phone':
+        return "+1555" + str(int(digest[:12], 16))[-7:].zfill(7)
+    return f"n-{digest[:8]}"
+
+
+def _personal_kind(key):
+    normalized = key.lower().replace('_', '').replace('-', '')
+    for kind in PERSONAL_KEYS:
+        if normalized.endswith(kind):
+            return 'phone' if kind == 'phone' else 'email' if kind == 'email' else 'name'
+    return None
+
+
+def anonymize(value, kind=None):
+    """Copia de `value` con los datos personales reemplazados por seudónimos estables."""
+    if isinstance(value, dict):
+        return {k: anonymize(v, _personal_kind(k)) for k, v in value.items()}
+    if isinstance(value, list):
+        return [anonymize(v, kind) for v in value]
+    if isinstance(value, str) and value:
+        if kind:
+            return _pseudonym(value.strip().lower() if kind == 'email' else value, kind)
+        # Emails sueltos en otros campos (p. ej. mensajes)
+        return EMAIL_PATTERN.sub(lambda m: _pseudonym(m.group(0).lower(), 'email'), value)
+    return value
+
+
+def clean_body(raw):
+    """Cuerpo sin secretos ni datos personales, como texto JSON compacto, o None."""
+    if not raw:
+        return ""
+    if len(raw) > TRAFFIC_CAPTURE_MAX_BODY:
+        _stats["skipped_body"] += 1
+        return None
+    try:
+        payload = json.loads(raw)
+    except ValueError:
+        # Un cuerpo que no es JSON no se puede limpiar campo a campo: no se guarda
+        _stats["skipped_body"] += 1
+        return None
+    return json.dumps(anonymize(redact(payload)), separators=(',', ':'), ensure_ascii=False)
+
+
+def start():
+    """
+    (instante, reloj monotónico) si esta petición se captura, o None (captura
+    desactivada o fuera de la muestra). asgi.py lo usa para sus rutas nativas.
+    """
+    if _writer is None:
+        return None
+    if TRAFFIC_CAPTURE_SAMPLE_RATE < 1 and random.random() >= TRAFFIC_CAPTURE_SAMPLE_RATE:
+        return None
+    return (time.time(), time.perf_counter())
+
+
+def record(started, method, full_path, content_type, raw_body, signed, status):
+    """Encola la línea de una petición cuya captura empezó con start()."""
+    try:
+        line = {
+            "v": FORMAT_VERSION,
+            "t": round(started[0], 6),
+            "m": method,
+            "p": full_path,
+            "ct": content_type,
+            "b": clean_body(raw_body),
+            "sig": signed,
+            "s": status,
+            "d": round((time.perf_counter() - started[1]) * 1000, 3),
+        }
+        _queue.put_nowait(json.dumps(line, separators=(',', ':'), ensure_ascii=False))
+        _stats["captured"] += 1
+    except queue.Full:
+        _stats["dropped"] += 1
+    except Exception as e:
+        logger.warning("No se pudo capturar la petición %s: %s", full_path, e)
+
+
+def _start_capture():
+    if request.blueprint not in CAPTURED_BLUEPRINTS:
+        return
+    started = start()
+    if started is not None:
+        g.capture_started = started
+
+
+def _finish_capture(response):
+    started = g.pop('capture_started', None)
+    if started is None:
+        return response
+    record(started, request.method, request.full_path.rstrip('?'), request.content_type,
+           request.get_data(cache=True), 'x-webhook-signature' in request.headers, response.status_code)
+    return response
+
+
+def _writer_loop(path):
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    while True:
+        lines = [_queue.get()]
+        # Se escriben juntas las líneas que ya estaban en cola
+        while len(lines) < 500:
+            try:
+                lines.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            os.write(fd, ("\n".join(lines) + "\n").encode('utf-8'))
+        except OSError as e:
+            _stats["dropped"] += len(lines)
+            logger.warning("No se pudo escribir la captura de tráfico en %s: %s", path, e)
+
+
+def init_app(app):
+    """Registra la captura si TRAFFIC_CAPTURE_FILE está configurado."""
+    global _writer
+    if not TRAFFIC_CAPTURE_FILE:
+        return
+    directory = os.path.dirname(TRAFFIC_CAPTURE_FILE)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_writer_loop, args=(TRAFFIC_CAPTURE_FILE,),
+                                       name="traffic-capture", daemon=True)
+            _writer.start()
+    app.before_request(_start_capture)
+    app.after_request(_finish_capture)
+    logger.info("📼 Capturando tráfico de %s en %s", ", ".join(sorted(CAPTURED_BLUEPRINTS)), TRAFFIC_CAPTURE_FILE)
+
+
+def stats():
+    return dict(_stats, queued=_queue.qsize())
@@ -0,0 +1,133 @@
+# warmup.py
+# Calentamiento de cada worker antes de atender tráfico.
+#
+# gunicorn recicla los workers cada --max-requests peticiones; sin calentar, las
+# primeras peticiones de cada location pagan la consulta a D1 y los handshakes
+# TLS. Al arrancar (create_app corre en cada worker) se hace en paralelo:
+#   - abrir conexiones keep-alive con D1, SmartPasses y GHL
+#   - cargar en la caché las credenciales de las locations activas (réplica + D1 en bloque)
+#   - compilar y renderizar las plantillas
+# Todo dentro de WARMUP_BUDGET_SECONDS: lo que no termine a tiempo sigue en segundo
+# plano y el worker empieza a atender igualmente.
+
+import logging
+import os
+import threading
+import time
+
+import credential_replica
+import d1
+import http_client
+import token_store
+from actions.customer import SMARTPASSES_API_BASE_URL
+from credential_cache import NOT_CONFIGURED, credential_cache
+
+logger = logging.getLogger(__name__)
+
+WARMUP_BUDGET_SECONDS = float(os.environ.get('WARMUP_BUDGET_SECONDS', 5))
+WARMUP_MAX_LOCATIONS = int(os.environ.get('WARMUP_MAX_LOCATIONS', 1000))
+WARMUP_CONNECTIONS_PER_HOST = int(os.environ.get('WARMUP_CONNECTIONS_PER_HOST', 2))
+
+TEMPLATES = ('base.html', 'index.html', 'settings.html', '404.html')
+
+# Resultado del último calentamiento, para /health
+last_report = {}
+
+
+def active_location_ids(limit=WARMUP_MAX_LOCATIONS):
+    """Locations con la app instalada y, si sobra cupo, las más recientes de la réplica."""
+    ids = token_store.location_ids(limit)
+    if credential_replica.is_enabled() and len(ids) < limit:
+        ids += credential_replica.recent_location_ids(limit)
+    return list(dict.fromkeys(ids))[:limit]
+
+
+def warm_credentials():
+    """Carga las credenciales en la caché en memoria. Devuelve cuántas se cargaron."""
+    location_ids = active_location_ids()
+    if not location_ids:
+        return 0
+
+    found = credential_replica.get_many(location_ids) if credential_replica.is_enabled() else {}
+    missing = [location_id for location_id in location_ids if location_id not in found]
+    if missing:
+        # Una sola petición a D1 con sentencias IN (...) para todas las que faltan
+        fetched, error = d1.fetch_credentials(missing)
+        if error:
+            logger.warning("No se pudieron precargar credenciales desde D1: %s", error[0])
+        else:
+            found.update(fetched)
+            for location_id in missing:
+                if location_id not in fetched:
+                    credential_cache.set(location_id, NOT_CONFIGURED)
+
+    for location_id, credentials in found.items():
+        credential_cache.set(location_id, credentials)
+    return len(found)
+
+
+def warm_connections():
+    """Abre conexiones con cada upstream. Devuelve {host: conexiones abiertas}."""
+    urls = (d1.CF_API_BASE_URL, SMARTPASSES_API_BASE_URL, token_store.GHL_API_BASE_URL)
+    opened = {}
+    threads = []
+    for url in urls:
+        def open_host(url=url):
+            opened[url] = http_client.preconnect(url, WARMUP_CONNECTIONS_PER_HOST)
+        threads.append(threading.Thread(target=open_host, daemon=True))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return opened
+
+
+def warm_templates(app):
+    """Compila las plantillas y renderiza la de configuración una vez."""
+    from flask import render_template
+
+    with app.test_request_context('/settings'):
+        for name in TEMPLATES:
+            app.jinja_env.get_template(name)
+        render_template('settings.html', location_id="")
+    return len(TEMPLATES)
+
+
+def warm_up(app, budget=None):
+    """
+    Ejecuta los pasos en paralelo y espera como máximo `budget` segundos.
+    Devuelve el reporte {paso: {"seconds", "result"} | "pending"}.
+    """
+    budget = WARMUP_BUDGET_SECONDS if budget is None else budget
+    steps = {
+        "connections": warm_connections,
+        "credentials": warm_credentials,
+        "templates": lambda: warm_templates(app),
+    }
+    report = {}
+    started = time.perf_counter()
+
+    def run(name, step):
+        step_started = time.perf_counter()
+        try:
+            result = step()
+        except Exception as e:
+            logger.exception("💥 Error en el calentamiento (%s): %s", name, e)
+            result = f"error: {e}"
+        report[name] = {"seconds": round(time.perf_counter() - step_started, 3), "result": result}
+
+    threads = [threading.Thread(target=run, args=(name, step), name=f"warmup-{name}", daemon=True)
+               for name, step in steps.items()]
+    for thread in threads:
+        thread.start()
+    deadline = started + budget
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.perf_counter()))
+
+    for name in steps:
+        report.setdefault(name, "pending")
+    report["total_seconds"] = round(time.perf_counter() - started, 3)
+    last_report.clear()
+    last_report.update(report)
+    logger.info("🔥 Calentamiento del worker terminado", extra={"warmup": report})
+    return report
@@ -2,13 +2,17 @@
 # webhook_handler.py
 # Maneja las notificaciones de webhook que llegan de GoHighLevel.
 
+import logging
 from flask import Blueprint, request, jsonify
 import hmac
 import hashlib
-import json
 import os
+import webhook_queue
+import customer_index
+from structured_log import log_payload
 
 webhook_bp = Blueprint('webhook', __name__)
+logger = logging.getLogger(__name__)
 
 @webhook_bp.route('/webhook/ghl', methods=['POST'])
 def handle_ghl_webhook():
@@ -21,7 +25,7 @@ def handle_ghl_webhook():
     shared_secret = os.environ.get('GHL_SHARED_SECRET')
 
     if not ghl_signature or not shared_secret:
-        print("❌ Webhook recibido sin firma o sin Shared Secret configurado.")
+        logger.warning("❌ Webhook recibido sin firma o sin Shared Secret configurado.")
         return jsonify({"error": "Configuración de seguridad incompleta."}), 400
 
     # Calculamos nuestra propia firma usando el cuerpo de la petición y el secreto.
@@ -31,34 +35,87 @@ def handle_ghl_webhook():
 
     # Comparamos las firmas. Si no coinciden, es una petición falsa.
     if not hmac.compare_digest(calculated_signature, ghl_signature):
-        print("❌ ¡Alerta de Seguridad! La firma del webhook es inválida.")
+        logger.warning("❌ ¡Alerta de Seguridad! La firma del webhook es inválida.")
         return jsonify({"error": "Firma inválida."}), 401
 
-    print("✅ Firma del webhook verificada exitosamente.")
-
-    # --- Procesamiento del Webhook ---
+    # --- Encolado del Webhook ---
     webhook_data = request.json
     event_type = webhook_data.get('type')
 
-    print(f"📥 Webhook recibido de tipo: {event_type}")
-    print(f"📋 Datos completos: {json.dumps(webhook_data, indent=2)}")
+    log_payload(logger, 'webhook', "📥 Webhook recibido", request_body,
+                event_type=event_type, location_id=webhook_data.get('locationId'))
+
+    # GHL reentrega eventos: los que ya vimos se confirman sin procesarlos otra vez
+    event_id = webhook_queue.event_id(webhook_data, request_body)
 
-    # Aquí puedes agregar lógica específica según el tipo de evento
-    # Por ejemplo:
-    # if event_type == 'contact.created':
-    #     handle_contact_created(webhook_data)
-    # elif event_type == 'contact.updated':
-    #     handle_contact_updated(webhook_data)
+    # Si la cola está desactivada, se procesa en línea como antes
+    if not webhook_queue.WEBHOOK_QUEUE_ENABLED:
+        if not webhook_queue.mark_seen(event_id):
+            logger.info("♻️ Webhook duplicado ignorado: %s", event_id)
+            return jsonify({"status": "duplicate", "type": event_type}), 200
+        try:
+            dispatch_webhook_event(webhook_data)
+        except Exception:
+            # GHL reentrega tras el 500: esa reentrega no debe tomarse por duplicada
+            webhook_queue.forget_seen(event_id)
+            raise
+        return jsonify({"status": "received", "type": event_type}), 200
 
-    # Por ahora, solo confirmamos que recibimos el webhook
-    return jsonify({"status": "received", "type": event_type}), 200
+    # El procesamiento real ocurre en los consumidores de webhook_queue,
+    # así respondemos a GHL de inmediato sin ocupar el worker.
+    # Las actualizaciones seguidas de un mismo contacto se fusionan en un solo trabajo.
+    job_id, outcome = webhook_queue.enqueue(
+        request_body.decode('utf-8'), event_type,
+        event_id=event_id, coalesce_key=webhook_queue.coalesce_key(webhook_data)
+    )
+    if outcome == 'duplicate':
+        logger.info("♻️ Webhook duplicado ignorado: %s", event_id)
+        return jsonify({"status": "duplicate", "type": event_type}), 200
+    return jsonify({"status": "received", "type": event_type, "job_id": job_id, "coalesced": outcome == 'coalesced'}), 200
+
+def dispatch_webhook_event(webhook_data):
+    """
+    Envía el webhook al manejador de su tipo de evento.
+    Se ejecuta desde los consumidores de la cola; si lanza una excepción, el trabajo se reintenta.
+    """
+    event_type = webhook_data.get('type')
+    logger.info("📋 Procesando webhook de tipo: %s", event_type)
+
+    if event_type in ('contact.created', 'ContactCreate'):
+        handle_contact_created(webhook_data)
+    elif event_type in ('contact.updated', 'ContactUpdate'):
+        handle_contact_updated(webhook_data)
+    elif event_type in ('contact.deleted', 'ContactDelete'):
+        handle_contact_deleted(webhook_data)
+    else:
+        logger.info("ℹ️ Tipo de webhook sin manejador: %s", event_type)
+
+def _contact_keys(data):
+    """(locationId, contactId, email) del contacto del webhook."""
+    contact = data.get('contact') or data
+    contact_id = contact.get('id') or data.get('contactId')
+    return data.get('locationId'), contact_id, contact.get('email')
 
 def handle_contact_created(data):
     """Maneja cuando se crea un nuevo contacto en GHL"""
-    print(f"🆕 Nuevo contacto creado: {data.get('contact', {}).get('email')}")
+    location_id, contact_id, email = _contact_keys(data)
+    logger.info("🆕 Nuevo contacto creado: %s", contact_id)
+    # Si ya existía un cliente con ese email (p. ej. cargado por el backfill), se asocia al contacto
+    customer_index.link(location_id, contact_id, email)
     # Aquí puedes agregar lógica para crear automáticamente el cliente en SmartPasses
 
 def handle_contact_updated(data):
     """Maneja cuando se actualiza un contacto en GHL"""
-    print(f"🔄 Contacto actualizado: {data.get('contact', {}).get('email')}")
+    location_id, contact_id, email = _contact_keys(data)
+    logger.info("🔄 Contacto actualizado: %s", contact_id)
+    # Mantiene el índice al día (p. ej. si el contacto cambió de email)
+    customer = customer_index.link(location_id, contact_id, email)
+    if customer is not None:
+        logger.debug("Contacto %s asociado al cliente %s", contact_id, customer['customer_id'])
     # Aquí puedes agregar lógica para actualizar el cliente en SmartPasses
+
+def handle_contact_deleted(data):
+    """Maneja cuando se elimina un contacto en GHL"""
+    location_id, contact_id, email = _contact_keys(data)
+    logger.info("🗑️ Contacto eliminado: %s", contact_id)
+    customer_index.forget(location_id, contact_id, email)
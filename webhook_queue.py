@@ -0,0 +1,339 @@
+# webhook_queue.py
+# Cola durable (SQLite) para los webhooks de GHL y sus consumidores en segundo plano.
+# El endpoint solo verifica la firma y encola; los hilos de este módulo procesan.
+#
+# Antes de encolar se descartan las reentregas de GHL (índice acotado de ids de
+# evento) y las actualizaciones de un mismo contacto que llegan dentro de
+# WEBHOOK_COALESCE_WINDOW se fusionan en un solo trabajo con el estado más reciente.
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from local_db import get_connection
+
+logger = logging.getLogger(__name__)
+
+# Configuración por variables de entorno
+WEBHOOK_QUEUE_ENABLED = os.environ.get('WEBHOOK_QUEUE_ENABLED', 'true').lower() == 'true'
+WEBHOOK_QUEUE_WORKERS = int(os.environ.get('WEBHOOK_QUEUE_WORKERS', 2))
+WEBHOOK_QUEUE_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_QUEUE_MAX_ATTEMPTS', 5))
+WEBHOOK_QUEUE_RETRY_DELAY = float(os.environ.get('WEBHOOK_QUEUE_RETRY_DELAY', 5))
+WEBHOOK_QUEUE_LEASE = float(os.environ.get('WEBHOOK_QUEUE_LEASE', 120))
+WEBHOOK_QUEUE_POLL_INTERVAL = float(os.environ.get('WEBHOOK_QUEUE_POLL_INTERVAL', 1))
+WEBHOOK_COALESCE_WINDOW = float(os.environ.get('WEBHOOK_COALESCE_WINDOW', 5))
+WEBHOOK_DEDUPE_MAX_EVENTS = int(os.environ.get('WEBHOOK_DEDUPE_MAX_EVENTS', 50000))
+WEBHOOK_DEDUPE_TTL = float(os.environ.get('WEBHOOK_DEDUPE_TTL', 86400))
+
+# Campos del cuerpo que GHL usa como id de la entrega
+EVENT_ID_FIELDS = ('webhookId', 'eventId')
+# Eventos que se pueden fusionar por contacto (solo importa el último estado)
+COALESCE_EVENT_TYPES = ('contact.updated', 'ContactUpdate')
+
+DB_NAME = 'webhook_queue'
+
+_wakeup = threading.Event()
+_workers = []
+_workers_lock = threading.Lock()
+_schema_ready = False
+_seen_inserts = 0
+
+
+def _db():
+    global _schema_ready
+    conn = get_connection(DB_NAME)
+    if not _schema_ready:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS webhook_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                event_type TEXT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                coalesce_key TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_webhook_jobs_available
+                ON webhook_jobs (available_at);
+            CREATE TABLE IF NOT EXISTS webhook_dead_letter (
+                id INTEGER PRIMARY KEY,
+                event_type TEXT,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                failed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS webhook_seen_events (
+                event_id TEXT PRIMARY KEY,
+                seen_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_webhook_seen_at ON webhook_seen_events (seen_at);
+            CREATE TABLE IF NOT EXISTS webhook_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+        # Colas creadas antes de la fusión por contacto no tienen la columna
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(webhook_jobs);")}
+        if 'coalesce_key' not in columns:
+            try:
+                conn.execute("ALTER TABLE webhook_jobs ADD COLUMN coalesce_key TEXT;")
+            except sqlite3.OperationalError as e:
+                # Otro hilo o worker la agregó entre la consulta y el ALTER
+                if 'duplicate column' not in str(e):
+                    raise
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_webhook_jobs_coalesce ON webhook_jobs (coalesce_key, status);"
+        )
+        _schema_ready = True
+    return conn
+
+
+def event_id(webhook_data, raw_body):
+    """Id de la entrega; si GHL no lo envía, el hash del cuerpo identifica las reentregas."""
+    for field in EVENT_ID_FIELDS:
+        if webhook_data.get(field):
+            return str(webhook_data[field])
+    return hashlib.sha256(raw_body).hexdigest()
+
+
+def coalesce_key(webhook_data):
+    """(locationId, contactId) para los eventos que se pueden fusionar, o None."""
+    if webhook_data.get('type') not in COALESCE_EVENT_TYPES:
+        return None
+    contact = webhook_data.get('contact') or {}
+    contact_id = contact.get('id') or webhook_data.get('contactId') or webhook_data.get('id')
+    location_id = webhook_data.get('locationId')
+    if not contact_id or not location_id:
+        return None
+    return f"{location_id}:{contact_id}"
+
+
+def _increment(conn, name):
+    conn.execute(
+        "INSERT INTO webhook_counters (name, value) VALUES (?, 1) "
+        "ON CONFLICT(name) DO UPDATE SET value = value + 1;",
+        [name]
+    )
+
+
+def _record_seen(conn, event_id, now):
+    """Registra el id; devuelve False si ya se había visto (reentrega)."""
+    global _seen_inserts
+    if conn.execute(
+        "INSERT OR IGNORE INTO webhook_seen_events (event_id, seen_at) VALUES (?, ?);", [event_id, now]
+    ).rowcount == 0:
+        return False
+
+    # El índice se poda de vez en cuando por antigüedad y por tamaño
+    _seen_inserts += 1
+    if _seen_inserts % 500 == 0:
+        conn.execute("DELETE FROM webhook_seen_events WHERE seen_at < ?;", [now - WEBHOOK_DEDUPE_TTL])
+        conn.execute(
+            "DELETE FROM webhook_seen_events WHERE seen_at < ("
+            "SELECT seen_at FROM webhook_seen_events ORDER BY seen_at DESC LIMIT 1 OFFSET ?);",
+            [WEBHOOK_DEDUPE_MAX_EVENTS]
+        )
+    return True
+
+
+def mark_seen(event_id):
+    """Para el procesamiento en línea (cola desactivada): False si el evento es una reentrega."""
+    conn = _db()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        _increment(conn, 'events_received')
+        fresh = _record_seen(conn, event_id, time.time())
+        if not fresh:
+            _increment(conn, 'duplicates_dropped')
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+    return fresh
+
+
+def forget_seen(event_id):
+    """Quita la marca de mark_seen si el procesamiento en línea falló, para aceptar la reentrega."""
+    _db().execute("DELETE FROM webhook_seen_events WHERE event_id = ?;", [event_id])
+
+
+def enqueue(payload, event_type=None, event_id=None, coalesce_key=None):
+    """
+    Guarda el webhook (texto JSON ya verificado). Devuelve (job_id, resultado), donde
+    resultado es 'queued', 'coalesced' (se actualizó un trabajo pendiente del mismo
+    contacto) o 'duplicate' (reentrega ya vista; job_id es None).
+    """
+    conn = _db()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        _increment(conn, 'events_received')
+        if event_id is not None and not _record_seen(conn, event_id, now):
+            _increment(conn, 'duplicates_dropped')
+            conn.execute("COMMIT;")
+            return None, 'duplicate'
+
+        if coalesce_key is not None:
+            row = conn.execute(
+                "SELECT id FROM webhook_jobs WHERE coalesce_key = ? AND status = 'pending' AND attempts = 0 "
+                "ORDER BY id DESC LIMIT 1;",
+                [coalesce_key]
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE webhook_jobs SET payload = ?, event_type = ? WHERE id = ?;",
+                    [payload, event_type, row['id']]
+                )
+                _increment(conn, 'coalesced')
+                conn.execute("COMMIT;")
+                return row['id'], 'coalesced'
+
+        # Los eventos fusionables esperan la ventana para absorber los siguientes
+        available_at = now + WEBHOOK_COALESCE_WINDOW if coalesce_key is not None else now
+        cursor = conn.execute(
+            "INSERT INTO webhook_jobs (event_type, payload, available_at, created_at, coalesce_key) "
+            "VALUES (?, ?, ?, ?, ?);",
+            [event_type, payload, available_at, now, coalesce_key]
+        )
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+    if coalesce_key is None:
+        _wakeup.set()
+    return cursor.lastrowid, 'queued'
+
+
+def _claim():
+    """
+    Reserva el siguiente trabajo disponible. Los trabajos 'processing' cuyo
+    plazo venció (worker caído) vuelven a estar disponibles.
+    """
+    conn = _db()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        row = conn.execute(
+            "SELECT id, event_type, payload, attempts FROM webhook_jobs "
+            "WHERE available_at <= ? ORDER BY id LIMIT 1;",
+            [now]
+        ).fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE webhook_jobs SET status = 'processing', attempts = attempts + 1, available_at = ? WHERE id = ?;",
+                [now + WEBHOOK_QUEUE_LEASE, row['id']]
+            )
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+    return row
+
+
+def _complete(job_id):
+    _db().execute("DELETE FROM webhook_jobs WHERE id = ?;", [job_id])
+
+
+def _fail(job, error):
+    conn = _db()
+    attempts = job['attempts'] + 1
+    if attempts >= WEBHOOK_QUEUE_MAX_ATTEMPTS:
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO webhook_dead_letter "
+                "(id, event_type, payload, attempts, last_error, created_at, failed_at) "
+                "SELECT id, event_type, payload, ?, ?, created_at, ? FROM webhook_jobs WHERE id = ?;",
+                [attempts, error, time.time(), job['id']]
+            )
+            conn.execute("DELETE FROM webhook_jobs WHERE id = ?;", [job['id']])
+            conn.execute("COMMIT;")
+        except Exception:
+            conn.execute("ROLLBACK;")
+            raise
+        logger.error("☠️ Webhook %s enviado a dead-letter tras %s intentos: %s", job['id'], attempts, error)
+    else:
+        # Backoff exponencial entre reintentos
+        delay = WEBHOOK_QUEUE_RETRY_DELAY * (2 ** (attempts - 1))
+        conn.execute(
+            "UPDATE webhook_jobs SET status = 'pending', available_at = ?, last_error = ? WHERE id = ?;",
+            [time.time() + delay, error, job['id']]
+        )
+        logger.warning("🔁 Webhook %s falló (intento %s), reintento en %.0fs: %s", job['id'], attempts, delay, error)
+
+
+def _worker_loop(handler):
+    while True:
+        try:
+            job = _claim()
+        except Exception as e:
+            logger.exception("💥 Error leyendo la cola de webhooks: %s", e)
+            time.sleep(WEBHOOK_QUEUE_POLL_INTERVAL)
+            continue
+
+        if job is None:
+            _wakeup.wait(WEBHOOK_QUEUE_POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+
+        try:
+            handler(json.loads(job['payload']))
+        except Exception as e:
+            _fail(job, str(e))
+        else:
+            _complete(job['id'])
+
+
+def start_workers(handler):
+    """
+    Arranca los consumidores en segundo plano (una sola vez por proceso).
+    `handler` recibe el diccionario del webhook ya decodificado.
+    """
+    with _workers_lock:
+        if _workers or not WEBHOOK_QUEUE_ENABLED:
+            return
+        for i in range(WEBHOOK_QUEUE_WORKERS):
+            thread = threading.Thread(
+                target=_worker_loop, args=(handler,), name=f"webhook-worker-{i}", daemon=True
+            )
+            thread.start()
+            _workers.append(thread)
+
+
+def stats():
+    """Profundidad de la cola para monitoreo."""
+    conn = _db()
+    now = time.time()
+    row = conn.execute(
+        "SELECT "
+        "SUM(CASE WHEN status = 'pending' THEN 1 ELSE 0 END) AS pending, "
+        "SUM(CASE WHEN status = 'processing' AND available_at > ? THEN 1 ELSE 0 END) AS processing, "
+        "MIN(created_at) AS oldest "
+        "FROM webhook_jobs;",
+        [now]
+    ).fetchone()
+    dead = conn.execute("SELECT COUNT(*) FROM webhook_dead_letter;").fetchone()[0]
+    counters = dict(conn.execute("SELECT name, value FROM webhook_counters;").fetchall())
+    duplicates = counters.get('duplicates_dropped', 0)
+    coalesced = counters.get('coalesced', 0)
+    return {
+        "depth": (row['pending'] or 0) + (row['processing'] or 0),
+        "pending": row['pending'] or 0,
+        "processing": row['processing'] or 0,
+        "dead_letter": dead,
+        "oldest_age_seconds": round(now - row['oldest'], 1) if row['oldest'] else 0,
+        "workers": len(_workers),
+        "events_received": counters.get('events_received', 0),
+        "duplicates_dropped": duplicates,
+        "coalesced": coalesced,
+        # Cada evento descartado o fusionado es una llamada a SmartPasses que no se hizo
+        "upstream_calls_saved": duplicates + coalesced,
+    }